@@ -0,0 +1,175 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Binary corpora of nets, packing the vertex classes, keys (rows), edges and
+targets of all nets into a few flat arrays that are mapped into memory and
+read by net index.
+
+Version:    2014-05-08
+'''
+
+from array import array as typed_array
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import makedirs
+from os.path import join as path_join
+
+from numpy import array
+from numpy import float64
+from numpy import frombuffer
+from numpy import int16
+from numpy import int32
+from numpy import int64
+from numpy import load
+from numpy import save
+
+from .net import FrozenNet
+
+_HEADER = 'header.json'
+_VERSION = 2
+
+# The arrays of a corpus, each saved as a .npy file, with their dtypes and the
+#   typecodes used to build them. For a corpus of nets with V vertices and E
+#   edges in total:
+#
+#   net_ptr:    The offset of the first vertex of each net (N + 1).
+#   types:      The position of the class of each vertex (V).
+#   rows:       The row of the key of each keyed vertex, otherwise -1 (V).
+#   parent_ptr: The offset of the parents of each vertex (V + 1).
+#   parent_idx: The parents of each vertex, by position within its net (E).
+#   labels:     The label of each vertex with a label target, otherwise -1
+#               (V).
+#   target_ptr: The offset of the dense target of each vertex (V + 1).
+#   targets:    The dense targets of all vertices with them, flattened.
+_ARRAYS = (
+        ('net_ptr', int64, 'q', ),
+        ('types', int16, 'h', ),
+        ('rows', int32, 'i', ),
+        ('parent_ptr', int64, 'q', ),
+        ('parent_idx', int32, 'i', ),
+        ('labels', int32, 'i', ),
+        ('target_ptr', int64, 'q', ),
+        ('targets', float64, 'd', ),
+        )
+
+
+def _class_name(vertex_class):
+    # Note: Static source vertices are not named.
+    return getattr(vertex_class, 'name', vertex_class.__name__)
+
+# The fingerprint of the vocabulary of each class, None for those without,
+#   since the rows saved are only meaningful for the vocabularies.
+def _fingerprints(vertex_classes):
+    return [vertex_class.vocabulary.fingerprint()
+            if hasattr(vertex_class, 'vocabulary') else None
+            for vertex_class in vertex_classes]
+
+# Save the nets (any iterable, consumed once) as a corpus in the directory at
+#   path, with the class of each vertex given by its position in
+#   vertex_classes. Static sources can not be saved since their activations
+#   are not part of the format, construct keyed sources instead.
+def save_corpus(path, nets, vertex_classes):
+    code = {vertex_class: i for i, vertex_class in enumerate(vertex_classes)}
+    # Note: Typed arrays rather than lists, the corpus may not fit in memory
+    #   as Python objects.
+    arrays = {name: typed_array(typecode)
+            for name, _, typecode in _ARRAYS}
+    for name in ('net_ptr', 'parent_ptr', 'target_ptr', ):
+        arrays[name].append(0)
+
+    for net in nets:
+        net = net.freeze()
+        for vertex in net.vertices:
+            v_class = type(vertex)
+            if v_class.fan_in == 0:
+                raise ValueError('can not save vertices of class {}'.format(
+                    v_class.__name__))
+            arrays['types'].append(code[v_class])
+            arrays['rows'].append(getattr(vertex, 'row', -1))
+            target = getattr(vertex, 'target', None)
+            if isinstance(target, int):
+                arrays['labels'].append(target)
+            else:
+                arrays['labels'].append(-1)
+                if target is not None:
+                    arrays['targets'].extend(target.ravel().tolist())
+            arrays['target_ptr'].append(len(arrays['targets']))
+        parent_ptr = net.parent_ptr[1:] + len(arrays['parent_idx'])
+        arrays['parent_ptr'].extend(parent_ptr.tolist())
+        arrays['parent_idx'].extend(net.parent_idx.tolist())
+        arrays['net_ptr'].append(len(arrays['types']))
+
+    makedirs(path, exist_ok=True)
+    for name, dtype, _ in _ARRAYS:
+        save(path_join(path, name + '.npy'), frombuffer(arrays[name],
+            dtype=dtype))
+    with open(path_join(path, _HEADER), 'w') as out:
+        out.write(json_dumps({
+            'version': _VERSION,
+            'nets': len(arrays['net_ptr']) - 1,
+            'classes': [_class_name(c) for c in vertex_classes],
+            'vocabularies': _fingerprints(vertex_classes),
+            }))
+
+
+# A corpus saved by save_corpus, with the arrays mapped into memory so that
+#   nets can be read in any order (for example by shuffled indices, see
+#   data.mini_batches) and the pages are shared by all processes reading the
+#   same corpus. The vertex classes must be those the corpus was saved with,
+#   down to their vocabularies.
+class Corpus(object):
+    def __init__(self, path, vertex_classes):
+        with open(path_join(path, _HEADER)) as inp:
+            header = json_loads(inp.read())
+        if header['version'] != _VERSION:
+            raise ValueError('unsupported corpus version: {}'.format(
+                header['version']))
+        if header['classes'] != [_class_name(c) for c in vertex_classes]:
+            raise ValueError('vertex class mismatch for corpus: {}'.format(
+                path))
+        if header.get('vocabularies') != _fingerprints(vertex_classes):
+            raise ValueError('vocabulary mismatch for corpus: {}'.format(
+                path))
+
+        self.vertex_classes = tuple(vertex_classes)
+        for name, _, _ in _ARRAYS:
+            setattr(self, name, load(path_join(path, name + '.npy'),
+                mmap_mode='r'))
+
+    def __len__(self):
+        return self.net_ptr.size - 1
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # The i-th net of the corpus, frozen.
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError('corpus index out of range')
+        start, stop = self.net_ptr[i:i + 2].tolist()
+
+        target_ptr = self.target_ptr[start:stop + 1].tolist()
+        vertices = []
+        for j, (code, row, label) in enumerate(zip(
+                self.types[start:stop].tolist(),
+                self.rows[start:stop].tolist(),
+                self.labels[start:stop].tolist())):
+            v_class = self.vertex_classes[code]
+            if row >= 0:
+                vertex = v_class(v_class.vocabulary.key(row), row)
+            elif label >= 0:
+                vertex = v_class(target=label)
+            elif target_ptr[j] != target_ptr[j + 1]:
+                vertex = v_class(target=self.targets[
+                    target_ptr[j]:target_ptr[j + 1]].reshape(-1, 1))
+            else:
+                vertex = v_class()
+            vertices.append(vertex)
+
+        # Note: Copies as plain arrays, those of a memmap are far slower to
+        #   take views of.
+        parent_ptr = array(self.parent_ptr[start:stop + 1], dtype=int32)
+        parent_ptr -= parent_ptr[0]
+        parent_idx = array(self.parent_idx[self.parent_ptr[start]:
+            self.parent_ptr[stop]], dtype=int32)
+        return FrozenNet(vertices, parent_ptr, parent_idx)
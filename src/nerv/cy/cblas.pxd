@@ -23,3 +23,14 @@ cdef extern from 'cblas.h':
             int ldc) nogil
     void cblas_dger 'cblas_dger'(CBLAS_ORDER order, int M, int N, double alpha,
             double *X, int incX, double *Y, int incY, double *A, int lda) nogil
+
+    # Single precision versions of the above.
+    void cblas_sgemv 'cblas_sgemv'(CBLAS_ORDER order, CBLAS_TRANSPOSE TransA,
+            int M, int N, float alpha, float *A, int lda, float *X,
+            int incX, float beta, float *Y, int incY) nogil
+    void cblas_sgemm 'cblas_sgemm'(CBLAS_ORDER Order, CBLAS_TRANSPOSE TransA,
+            CBLAS_TRANSPOSE TransB, int M, int N, int K, float alpha,
+            float *A, int lda, float *B, int ldb, float beta, float *C,
+            int ldc) nogil
+    void cblas_sger 'cblas_sger'(CBLAS_ORDER order, int M, int N, float alpha,
+            float *X, int incX, float *Y, int incY, float *A, int lda) nogil
@@ -15,28 +15,62 @@ Author:     Pontus Stenetorp    <pontus stenetorp se>
 
 from numpy import dot
 from numpy import empty
+from numpy import float32
 from numpy import float64
+from numpy import int32
 
 cimport numpy
+from cython cimport floating
 from libc.math cimport exp
 from libc.math cimport log
 from libc.math cimport pow
+from libc.math cimport tanh
 from libc.string cimport memset
 from numpy cimport PyArray_DATA
+from numpy cimport float32_t
 from numpy cimport float64_t
+from numpy cimport int32_t
 
+from cblas cimport CBLAS_TRANSPOSE
+from cblas cimport CblasNoTrans
 from cblas cimport CblasRowMajor
 from cblas cimport CblasTrans
+from cblas cimport cblas_dgemm
 from cblas cimport cblas_dgemv
 from cblas cimport cblas_dger
+from cblas cimport cblas_sgemm
+from cblas cimport cblas_sgemv
+from cblas cimport cblas_sger
 
 DOUBLE = float64
 ctypedef float64_t DOUBLE_t
+FLOAT = float32
+ctypedef float32_t FLOAT_t
+ctypedef int32_t LABEL_t
 
-cdef inline void _softmax(const int size, const DOUBLE_t *x,
-        DOUBLE_t *out) nogil:
+# Note: The kernels are generated for both float and double (fused types),
+#   the wrappers dispatch on the dtype of x and out must be of the same dtype.
+
+# The kernels index the arrays as raw pointers, so each (array, shape) pair
+#   must be C-contiguous, of the given shape and of the same dtype as the
+#   first, float32 or float64. Raises a TypeError or ValueError otherwise.
+def _check(*arrays):
+    dtype = arrays[0][0].dtype
+    if dtype != FLOAT and dtype != DOUBLE:
+        raise TypeError('unsupported dtype: {}'.format(dtype))
+    for a, shape in arrays:
+        if a.dtype != dtype:
+            raise TypeError('dtype mismatch: {} != {}'.format(a.dtype, dtype))
+        if a.shape != shape:
+            raise ValueError('shape mismatch: {} != {}'.format(a.shape,
+                shape))
+        if not a.flags.c_contiguous:
+            raise ValueError('not contiguous')
+
+cdef inline void _softmax(const int size, const floating *x,
+        floating *out) noexcept nogil:
     cdef int i
-    cdef DOUBLE_t xmax, xsum, tmp
+    cdef floating xmax, xsum, tmp
 
     xmax = x[0]
     for i in range(1, size):
@@ -54,23 +88,32 @@ cdef inline void _softmax(const int size, const DOUBLE_t *x,
 def softmax(x, out=None):
     # XXX: IDENTICAL TO TANH_PRIME! Generate?
     cdef DOUBLE_t *x_ptr, *out_ptr
+    cdef FLOAT_t *x_f_ptr, *out_f_ptr
     cdef int size
 
     if out is None:
-        out = empty(x.shape)
+        out = empty(x.shape, dtype=x.dtype)
+    _check((x, x.shape, ), (out, x.shape, ))
 
-    x_ptr = <DOUBLE_t *> PyArray_DATA(x)
-    out_ptr = <DOUBLE_t *> PyArray_DATA(out)
     size = x.size
 
-    _softmax(size, x_ptr, out_ptr)
+    if x.dtype == FLOAT:
+        x_f_ptr = <FLOAT_t *> PyArray_DATA(x)
+        out_f_ptr = <FLOAT_t *> PyArray_DATA(out)
+        with nogil:
+            _softmax(size, x_f_ptr, out_f_ptr)
+    else:
+        x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+        out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+        with nogil:
+            _softmax(size, x_ptr, out_ptr)
     return out
 
 # Use?:
 #   http://scipy-lectures.github.io/advanced/advanced_numpy/
 #       #exercise-building-an-ufunc-from-scratch
-cdef inline void _tanh_prime(const int size, const DOUBLE_t *x,
-        DOUBLE_t *out) nogil:
+cdef inline void _tanh_prime(const int size, const floating *x,
+        floating *out) noexcept nogil:
     cdef int i
 
     for i in range(size):
@@ -79,14 +122,352 @@ cdef inline void _tanh_prime(const int size, const DOUBLE_t *x,
 def tanh_prime(x, out=None):
     # XXX: IDENTICAL TO SOFTMAX! Generate?
     cdef DOUBLE_t *x_ptr, *out_ptr
+    cdef FLOAT_t *x_f_ptr, *out_f_ptr
     cdef int size
 
     if out is None:
-        out = empty(x.shape)
+        out = empty(x.shape, dtype=x.dtype)
+    _check((x, x.shape, ), (out, x.shape, ))
 
-    x_ptr = <DOUBLE_t *> PyArray_DATA(x)
-    out_ptr = <DOUBLE_t *> PyArray_DATA(out)
     size = x.size
 
-    _tanh_prime(size, x_ptr, out_ptr)
+    if x.dtype == FLOAT:
+        x_f_ptr = <FLOAT_t *> PyArray_DATA(x)
+        out_f_ptr = <FLOAT_t *> PyArray_DATA(out)
+        with nogil:
+            _tanh_prime(size, x_f_ptr, out_f_ptr)
+    else:
+        x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+        out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+        with nogil:
+            _tanh_prime(size, x_ptr, out_ptr)
     return out
+
+# Row-major BLAS for either precision, see cblas.pxd.
+cdef inline void _gemv(CBLAS_TRANSPOSE trans, int m, int n, floating *a,
+        floating *x, floating beta, floating *y) noexcept nogil:
+    if floating is double:
+        cblas_dgemv(CblasRowMajor, trans, m, n, 1.0, a, n, x, 1, beta, y, 1)
+    else:
+        cblas_sgemv(CblasRowMajor, trans, m, n, 1.0, a, n, x, 1, beta, y, 1)
+
+cdef inline void _gemm(CBLAS_TRANSPOSE trans_a, CBLAS_TRANSPOSE trans_b,
+        int m, int n, int k, floating *a, int lda, floating *b, int ldb,
+        floating beta, floating *c) noexcept nogil:
+    if floating is double:
+        cblas_dgemm(CblasRowMajor, trans_a, trans_b, m, n, k, 1.0, a, lda,
+                b, ldb, beta, c, n)
+    else:
+        cblas_sgemm(CblasRowMajor, trans_a, trans_b, m, n, k, 1.0, a, lda,
+                b, ldb, beta, c, n)
+
+cdef inline void _ger(int m, int n, floating *x, floating *y,
+        floating *a) noexcept nogil:
+    if floating is double:
+        cblas_dger(CblasRowMajor, m, n, 1.0, x, 1, y, 1, a, n)
+    else:
+        cblas_sger(CblasRowMajor, m, n, 1.0, x, 1, y, 1, a, n)
+
+# The composition (RNN) layer for rows rows of inputs: the product with the
+#   weights (fan_out by fan_in), the bias and the non-linearity in one pass.
+cdef inline void _rnn_forward(const int rows, const int fan_out,
+        const int fan_in, floating *w, const floating *b, floating *x,
+        floating *out) noexcept nogil:
+    cdef int i, j
+
+    if rows == 1:
+        _gemv(CblasNoTrans, fan_out, fan_in, w, x, 0, out)
+    else:
+        _gemm(CblasNoTrans, CblasTrans, rows, fan_out, fan_in, x, fan_in,
+                w, fan_in, 0, out)
+
+    for i in range(rows):
+        for j in range(fan_out):
+            out[i * fan_out + j] = tanh(out[i * fan_out + j] + b[j])
+
+# The error (back) from the activations and incoming messages, accumulated
+#   into the weight and bias gradients, and the messages to the inputs.
+cdef inline void _rnn_backward(const int rows, const int fan_out,
+        const int fan_in, floating *w, floating *x, const floating *a,
+        const floating *incoming, floating *w_grad, floating *b_grad,
+        floating *back, floating *out) noexcept nogil:
+    cdef int i, j, k
+
+    for i in range(rows):
+        for j in range(fan_out):
+            k = i * fan_out + j
+            back[k] = (1 - a[k] * a[k]) * incoming[k]
+            b_grad[j] += back[k]
+
+    if rows == 1:
+        _ger(fan_out, fan_in, back, x, w_grad)
+        _gemv(CblasTrans, fan_out, fan_in, w, back, 0, out)
+    else:
+        _gemm(CblasTrans, CblasNoTrans, fan_out, fan_in, rows, back, fan_out,
+                x, fan_in, 1, w_grad)
+        _gemm(CblasNoTrans, CblasNoTrans, rows, fan_in, fan_out, back,
+                fan_out, w, fan_in, 0, out)
+
+# The rows of the input and the fan out and fan in of the weights of a layer.
+def _dims(weight, input_):
+    if weight.ndim != 2 or input_.ndim != 2:
+        raise ValueError('weights and input must be matrices')
+    fan_out, fan_in = weight.shape
+    return (input_.shape[0], fan_out, fan_in, )
+
+# The first rows * columns elements of scratch as a matrix, or a new one, see
+#   _scratch in the maths module.
+def _scratch(scratch, int rows, int columns, dtype):
+    if scratch is None:
+        return empty((rows, columns), dtype=dtype)
+    if scratch.size < rows * columns:
+        raise ValueError('scratch too small: {} < {}'.format(scratch.size,
+            rows * columns))
+    return scratch[:rows * columns].reshape(rows, columns)
+
+def rnn_forward(weight, bias, input_, out=None):
+    cdef int rows, fan_out, fan_in
+
+    rows, fan_out, fan_in = _dims(weight, input_)
+    if out is None:
+        out = empty((rows, fan_out), dtype=weight.dtype)
+    _check((weight, (fan_out, fan_in, ), ), (bias, (fan_out, 1, ), ),
+            (input_, (rows, fan_in, ), ), (out, (rows, fan_out, ), ))
+
+    if weight.dtype == FLOAT:
+        _rnn_forward_f(rows, fan_out, fan_in, weight, bias, input_, out)
+    else:
+        _rnn_forward_d(rows, fan_out, fan_in, weight, bias, input_, out)
+    return out
+
+def rnn_backward(weight, input_, activations, incoming, w_gradient,
+        b_gradient, out=None, scratch=None):
+    cdef int rows, fan_out, fan_in
+
+    rows, fan_out, fan_in = _dims(weight, input_)
+    if out is None:
+        out = empty((rows, fan_in), dtype=weight.dtype)
+    back = _scratch(scratch, rows, fan_out, weight.dtype)
+    _check((weight, (fan_out, fan_in, ), ), (input_, (rows, fan_in, ), ),
+            (activations, (rows, fan_out, ), ),
+            (incoming, (rows, fan_out, ), ),
+            (w_gradient, (fan_out, fan_in, ), ),
+            (b_gradient, (fan_out, 1, ), ), (out, (rows, fan_in, ), ),
+            (back, (rows, fan_out, ), ))
+
+    if weight.dtype == FLOAT:
+        _rnn_backward_f(rows, fan_out, fan_in, weight, input_, activations,
+                incoming, w_gradient, b_gradient, back, out)
+    else:
+        _rnn_backward_d(rows, fan_out, fan_in, weight, input_, activations,
+                incoming, w_gradient, b_gradient, back, out)
+    return out
+
+# XXX: One per dtype, since the pointers must be taken with the GIL.
+cdef void _rnn_forward_d(int rows, int fan_out, int fan_in, w, b, x, out):
+    cdef DOUBLE_t *w_ptr = <DOUBLE_t *> PyArray_DATA(w)
+    cdef DOUBLE_t *b_ptr = <DOUBLE_t *> PyArray_DATA(b)
+    cdef DOUBLE_t *x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+    cdef DOUBLE_t *out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+    with nogil:
+        _rnn_forward(rows, fan_out, fan_in, w_ptr, b_ptr, x_ptr, out_ptr)
+
+cdef void _rnn_forward_f(int rows, int fan_out, int fan_in, w, b, x, out):
+    cdef FLOAT_t *w_ptr = <FLOAT_t *> PyArray_DATA(w)
+    cdef FLOAT_t *b_ptr = <FLOAT_t *> PyArray_DATA(b)
+    cdef FLOAT_t *x_ptr = <FLOAT_t *> PyArray_DATA(x)
+    cdef FLOAT_t *out_ptr = <FLOAT_t *> PyArray_DATA(out)
+    with nogil:
+        _rnn_forward(rows, fan_out, fan_in, w_ptr, b_ptr, x_ptr, out_ptr)
+
+cdef void _rnn_backward_d(int rows, int fan_out, int fan_in, w, x, a,
+        incoming, w_grad, b_grad, back, out):
+    cdef DOUBLE_t *w_ptr = <DOUBLE_t *> PyArray_DATA(w)
+    cdef DOUBLE_t *x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+    cdef DOUBLE_t *a_ptr = <DOUBLE_t *> PyArray_DATA(a)
+    cdef DOUBLE_t *inc_ptr = <DOUBLE_t *> PyArray_DATA(incoming)
+    cdef DOUBLE_t *wg_ptr = <DOUBLE_t *> PyArray_DATA(w_grad)
+    cdef DOUBLE_t *bg_ptr = <DOUBLE_t *> PyArray_DATA(b_grad)
+    cdef DOUBLE_t *back_ptr = <DOUBLE_t *> PyArray_DATA(back)
+    cdef DOUBLE_t *out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+    with nogil:
+        _rnn_backward(rows, fan_out, fan_in, w_ptr, x_ptr, a_ptr, inc_ptr,
+                wg_ptr, bg_ptr, back_ptr, out_ptr)
+
+cdef void _rnn_backward_f(int rows, int fan_out, int fan_in, w, x, a,
+        incoming, w_grad, b_grad, back, out):
+    cdef FLOAT_t *w_ptr = <FLOAT_t *> PyArray_DATA(w)
+    cdef FLOAT_t *x_ptr = <FLOAT_t *> PyArray_DATA(x)
+    cdef FLOAT_t *a_ptr = <FLOAT_t *> PyArray_DATA(a)
+    cdef FLOAT_t *inc_ptr = <FLOAT_t *> PyArray_DATA(incoming)
+    cdef FLOAT_t *wg_ptr = <FLOAT_t *> PyArray_DATA(w_grad)
+    cdef FLOAT_t *bg_ptr = <FLOAT_t *> PyArray_DATA(b_grad)
+    cdef FLOAT_t *back_ptr = <FLOAT_t *> PyArray_DATA(back)
+    cdef FLOAT_t *out_ptr = <FLOAT_t *> PyArray_DATA(out)
+    with nogil:
+        _rnn_backward(rows, fan_out, fan_in, w_ptr, x_ptr, a_ptr, inc_ptr,
+                wg_ptr, bg_ptr, back_ptr, out_ptr)
+
+# The softmax layer for rows rows of inputs and the cross entropy of the rows
+#   with a label (otherwise -1), from the probability of the label alone.
+cdef inline double _softmax_xent(const int rows, const int fan_out,
+        const int fan_in, floating *w, const floating *b, floating *x,
+        const LABEL_t *labels, floating *out) noexcept nogil:
+    cdef int i, j
+    cdef double loss = 0
+
+    if rows == 1:
+        _gemv(CblasNoTrans, fan_out, fan_in, w, x, 0, out)
+    else:
+        _gemm(CblasNoTrans, CblasTrans, rows, fan_out, fan_in, x, fan_in,
+                w, fan_in, 0, out)
+
+    for i in range(rows):
+        for j in range(fan_out):
+            out[i * fan_out + j] += b[j]
+        # Note: In-place, each element is only read before it is written.
+        _softmax(fan_out, out + i * fan_out, out + i * fan_out)
+        if labels[i] >= 0:
+            loss -= log(out[i * fan_out + labels[i]])
+    return loss
+
+# The error (the probabilities less the one-hot label, nothing without a
+#   label) accumulated into the weight and bias gradients, and the messages
+#   to the inputs.
+cdef inline void _softmax_xent_backward(const int rows, const int fan_out,
+        const int fan_in, floating *w, floating *x, const floating *a,
+        const LABEL_t *labels, floating *w_grad, floating *b_grad,
+        floating *error, floating *out) noexcept nogil:
+    cdef int i, j, k
+
+    for i in range(rows):
+        for j in range(fan_out):
+            k = i * fan_out + j
+            error[k] = a[k] if labels[i] >= 0 else 0
+        if labels[i] >= 0:
+            error[i * fan_out + labels[i]] -= 1
+        for j in range(fan_out):
+            b_grad[j] += error[i * fan_out + j]
+
+    if rows == 1:
+        _ger(fan_out, fan_in, error, x, w_grad)
+        _gemv(CblasTrans, fan_out, fan_in, w, error, 0, out)
+    else:
+        _gemm(CblasTrans, CblasNoTrans, fan_out, fan_in, rows, error,
+                fan_out, x, fan_in, 1, w_grad)
+        _gemm(CblasNoTrans, CblasNoTrans, rows, fan_in, fan_out, error,
+                fan_out, w, fan_in, 0, out)
+
+# The labels are used as offsets by the kernels, so there must be one for each
+#   row and none may be out of range.
+cdef int _check_labels(labels, int rows, int fan_out) except -1:
+    cdef LABEL_t *l_ptr
+    cdef int i
+
+    if labels.dtype != int32 or not labels.flags.c_contiguous:
+        raise ValueError('labels not contiguous int32')
+    if labels.size != rows:
+        raise ValueError('label count mismatch: {} != {}'.format(
+            labels.size, rows))
+    l_ptr = <LABEL_t *> PyArray_DATA(labels)
+    for i in range(rows):
+        if l_ptr[i] >= fan_out:
+            raise ValueError('label out of range: {}'.format(l_ptr[i]))
+    return 0
+
+# Note: The labels must be a C-contiguous int32 array, see also rnn_forward.
+def softmax_xent(weight, bias, input_, labels, out=None):
+    cdef int rows, fan_out, fan_in
+    cdef double loss
+
+    rows, fan_out, fan_in = _dims(weight, input_)
+    _check_labels(labels, rows, fan_out)
+    if out is None:
+        out = empty((rows, fan_out), dtype=weight.dtype)
+    _check((weight, (fan_out, fan_in, ), ), (bias, (fan_out, 1, ), ),
+            (input_, (rows, fan_in, ), ), (out, (rows, fan_out, ), ))
+
+    if weight.dtype == FLOAT:
+        loss = _softmax_xent_f(rows, fan_out, fan_in, weight, bias, input_,
+                labels, out)
+    else:
+        loss = _softmax_xent_d(rows, fan_out, fan_in, weight, bias, input_,
+                labels, out)
+    return (out, loss, )
+
+def softmax_xent_backward(weight, input_, activations, labels, w_gradient,
+        b_gradient, out=None, scratch=None):
+    cdef int rows, fan_out, fan_in
+
+    rows, fan_out, fan_in = _dims(weight, input_)
+    _check_labels(labels, rows, fan_out)
+    if out is None:
+        out = empty((rows, fan_in), dtype=weight.dtype)
+    error = _scratch(scratch, rows, fan_out, weight.dtype)
+    _check((weight, (fan_out, fan_in, ), ), (input_, (rows, fan_in, ), ),
+            (activations, (rows, fan_out, ), ),
+            (w_gradient, (fan_out, fan_in, ), ),
+            (b_gradient, (fan_out, 1, ), ), (out, (rows, fan_in, ), ),
+            (error, (rows, fan_out, ), ))
+
+    if weight.dtype == FLOAT:
+        _softmax_xent_backward_f(rows, fan_out, fan_in, weight, input_,
+                activations, labels, w_gradient, b_gradient, error, out)
+    else:
+        _softmax_xent_backward_d(rows, fan_out, fan_in, weight, input_,
+                activations, labels, w_gradient, b_gradient, error, out)
+    return out
+
+cdef double _softmax_xent_d(int rows, int fan_out, int fan_in, w, b, x,
+        labels, out):
+    cdef DOUBLE_t *w_ptr = <DOUBLE_t *> PyArray_DATA(w)
+    cdef DOUBLE_t *b_ptr = <DOUBLE_t *> PyArray_DATA(b)
+    cdef DOUBLE_t *x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+    cdef LABEL_t *l_ptr = <LABEL_t *> PyArray_DATA(labels)
+    cdef DOUBLE_t *out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+    cdef double loss
+    with nogil:
+        loss = _softmax_xent(rows, fan_out, fan_in, w_ptr, b_ptr, x_ptr,
+                l_ptr, out_ptr)
+    return loss
+
+cdef double _softmax_xent_f(int rows, int fan_out, int fan_in, w, b, x,
+        labels, out):
+    cdef FLOAT_t *w_ptr = <FLOAT_t *> PyArray_DATA(w)
+    cdef FLOAT_t *b_ptr = <FLOAT_t *> PyArray_DATA(b)
+    cdef FLOAT_t *x_ptr = <FLOAT_t *> PyArray_DATA(x)
+    cdef LABEL_t *l_ptr = <LABEL_t *> PyArray_DATA(labels)
+    cdef FLOAT_t *out_ptr = <FLOAT_t *> PyArray_DATA(out)
+    cdef double loss
+    with nogil:
+        loss = _softmax_xent(rows, fan_out, fan_in, w_ptr, b_ptr, x_ptr,
+                l_ptr, out_ptr)
+    return loss
+
+cdef void _softmax_xent_backward_d(int rows, int fan_out, int fan_in, w, x,
+        a, labels, w_grad, b_grad, error, out):
+    cdef DOUBLE_t *w_ptr = <DOUBLE_t *> PyArray_DATA(w)
+    cdef DOUBLE_t *x_ptr = <DOUBLE_t *> PyArray_DATA(x)
+    cdef DOUBLE_t *a_ptr = <DOUBLE_t *> PyArray_DATA(a)
+    cdef LABEL_t *l_ptr = <LABEL_t *> PyArray_DATA(labels)
+    cdef DOUBLE_t *wg_ptr = <DOUBLE_t *> PyArray_DATA(w_grad)
+    cdef DOUBLE_t *bg_ptr = <DOUBLE_t *> PyArray_DATA(b_grad)
+    cdef DOUBLE_t *error_ptr = <DOUBLE_t *> PyArray_DATA(error)
+    cdef DOUBLE_t *out_ptr = <DOUBLE_t *> PyArray_DATA(out)
+    with nogil:
+        _softmax_xent_backward(rows, fan_out, fan_in, w_ptr, x_ptr, a_ptr,
+                l_ptr, wg_ptr, bg_ptr, error_ptr, out_ptr)
+
+cdef void _softmax_xent_backward_f(int rows, int fan_out, int fan_in, w, x,
+        a, labels, w_grad, b_grad, error, out):
+    cdef FLOAT_t *w_ptr = <FLOAT_t *> PyArray_DATA(w)
+    cdef FLOAT_t *x_ptr = <FLOAT_t *> PyArray_DATA(x)
+    cdef FLOAT_t *a_ptr = <FLOAT_t *> PyArray_DATA(a)
+    cdef LABEL_t *l_ptr = <LABEL_t *> PyArray_DATA(labels)
+    cdef FLOAT_t *wg_ptr = <FLOAT_t *> PyArray_DATA(w_grad)
+    cdef FLOAT_t *bg_ptr = <FLOAT_t *> PyArray_DATA(b_grad)
+    cdef FLOAT_t *error_ptr = <FLOAT_t *> PyArray_DATA(error)
+    cdef FLOAT_t *out_ptr = <FLOAT_t *> PyArray_DATA(out)
+    with nogil:
+        _softmax_xent_backward(rows, fan_out, fan_in, w_ptr, x_ptr, a_ptr,
+                l_ptr, wg_ptr, bg_ptr, error_ptr, out_ptr)
@@ -11,10 +11,19 @@ Version:    2014-03-12
 # TODO: Implement remove_edge?
 # TODO: Could use more clever caching rather than full invalidation.
 # TODO: The above cache would also allow us to avoid a method call.
-# TODO: Consider an incremental topological sort?
 # TODO: Sanity checking?
 
 from collections import defaultdict
+from itertools import chain
+
+from numpy import arange
+from numpy import array
+from numpy import bincount
+from numpy import cumsum
+from numpy import diff
+from numpy import int32
+from numpy import repeat
+from numpy import zeros
 
 from lib.structs import OrderedSet
 from lib.structs import enum
@@ -27,20 +36,108 @@ class DAG(object):
         self.parents = defaultdict(OrderedSet)
         self.children = defaultdict(OrderedSet)
         self.vertices = set()
+        # The topological order, maintained incrementally as edges are added
+        #   (see _reorder): the position of each vertex and the vertex at
+        #   each position.
+        self._order = {}
+        self._by_order = []
         # Cache(s).
         self._topo_sort = None
+        self._levels = None
 
     def __iter__(self):
         return iter(self.vertices)
 
+    # Raises a ValueError if the edge would introduce a cycle, in which case
+    #   the DAG is left as it was.
     def add_edge(self, parent, child):
+        if parent is child:
+            raise ValueError('edge would introduce a cycle')
+
+        order = self._order
+        for vertex in (parent, child):
+            if vertex not in order:
+                order[vertex] = len(self._by_order)
+                self._by_order.append(vertex)
+        if order[child] < order[parent]:
+            self._reorder(parent, child)
+
         self.vertices.add(parent)
         self.vertices.add(child)
         self.parents[child].add(parent)
         self.children[parent].add(child)
 
+        self._invalidate()
+
+    # Add a vertex without any edges, edges add their vertices themselves.
+    def add_vertex(self, vertex):
+        if vertex in self.vertices:
+            return
+
+        self._order[vertex] = len(self._by_order)
+        self._by_order.append(vertex)
+        self.vertices.add(vertex)
+
+        self._invalidate()
+
+    # Restore the topological order for a new edge from parent to child where
+    #   the child precedes the parent, re-ordering only the vertices placed
+    #   between the two. From "A Dynamic Topological Sort Algorithm for
+    #   Directed Acyclic Graphs" by Pearce and Kelly (2007).
+    def _reorder(self, parent, child):
+        order = self._order
+        lower = order[child]
+        upper = order[parent]
+
+        # The descendants of the child placed before the parent, if the parent
+        #   is among them the edge would introduce a cycle.
+        forward = [child]
+        visited = {child}
+        stack = [child]
+        while stack:
+            for vertex in self.children[stack.pop()]:
+                if vertex is parent:
+                    raise ValueError('edge would introduce a cycle')
+                if vertex not in visited and order[vertex] < upper:
+                    visited.add(vertex)
+                    forward.append(vertex)
+                    stack.append(vertex)
+
+        # The ancestors of the parent placed after the child.
+        backward = [parent]
+        visited = {parent}
+        stack = [parent]
+        while stack:
+            for vertex in self.parents[stack.pop()]:
+                if vertex not in visited and order[vertex] > lower:
+                    visited.add(vertex)
+                    backward.append(vertex)
+                    stack.append(vertex)
+
+        # Place the ancestors before the descendants, re-using the positions
+        #   of both while keeping their relative order.
+        backward.sort(key=order.__getitem__)
+        forward.sort(key=order.__getitem__)
+        positions = sorted(order[vertex]
+                for vertex in chain(backward, forward))
+        for vertex, position in zip(chain(backward, forward), positions):
+            order[vertex] = position
+            self._by_order[position] = vertex
+
+    def _invalidate(self):
         # Invalidate cache(s).
         self._topo_sort = None
+        self._levels = None
+
+    def freeze(self):
+        return FrozenDAG.from_dag(self)
+
+    # The vertices in topological order and the (int32) CSR arrays of their
+    #   parents, as held by a frozen DAG.
+    def csr(self):
+        vertices = tuple(self.topological_sort())
+        index = {vertex: i for i, vertex in enumerate(vertices)}
+        return (vertices, ) + _csr(self.parents, vertices, index)
 
     def typed_it(self):
         for vertex in self:
@@ -60,45 +157,192 @@ class DAG(object):
     def internals(self):
         return (v for t, v in self.typed_it() if t == VertexType.INTERNAL)
 
-    # http://en.wikipedia.org/wiki/Topological_sorting
-    def _topological_sort(self):
-        tsort = []
-        processed = set()
-
-        # Start a Depth-First Search (DFS) from each vertex and add each
-        #   vertex after the search has added their children to the order.
-        #   Lastly, reverse the order to gain the topological sort.
-        for start in self:
-            # No need to process a vertex twice.
-            if start in processed:
-                continue
-
-            # Start the DFS from this vertex.
-            queue = [start]
-            while queue:
-                current = queue[-1]
-                # If we have already processed this vertex it means that all
-                #   of its descendants have been processed and we can safely
-                #   add it to the topological sort.
-                if current in processed:
-                    tsort.append(current)
-                    queue.pop()
-                    continue
-
-                # Process the vertex by adding each of its unprocessed
-                #   children to the queue.
-                for child in self.children[current]:
-                    if child not in processed:
-                        queue.append(child)
-                processed.add(current)
-
-        return reversed(tsort)
-
     def topological_sort(self, reverse=False):
         if self._topo_sort is not None:
             topo_sort = self._topo_sort
         else:
-            topo_sort = tuple(self._topological_sort())
+            topo_sort = tuple(self._by_order)
             self._topo_sort = topo_sort
 
         return topo_sort if not reverse else reversed(topo_sort)
+
+    # Group the vertices by their depth, the length of the longest path from
+    #   any source. Vertices at the same depth are independent of each other
+    #   given the vertices at lower depths.
+    def _level_sort(self):
+        depth = {}
+        levels = []
+        for vertex in self.topological_sort():
+            parents = self.parents[vertex]
+            if parents:
+                level = max(depth[parent] for parent in parents) + 1
+            else:
+                level = 0
+            depth[vertex] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(vertex)
+
+        return (tuple(level) for level in levels)
+
+    def levels(self, reverse=False):
+        if self._levels is not None:
+            levels = self._levels
+        else:
+            levels = tuple(self._level_sort())
+            self._levels = levels
+
+        return levels if not reverse else reversed(levels)
+
+
+# Offsets and indices (Compressed Sparse Row) of the adjacent vertices of
+#   each vertex, in the given order.
+def _csr(adjacency, vertices, index):
+    ptr = zeros(len(vertices) + 1, dtype=int32)
+    idx = []
+    for i, vertex in enumerate(vertices):
+        # Note: Using get avoids adding entries to a defaultdict.
+        idx.extend(index[adjacent] for adjacent in adjacency.get(vertex, ()))
+        ptr[i + 1] = len(idx)
+    return (ptr, array(idx, dtype=int32), )
+
+# The CSR arrays of the transposed adjacency, the children from the parents.
+def _transpose(ptr, idx, size):
+    adjacent = repeat(arange(size, dtype=int32), diff(ptr))
+    order = idx.argsort(kind='mergesort')
+    t_ptr = zeros(size + 1, dtype=int32)
+    cumsum(bincount(idx, minlength=size), out=t_ptr[1:])
+    return (t_ptr, adjacent[order], )
+
+
+# Read-only mapping from each vertex of a frozen DAG to its parents (or
+#   children), as found in the parents (or children) of a DAG.
+class _Adjacency(object):
+    def __init__(self, dag, ptr, idx):
+        self._dag = dag
+        self._ptr = ptr
+        self._idx = idx
+
+    def __getitem__(self, vertex):
+        i = self._dag.index(vertex)
+        vertices = self._dag.vertices
+        return tuple(vertices[j]
+                for j in self._idx[self._ptr[i]:self._ptr[i + 1]].tolist())
+
+    def __iter__(self):
+        return iter(self._dag.vertices)
+
+    def __len__(self):
+        return len(self._dag.vertices)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((vertex, self[vertex]) for vertex in self)
+
+
+# An immutable DAG, with vertices identified by their position in a
+#   topological order and the edges held as CSR arrays, which takes a fraction
+#   of the memory of a DAG. See DAG.freeze.
+#
+# The vertices must be in topological order, with the parents of each vertex
+#   given by the (int32) offsets and indices of the parent CSR arrays.
+class FrozenDAG(object):
+    def __init__(self, vertices, parent_ptr, parent_idx):
+        self.vertices = tuple(vertices)
+        self.parent_ptr = parent_ptr
+        self.parent_idx = parent_idx
+        # Note: The children of a vertex are in topological order.
+        self.child_ptr, self.child_idx = _transpose(parent_ptr, parent_idx,
+                len(self.vertices))
+        # Cache(s).
+        self._index = None
+        self._levels = None
+
+    @classmethod
+    def from_dag(cls, dag):
+        return cls(*dag.csr())
+
+    def __iter__(self):
+        return iter(self.vertices)
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def add_vertex(self, vertex):
+        raise TypeError('can not add vertices to a frozen DAG')
+
+    def add_edge(self, parent, child):
+        raise TypeError('can not add edges to a frozen DAG')
+
+    def freeze(self):
+        return self
+
+    def csr(self):
+        return (self.vertices, self.parent_ptr, self.parent_idx, )
+
+    # The identifier (position) of a vertex.
+    #
+    # Note: The mapping is only built when first needed, since it is as large
+    #   as the DAG itself.
+    def index(self, vertex):
+        if self._index is None:
+            self._index = {v: i for i, v in enumerate(self.vertices)}
+        return self._index[vertex]
+
+    @property
+    def parents(self):
+        return _Adjacency(self, self.parent_ptr, self.parent_idx)
+
+    @property
+    def children(self):
+        return _Adjacency(self, self.child_ptr, self.child_idx)
+
+    def typed_it(self):
+        parent_ptr = self.parent_ptr.tolist()
+        child_ptr = self.child_ptr.tolist()
+        for i, vertex in enumerate(self.vertices):
+            if parent_ptr[i] == parent_ptr[i + 1]:
+                yield (VertexType.SOURCE, vertex)
+            elif child_ptr[i] == child_ptr[i + 1]:
+                yield (VertexType.SINK, vertex)
+            else:
+                yield (VertexType.INTERNAL, vertex)
+
+    def sources(self):
+        return (v for t, v in self.typed_it() if t == VertexType.SOURCE)
+
+    def sinks(self):
+        return (v for t, v in self.typed_it() if t == VertexType.SINK)
+
+    def internals(self):
+        return (v for t, v in self.typed_it() if t == VertexType.INTERNAL)
+
+    def topological_sort(self, reverse=False):
+        return self.vertices if not reverse else reversed(self.vertices)
+
+    # See DAG.levels, the vertices being in topological order already.
+    def _level_sort(self):
+        ptr = self.parent_ptr.tolist()
+        idx = self.parent_idx.tolist()
+        depth = []
+        levels = []
+        for i, vertex in enumerate(self.vertices):
+            parents = idx[ptr[i]:ptr[i + 1]]
+            level = max(depth[j] for j in parents) + 1 if parents else 0
+            depth.append(level)
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(vertex)
+
+        return (tuple(level) for level in levels)
+
+    def levels(self, reverse=False):
+        if self._levels is not None:
+            levels = self._levels
+        else:
+            levels = tuple(self._level_sort())
+            self._levels = levels
+
+        return levels if not reverse else reversed(levels)
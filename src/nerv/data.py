@@ -0,0 +1,127 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Streaming of training data, constructing nets lazily from a corpus and
+grouping them into mini-batches without ever holding the whole corpus in
+memory.
+
+Version:    2014-05-07
+'''
+
+from itertools import islice
+from queue import Full
+from queue import Queue
+from random import randint
+from random import shuffle
+from threading import Event
+from threading import Thread
+
+
+# Shuffle within a buffer of at most buffer_size items: once the buffer is
+#   full, each new item replaces (and yields) a random item in the buffer.
+def shuffled(items, buffer_size):
+    buf = []
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        i = randint(0, buffer_size - 1)
+        yield buf[i]
+        buf[i] = item
+
+    shuffle(buf)
+    yield from buf
+
+# Consecutive mini-batches (tuples) of batch_size items, the last one possibly
+#   smaller.
+def batched(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = tuple(islice(items, batch_size))
+        if not batch:
+            break
+        yield batch
+
+# Mini-batches of items of similar size (by key), formed by sorting pools of
+#   pool_batches mini-batches, with the mini-batches of each pool yielded in
+#   random order. Similar sizes make for fewer levels (and wider steps) when
+#   evaluating the mini-batch as a single net, see Model.loss_and_gradient.
+def bucketed(items, batch_size, key, pool_batches=32):
+    for pool in batched(items, batch_size * pool_batches):
+        batches = list(batched(sorted(pool, key=key), batch_size))
+        shuffle(batches)
+        yield from batches
+
+_END = object()
+# How often (in seconds) a producer blocked on a full queue checks whether it
+#   should stop.
+_POLL = 0.1
+
+# Put the entry on the queue unless stopped first, returns whether it was put.
+def _put(queue, entry, stop):
+    while not stop.is_set():
+        try:
+            queue.put(entry, timeout=_POLL)
+            return True
+        except Full:
+            pass
+    return False
+
+def _produce(items, queue, stop):
+    try:
+        for item in items:
+            if not _put(queue, (item, None, ), stop):
+                return
+    except BaseException as exception:
+        _put(queue, (None, exception, ), stop)
+    else:
+        _put(queue, (_END, None, ), stop)
+
+# Evaluate the items in a background thread, at most size items ahead of the
+#   consumer. Any exception raised while producing an item is re-raised. The
+#   producer stops (dropping the items) once the consumer does, that is when
+#   the generator is closed or collected.
+#
+# Note: Only the parts of the work that release the GIL (NumPy, I/O) overlap
+#   with the consumer. Nets can not be sent to other processes, since the
+#   vertex classes are created dynamically.
+def prefetched(items, size=1):
+    queue = Queue(maxsize=size)
+    stop = Event()
+    producer = Thread(target=_produce, args=(iter(items), queue, stop, ))
+    # Note: Do not keep the interpreter alive for an abandoned stream.
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item, exception = queue.get()
+            if exception is not None:
+                raise exception
+            if item is _END:
+                break
+            yield item
+    finally:
+        stop.set()
+
+def _num_vertices(net):
+    return len(net.vertices)
+
+# Mini-batches of nets constructed (by build) from a stream of items, such as
+#   sentences. Items are shuffled within a buffer of buffer_size (if any)
+#   before the nets are constructed, and mini-batches are bucketed by the
+#   number of vertices if bucket is set. The next prefetch mini-batches are
+#   prepared in the background.
+def mini_batches(items, build, batch_size, buffer_size=None, bucket=False,
+        pool_batches=32, prefetch=1):
+    if buffer_size is not None:
+        items = shuffled(items, buffer_size)
+    nets = (build(item) for item in items)
+    if bucket:
+        batches = bucketed(nets, batch_size, _num_vertices,
+                pool_batches=pool_batches)
+    else:
+        batches = batched(nets, batch_size)
+    if prefetch:
+        batches = prefetched(batches, size=prefetch)
+    return batches
@@ -4,105 +4,182 @@
 Finite difference and finite difference checks.
 
 Author:     Pontus Stenetorp    <pontus stenetorp se>
-Version:    2013-10-28
+Version:    2014-05-12
 '''
 
-from copy import deepcopy
+from collections import OrderedDict
 from functools import partial
-from math import fsum
+from multiprocessing import get_context
 from sys import stderr
 
+from numpy import abs as numpy_abs
 from numpy import allclose as numpy_allclose
-from numpy import vstack
-from scipy.optimize import approx_fprime
-
-from .maths import EPSILON
-from .net import Loss
+from numpy import arange
+from numpy import array_split
+from numpy import concatenate
+from numpy import empty
+from numpy import finfo
+from numpy import isin
+from numpy import maximum
+from numpy import zeros
+from numpy.random import choice
 
 # Ideally we would have the tolerance depend on the errors we can expect from
 #   the finite difference calculations, but there are of course also numerical
 #   errors involved since we have plenty of floating point calculations taking
 #   place within the net.
-allclose = partial(numpy_allclose, atol=1e-6)
-
-def fdiff(m, f):
-    return approx_fprime(m, f, EPSILON)
-
-def loss_given_m(model, nets, model_key, bias=False):
-    def f(m):
-        _model = deepcopy(model)
-        if not bias:
-            w_dic = _model.weight
+ATOL = 1e-6
+allclose = partial(numpy_allclose, atol=ATOL)
+
+# State of each worker process, inherited when forked (see pool).
+_worker = {}
+
+# The (start, stop) of the weights and biases of each vertex class with
+#   parameters within the (flat) parameters of a model, see Model._init_keys.
+def _regions(model):
+    offset = 0
+    for v_class in (c for c in model.vertice_classes if c.size()):
+        w_size = v_class.weights_size()
+        b_size = v_class.biases_size()
+        yield (v_class, False, offset, offset + w_size, )
+        yield (v_class, True, offset + w_size, offset + w_size + b_size, )
+        offset += w_size + b_size
+
+def _loss(model, nets, batched):
+    return model.loss(nets, normalise=False, batched=batched).total()
+
+# Central differences of the loss of the nets for the given (flat) parameter
+#   coordinates, perturbing one parameter at a time in-place and restoring it
+#   afterwards. The parameters of the model must be writable.
+def fdiff(model, nets, coordinates, epsilon=None, batched=False):
+    flat = model.params.reshape(-1)
+    if epsilon is None:
+        # Note: Balances the truncation error of central differences against
+        #   the rounding error of the loss.
+        epsilon = finfo(flat.dtype).eps ** (1 / 3)
+
+    derivatives = empty(len(coordinates))
+    for j, i in enumerate(coordinates.tolist()):
+        value = flat[i]
+        try:
+            flat[i] = value + epsilon
+            upper = _loss(model, nets, batched)
+            flat[i] = value - epsilon
+            lower = _loss(model, nets, batched)
+        finally:
+            flat[i] = value
+        derivatives[j] = (upper - lower) / (2 * epsilon)
+    return derivatives
+
+def _init_worker(model, nets, epsilon, batched):
+    # Note: A copy, in case the parameters are in shared memory (see
+    #   Model.share_memory) or read-only.
+    model.params = model.params.copy()
+    model._init_keys(init=False)
+    _worker['fdiff'] = partial(fdiff, model, nets, epsilon=epsilon,
+            batched=batched)
+
+def _fdiff(coordinates):
+    return _worker['fdiff'](coordinates)
+
+# The analytical and numerical gradient of the (unnormalised) loss of the nets
+#   for each vertex class, for its weights and biases, as a mapping from
+#   (vertex class, bias) to the coordinates checked and the two gradients at
+#   those coordinates.
+#
+# With samples set, at most that many coordinates are drawn at random for the
+#   weights and biases of each class, only from the rows used by the nets for
+#   sparse weights (the other rows of which have no gradient). With processes
+#   set, the probes are spread over that many forked processes, each with its
+#   own copy of the parameters.
+#
+# Note: Use models with double precision parameters, finite differences are
+#   far too imprecise for single precision ones.
+def fdiff_gradient(model, nets, samples=None, processes=None, epsilon=None,
+        batched=False, check_bias=True):
+    _, gradient = model.loss_and_gradient(nets,
+            gradient=model.gradient(sparse=True), normalise=False,
+            batched=batched)
+    g_flat = gradient.params.reshape(-1)
+
+    # The coordinates to check and which of them to probe, the loss does not
+    #   depend on the rows of sparse weights that are not used by the nets.
+    checks = OrderedDict()
+    for v_class, bias, start, stop in _regions(model):
+        if bias and not check_bias:
+            continue
+        if not bias and v_class.sparse:
+            rows = gradient._touched_rows(v_class.name)
+            size = v_class.fan_out
+            used = (start + rows.reshape(-1, 1) * size + arange(size)).ravel()
+            coordinates = used if samples is not None else arange(start, stop)
         else:
-            w_dic = _model.bias
-        w = w_dic[model_key]
-
-        if isinstance(w, dict):
-            offset = 0
-            for _w in w.values():
-                _w[:] = m[offset:offset + _w.size].reshape(_w.shape)
-                offset += _w.size
-        if isinstance(w, tuple):
-            offset = 0
-            for _w in w:
-                _w[:] = m[offset:offset + _w.size].reshape(_w.shape)
-                offset += _w.size
+            used = None
+            coordinates = arange(start, stop)
+        if samples is not None and samples < coordinates.size:
+            coordinates = choice(coordinates, size=samples, replace=False)
+            coordinates.sort()
+        probed = (coordinates if used is None
+                else coordinates[isin(coordinates, used)])
+        checks[(v_class, bias, )] = (coordinates, probed, )
+
+    probes = (concatenate(tuple(p for _, p in checks.values())) if checks
+            else arange(0))
+    if processes is None or processes <= 1 or probes.size < 2:
+        derivatives = fdiff(model, nets, probes, epsilon=epsilon,
+                batched=batched)
+    else:
+        # Note: Relies on fork() to hand the model and nets to the workers.
+        with get_context('fork').Pool(processes, initializer=_init_worker,
+                initargs=(model, nets, epsilon, batched, )) as pool:
+            derivatives = concatenate(pool.map(_fdiff,
+                array_split(probes, processes)))
+
+    offset = 0
+    for key, (coordinates, probed) in checks.items():
+        stop = offset + probed.size
+        if probed is coordinates:
+            numerical = derivatives[offset:stop]
         else:
-            w[:] = m.reshape(w.shape)
-
-        loss = Loss()
-        for net in nets:
-            net.forward(_model, loss=loss)
-        return loss.total()
-    return f
-
+            numerical = zeros(coordinates.size)
+            numerical[coordinates.searchsorted(probed)] = derivatives[
+                    offset:stop]
+        checks[key] = (coordinates, g_flat[coordinates], numerical, )
+        offset = stop
+    return checks
+
+# The largest relative error between an analytical and a numerical gradient,
+#   where gradients smaller than the absolute tolerance count as that.
+def max_relative_error(analytical, numerical):
+    if not analytical.size:
+        return 0.0
+    return float((numpy_abs(analytical - numerical) / maximum(
+        maximum(numpy_abs(analytical), numpy_abs(numerical)), ATOL)).max())
+
+# Returns the largest relative error for each (vertex class name, bias) and
+#   warns about the gradients that do not match, see fdiff_gradient.
 # TODO: Throw an exception instead?
-def fdiff_check(model, net, check_bias=True, verbose=False):
-    loss = Loss()
-    net.forward(model, loss=loss)
-    gradient = model.gradient()
-    net.backward(model, gradient=gradient)
-
-    loss_f_gen = partial(loss_given_m, model, (net, ))
-
-    for vertice_class in model.vertice_classes:
-        for bias in (False, ) if not check_bias else (False, True, ):
-            key = vertice_class.name
-            if not bias:
-                m_dic = model.weight
-                g_dic = gradient.weight
-            else:
-                m_dic = model.bias
-                g_dic = gradient.bias
-
-            c = m_dic[key]
-            if isinstance(c, dict):
-                m = vstack(c.values())
-                g = vstack(g_dic[key].values())
-            elif isinstance(c, tuple):
-                from numpy import hstack
-                m = hstack(e.flatten() for e in c)
-                g = hstack(e.flatten() for e in g_dic[key])
-            else:
-                # "Standard".
-                m = c
-                g = g_dic[key]
-
-            _n = fdiff(m.flatten(),
-                    loss_f_gen(key, bias=bias))
-            n = _n.reshape(g.shape)
-
-            mismatch = not allclose(g, n)
-            if verbose:
-                print(vertice_class.__name__, '' if not bias else 'bias',
-                        file=stderr)
-            if mismatch:
-                print(('WARNING: Mismatch detected for the {} '
-                    '{}gradient.').format(vertice_class.__name__,
-                        '' if not bias else 'bias '), file=stderr)
-            if mismatch or verbose:
-                print('\tAnalytical:', '\t'.join(str(e)
-                    for e in g.flatten()), file=stderr)
-                print('\t Numerical:', '\t'.join(str(e)
-                    for e in n.flatten()), file=stderr)
-                print(file=stderr)
+def fdiff_check(model, net, check_bias=True, verbose=False, samples=None,
+        processes=None):
+    errors = OrderedDict()
+    for (v_class, bias), (_, g, n) in fdiff_gradient(model, (net, ),
+            samples=samples, processes=processes,
+            check_bias=check_bias).items():
+        error = max_relative_error(g, n)
+        errors[(v_class.name, bias, )] = error
+
+        mismatch = not allclose(g, n)
+        if verbose:
+            print(v_class.__name__, '' if not bias else 'bias',
+                    'max relative error:', error, file=stderr)
+        if mismatch:
+            print(('WARNING: Mismatch detected for the {} '
+                '{}gradient.').format(v_class.__name__,
+                    '' if not bias else 'bias '), file=stderr)
+        if mismatch or verbose:
+            print('\tAnalytical:', '\t'.join(str(e)
+                for e in g.flatten()), file=stderr)
+            print('\t Numerical:', '\t'.join(str(e)
+                for e in n.flatten()), file=stderr)
+            print(file=stderr)
+    return errors
@@ -19,9 +19,39 @@ from numpy import negative
 from numpy import power
 from numpy import sqrt
 from numpy import tanh
+from numpy import zeros
+from scipy.linalg.blas import dgemm
+from scipy.linalg.blas import dger
+from scipy.linalg.blas import sgemm
+from scipy.linalg.blas import sger
 
 EPSILON = sqrt(finfo(float).eps)
 
+# BLAS routines (ger, gemm) by the type code of the parameters.
+_BLAS = {
+        'd': (dger, dgemm, ),
+        'f': (sger, sgemm, ),
+        }
+
+# Accumulate the outer products of the rows of back and input_ into the weight
+#   gradient, in-place.
+def outer_acc(w_gradient, back, input_):
+    ger, gemm = _BLAS[w_gradient.dtype.char]
+    # Note: The transpose of a C-contiguous weight gradient is Fortran
+    #   contiguous, so BLAS will write to it directly.
+    if back.shape[0] == 1:
+        ger(1.0, input_[0], back[0], a=w_gradient.T, overwrite_a=True)
+    else:
+        gemm(1.0, input_.T, back.T, beta=1.0, c=w_gradient.T, trans_b=True,
+                overwrite_c=True)
+
+# Accumulate the sum of the rows of back into the bias gradient, in-place.
+def bias_acc(b_gradient, back):
+    if back.shape[0] == 1:
+        b_gradient += back.T
+    else:
+        b_gradient += back.sum(axis=0).reshape(-1, 1)
+
 def py_softmax(x, out=None):
     if out is None:
         out = array(x, copy=True)
@@ -40,12 +70,26 @@ except ImportError:
         raise NotImplementedError
     softmax = py_softmax
 
+# Softmax over each row of a matrix, the rows being separate distributions.
+def softmax_rows(x, out=None):
+    if x.shape[0] == 1:
+        return softmax(x, out=out)
+
+    if out is None:
+        out = array(x, copy=True)
+    else:
+        copyto(out, x)
+    out -= out.max(axis=1).reshape(-1, 1)
+    exp(out, out=out)
+    out /= out.sum(axis=1).reshape(-1, 1)
+    return out
+
 # TODO: Could consider a Cythonised version, but it shouldn't really help.
 tanh = tanh
 
 def py_tanh_prime(x, out=None):
     if out is None:
-        out = empty(x.shape)
+        out = empty(x.shape, dtype=x.dtype)
     out[:] = 1 - x ** 2
     return out
 
@@ -56,3 +100,117 @@ except ImportError:
     def cy_tanh_prime(x, out=None):
         raise NotImplementedError
     tanh_prime = py_tanh_prime
+
+# The first rows * columns elements of scratch as a matrix, for intermediate
+#   results, or a new matrix if no scratch buffer is given.
+def _scratch(scratch, rows, columns, dtype):
+    if scratch is None:
+        return empty((rows, columns), dtype=dtype)
+    if scratch.size < rows * columns:
+        raise ValueError('scratch too small: {} < {}'.format(scratch.size,
+            rows * columns))
+    return scratch[:rows * columns].reshape(rows, columns)
+
+# Forward pass of a composition (RNN) layer for a batch of inputs (rows),
+#   tanh(input_ weight^T + bias^T).
+def py_rnn_forward(weight, bias, input_, out=None):
+    out = dot(input_, weight.T, out=out)
+    out += bias.T
+    tanh(out, out=out)
+    return out
+
+# Backward pass of a composition layer for a batch, accumulating the weight
+#   and bias gradients in-place and returning the messages to the inputs.
+#   The error is computed in scratch if given, a flat contiguous buffer of at
+#   least as many elements as the activations, rather than a new array.
+def py_rnn_backward(weight, input_, activations, incoming, w_gradient,
+        b_gradient, out=None, scratch=None):
+    back = tanh_prime(activations, out=_scratch(scratch, *activations.shape,
+        dtype=activations.dtype))
+    back *= incoming
+    outer_acc(w_gradient, back, input_)
+    bias_acc(b_gradient, back)
+    return dot(back, weight, out=out)
+
+try:
+    from .cy_maths import rnn_forward as cy_rnn_forward
+    from .cy_maths import rnn_backward as cy_rnn_backward
+    rnn_forward = cy_rnn_forward
+    rnn_backward = cy_rnn_backward
+except ImportError:
+    def cy_rnn_forward(weight, bias, input_, out=None):
+        raise NotImplementedError
+    def cy_rnn_backward(weight, input_, activations, incoming, w_gradient,
+            b_gradient, out=None, scratch=None):
+        raise NotImplementedError
+    rnn_forward = py_rnn_forward
+    rnn_backward = py_rnn_backward
+
+# Raise a ValueError unless there is a label for each row, all of them (if
+#   any) less than the number of classes.
+def _check_labels(labels, rows, fan_out):
+    if labels.size != rows:
+        raise ValueError('label count mismatch: {} != {}'.format(
+            labels.size, rows))
+    if rows and (int(labels[0]) if rows == 1 else labels.max()) >= fan_out:
+        raise ValueError('label out of range: {}'.format(labels.max()))
+
+# Forward pass of a softmax layer for a batch of inputs (rows) and the cross
+#   entropy for the rows with a label (the index of the correct class, or -1
+#   for none), computed from the probability of the label alone.
+def py_softmax_xent(weight, bias, input_, labels, out=None):
+    _check_labels(labels, input_.shape[0], weight.shape[0])
+    out = dot(input_, weight.T, out=out)
+    out += bias.T
+    softmax_rows(out, out=out)
+    if labels.size == 1:
+        # Note: Avoid fancy indexing for a single row, the common case.
+        label = int(labels[0])
+        loss = -float(log(out[0, label])) if label >= 0 else 0.0
+    else:
+        rows = (labels >= 0).nonzero()[0]
+        loss = -float(log(out[rows, labels[rows]]).sum())
+    return (out, loss, )
+
+# Backward pass of a softmax layer with the cross entropy loss for a batch,
+#   accumulating the weight and bias gradients in-place and returning the
+#   messages to the inputs. Rows without a label send no error. The error is
+#   computed in scratch if given, as for py_rnn_backward.
+def py_softmax_xent_backward(weight, input_, activations, labels, w_gradient,
+        b_gradient, out=None, scratch=None):
+    _check_labels(labels, input_.shape[0], weight.shape[0])
+    if labels.size == 1:
+        label = int(labels[0])
+        if label < 0:
+            if out is None:
+                return zeros(input_.shape, dtype=input_.dtype)
+            out.fill(0)
+            return out
+        error = _scratch(scratch, *activations.shape,
+                dtype=activations.dtype)
+        copyto(error, activations)
+        error[0, label] -= 1
+    else:
+        error = _scratch(scratch, *activations.shape,
+                dtype=activations.dtype)
+        copyto(error, activations)
+        error[labels < 0] = 0
+        rows = (labels >= 0).nonzero()[0]
+        error[rows, labels[rows]] -= 1
+    outer_acc(w_gradient, error, input_)
+    bias_acc(b_gradient, error)
+    return dot(error, weight, out=out)
+
+try:
+    from .cy_maths import softmax_xent as cy_softmax_xent
+    from .cy_maths import softmax_xent_backward as cy_softmax_xent_backward
+    softmax_xent = cy_softmax_xent
+    softmax_xent_backward = cy_softmax_xent_backward
+except ImportError:
+    def cy_softmax_xent(weight, bias, input_, labels, out=None):
+        raise NotImplementedError
+    def cy_softmax_xent_backward(weight, input_, activations, labels,
+            w_gradient, b_gradient, out=None, scratch=None):
+        raise NotImplementedError
+    softmax_xent = py_softmax_xent
+    softmax_xent_backward = py_softmax_xent_backward
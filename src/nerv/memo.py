@@ -0,0 +1,142 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Memoisation of activations for inference, so that sub-DAGs occurring in many
+nets (such as frequent phrases in a treebank) are only evaluated once for a
+given model.
+
+Version:    2014-05-09
+'''
+
+from collections import OrderedDict
+from itertools import count
+
+from numpy import concatenate
+from numpy import empty
+
+
+# The structural key of a vertex: its class, its key (row) if any and the ids
+#   of the entries of its parents (in order), or None if the activations
+#   depend on anything else (static sources and their descendants).
+def _key(vertex, v_class, parents, ids):
+    if not parents and not hasattr(vertex, 'row'):
+        return None
+    p_ids = tuple(ids[parent] for parent in parents)
+    if None in p_ids:
+        return None
+    return (v_class, getattr(vertex, 'row', None), p_ids, )
+
+
+# Forward evaluation of nets that re-uses the activations of identical
+#   sub-DAGs, keeping the activations of the (at most) size most recently used
+#   ones. The cache belongs to a single model and is emptied whenever the
+#   version of the model changes, see Model.version.
+#
+# Vertices with a target are always evaluated, so that the loss accounts for
+#   them, as are sources since their activations are merely looked up. All
+#   other vertex classes must be batchable (see Vertex.forward_batch).
+#
+# Note: Each entry has an id of its own, never re-used, which stands for its
+#   sub-DAG in the keys of its children. Sub-DAGs are thus only identified by
+#   their structure, and the keys stay small however deep the sub-DAG. The
+#   entries of children outliving that of a parent are merely never hit again.
+class ActivationCache(object):
+    def __init__(self, model, size=65536):
+        self.model = model
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._version = model.version
+        # The (id, activations) of each sub-DAG by its structural key.
+        self._entries = OrderedDict()
+        self._ids = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    # Evaluate the net, returning the activations (read-only row vectors) of
+    #   each vertex; the vertices themselves are left untouched. The loss (if
+    #   given) is accumulated as by Net.forward.
+    def forward(self, net, loss=None):
+        model = self.model
+        if model.version != self._version:
+            self.clear()
+            self._version = model.version
+        entries = self._entries
+        dtype = model.params.dtype
+
+        activations = {}
+        ids = {}
+        for level in net.schedule():
+            for v_class, vertices in level:
+                pending = []
+                keys = []
+                for vertex in vertices:
+                    parents = net.parents[vertex]
+                    key = _key(vertex, v_class, parents, ids)
+                    if key is None:
+                        ids[vertex] = None
+                        pending.append(vertex)
+                        keys.append(None)
+                        continue
+                    evaluate = (not parents or
+                            getattr(vertex, 'target', None) is not None)
+                    try:
+                        ids[vertex], row = entries[key]
+                        entries.move_to_end(key)
+                    except KeyError:
+                        ids[vertex] = next(self._ids)
+                        pending.append(vertex)
+                        keys.append(key)
+                        if not evaluate:
+                            self.misses += 1
+                        continue
+                    if evaluate:
+                        pending.append(vertex)
+                        keys.append(None)
+                    else:
+                        activations[vertex] = row
+                        self.hits += 1
+
+                if not pending:
+                    continue
+                if not v_class.fan_in:
+                    for vertex, key in zip(pending, keys):
+                        activations[vertex] = vertex.activations.ravel()
+                        if key is not None:
+                            self._add(key, ids[vertex], activations[vertex])
+                    continue
+                if not v_class.batchable:
+                    raise ValueError(('{} can not be evaluated without vertex '
+                        'state').format(v_class.__name__))
+
+                in_size = sum(parent.fan_out
+                        for parent in net.parents[pending[0]])
+                input_ = empty((len(pending), in_size), dtype=dtype)
+                for vertex, row in zip(pending, input_):
+                    parents = net.parents[vertex]
+                    if parents:
+                        concatenate([activations[parent]
+                            for parent in parents], out=row)
+                out = v_class.forward_batch(v_class.batch(pending), input_,
+                        model, loss=loss)
+
+                for vertex, key, row in zip(pending, keys, out):
+                    if key is None:
+                        activations[vertex] = row
+                        continue
+                    row = row.copy()
+                    row.flags.writeable = False
+                    activations[vertex] = row
+                    self._add(key, ids[vertex], row)
+
+        return activations
+
+    def _add(self, key, id_, row):
+        entries = self._entries
+        entries[key] = (id_, row, )
+        if len(entries) > self.size:
+            entries.popitem(last=False)
@@ -8,41 +8,153 @@ Version:    2014-02-06
 '''
 
 # TODO: Each class should probably be responsible for its own weight init.
-# TODO: __slots__ for the vertices.
 # TODO: Have we in a way re-invented the factory pattern? Ugh...
 
+from collections import OrderedDict
 from collections import defaultdict
-from copy import deepcopy
+from copy import copy
+from itertools import chain
+from json import dumps as json_dumps
+from json import loads as json_loads
+from math import ceil
 from math import fsum
+from math import sqrt
+from numbers import Integral
 
+from numpy import add
+from numpy import arange
+from numpy import array
 from numpy import dot
 from numpy import mean
 from numpy import empty
-from numpy import multiply
+from numpy import float32
+from numpy import float64
+from numpy import int32
+from numpy import intp
+from numpy import log
+from numpy import memmap
 from numpy import product
 from numpy import subtract
 from numpy import transpose
+from numpy import unique
+from numpy import where
 from numpy import zeros
-from scipy.linalg.blas import dger
 
 from .init import init_layer
 from .init import socher_2013_comp_mtrx
 from .loss import cross_entropy
+from .maths import bias_acc
+from .maths import outer_acc
+from .maths import rnn_backward
+from .maths import rnn_forward
 from .maths import softmax
+from .maths import softmax_rows
+from .maths import softmax_xent
+from .maths import softmax_xent_backward
 from .maths import tanh
 from .maths import tanh_prime
+from .optimise import SparseGradient
+from .optimise import shared_zeros
 from .dag import DAG
+from .dag import FrozenDAG
+from .plan import Plan
+from .vocab import Vocabulary
+
+
+# Magic string of saved models, followed by the length of the (JSON) header.
+_MAGIC = b'NERVMDL1'
+# Alignment of the parameters in saved models, a page to allow for sharing.
+_ALIGNMENT = 4096
 
 
 # TODO: We might want to split this into separate classes.
 #   Some have a special init, fan_in, etc.
 class Vertex(object):
+    # Vertices are numerous, so avoid a dictionary for each of them. Vertex
+    #   classes declare the slots of any further attributes.
+    __slots__ = ('_input', '_activations', '_message', '_at', )
+
+    # Set by vertex classes that implement forward_batch and backward_batch,
+    #   all other vertex classes are evaluated one vertex at a time.
+    batchable = False
+    # Set by vertex classes with a weight gradient that is sparse, a table
+    #   with a row of fan_out weights per key of which only a few are used.
+    sparse = False
+
+    def __init__(self):
+        self._at = None
+        self._input = self._activations = self._message = None
+
+    # The input, activations and message of a vertex evaluated by a plan are
+    #   rows of the buffers of an arena, set by each pass as the buffers (input,
+    #   activations, messages) and the row of the vertex (see Plan.forward).
+    #   The column vector views are only created once asked for.
+    def _view(self, i):
+        if self._at is None:
+            return None
+        buffers, row = self._at
+        return buffers[i][row].reshape(-1, 1)
+
+    @property
+    def input(self):
+        if self._input is None:
+            self._input = self._view(0)
+        return self._input
+
+    @input.setter
+    def input(self, input_):
+        self._input = input_
+
+    @property
+    def activations(self):
+        if self._activations is None:
+            self._activations = self._view(1)
+        return self._activations
+
+    @activations.setter
+    def activations(self, activations):
+        self._activations = activations
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = self._view(2)
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    # Evaluate a single vertex, only for classes that are not batchable since
+    #   plans evaluate all others with forward_batch and backward_batch.
     def forward(self, net, model, loss=None):
         raise NotImplementedError
 
     def backward(self, net, model, gradient):
         raise NotImplementedError
 
+    # Batched versions of forward and backward for several vertices of the
+    #   same class, with one row per vertex for the inputs, activations,
+    #   incoming messages and outgoing messages. Return the activations and
+    #   the message (if any) respectively, written to out if given. The
+    #   backward pass may use scratch (if given) for intermediate results, a
+    #   flat buffer of at least as many elements as the activations.
+    @classmethod
+    def forward_batch(cls, vertices, input_, model, loss=None, out=None):
+        raise NotImplementedError
+
+    @classmethod
+    def backward_batch(cls, vertices, input_, activations, incoming, model,
+            gradient, out=None, scratch=None):
+        raise NotImplementedError
+
+    # The vertices of a batch as handed to forward_batch and backward_batch
+    #   by a plan, which keeps it for every pass. A vertex class may return a
+    #   tuple sub-class with anything it can precompute for the batch.
+    @classmethod
+    def batch(cls, vertices):
+        return tuple(vertices)
+
     @classmethod
     def init(cls, weights):
         weights[:] = init_layer(weights.shape, weights.shape[0],
@@ -78,10 +190,12 @@ class Vertex(object):
 
 def static_source_vertex(fan_out_):
     class StaticSourceVertex(Vertex):
+        __slots__ = ()
         fan_out = fan_out_
         fan_in = 0
 
         def __init__(self, activations):
+            super().__init__()
             self.activations = activations
 
         def forward(self, net, model, loss=None):
@@ -97,14 +211,29 @@ def static_source_vertex(fan_out_):
     return StaticSourceVertex
 
 
-# I have a nasty feeling that this use-case may be covered by the built-in...
-class FallbackDict(dict):
-    def __init__(self, fallback):
-        super().__init__()
-        self.fallback = fallback
+# A batch of keyed source vertices, with the rows of their keys and whether
+#   the rows are unique.
+class _KeyedBatch(tuple):
+    pass
 
-    def __missing__(self, key):
-        return self[self.fallback]
+
+# A batch of classification vertices, with the labels of the vertices as of
+#   the last forward pass of the batch (see SoftMaxVertex.labels).
+class _LabelledBatch(tuple):
+    pass
+
+# Read-only label arrays for a single vertex, by label (None for none).
+_LABEL_ROWS = {}
+_NO_ROWS = array((), dtype=intp)
+
+def _label_row(label):
+    try:
+        return _LABEL_ROWS[label]
+    except KeyError:
+        row = array((-1 if label is None else label, ), dtype=int32)
+        row.flags.writeable = False
+        _LABEL_ROWS[label] = row
+        return row
 
 
 # XXX: HAS A BIAS TERM! BAAAD! WASTE!
@@ -112,28 +241,37 @@ class FallbackDict(dict):
 def keyed_source_vertex(dims, dic, missing_='<unk>', name_='keyed'):
     source_size = len(dic) * dims
 
-    # Create a mapping between key and weight array region.
+    # Create a mapping between key and row of the weight array.
     assert missing_ in dic, "%s not present in dictionary" % missing_
-    _slice_by_key = FallbackDict(missing_)
-    for i, key in enumerate(dic):
-        start = i * dims
-        _slice_by_key[key] = slice(start, start + dims)
+    _vocabulary = Vocabulary(dic, missing_)
 
 
     class KeyedSourceVertex(Vertex):
+        __slots__ = ('key', 'row', )
         name = name_
         fan_out = dims
         fan_in = 1
+        batchable = True
+        sparse = True
 
-        def __init__(self, key):
+        # Note: The row of the key is looked up once, see also many.
+        def __init__(self, key, row=None):
             super().__init__()
             self.key = key
+            self.row = self.vocabulary[key] if row is None else row
+
+        # Vertices for a sequence of keys, with a single vocabulary lookup.
+        @classmethod
+        def many(cls, keys):
+            keys = list(keys)
+            return [cls(key, row) for key, row in zip(keys,
+                cls.vocabulary.lookup(keys).tolist())]
 
         @classmethod
         def init(cls, weights):
-            weights[:] = 0
+            table = weights.reshape(-1, dims)
             for key in dic:
-                weights[cls.slice_by_key[key]] = dic[key]
+                table[cls.vocabulary[key]] = dic[key].ravel()
             return weights
 
         @classmethod
@@ -144,20 +282,42 @@ def keyed_source_vertex(dims, dic, missing_='<unk>', name_='keyed'):
         def biases_shape(cls):
             return (0, 0, )
 
-        slice_by_key = _slice_by_key
+        vocabulary = _vocabulary
 
-        def forward(self, net, model, loss=None):
-            self.activations = model.weight[name_][self.slice_by_key[self.key]]
+        @classmethod
+        def rows(cls, vertices):
+            try:
+                return vertices.rows
+            except AttributeError:
+                return [vertex.row for vertex in vertices]
 
-        def backward(self, net, model, gradient):
-            _gradient = gradient.weight[name_][self.slice_by_key[self.key]]
-            for child in net.children[self]:
-                offset = 0
-                for other_parent in net.parents[child]:
-                    if other_parent is self:
-                        break
-                    offset += other_parent.activations.size
-                _gradient += child.message[offset:offset + _gradient.size]
+        @classmethod
+        def batch(cls, vertices):
+            batch = _KeyedBatch(vertices)
+            batch.rows = array(cls.rows(vertices), dtype=intp)
+            batch.unique = unique(batch.rows).size == batch.rows.size
+            return batch
+
+        # Gather the rows of all vertices with a single take.
+        @classmethod
+        def forward_batch(cls, vertices, input_, model, loss=None, out=None):
+            return model.weight[name_].reshape(-1, dims).take(
+                    cls.rows(vertices), axis=0, out=out)
+
+        @classmethod
+        def backward_batch(cls, vertices, input_, activations, incoming,
+                model, gradient, out=None, scratch=None):
+            table = gradient.weight[name_].reshape(-1, dims)
+            rows = cls.rows(vertices)
+            if len(vertices) == 1:
+                table[rows[0]] += incoming[0]
+            elif getattr(vertices, 'unique', False):
+                table[rows] += incoming
+            else:
+                # Note: The same key may occur more than once in a batch.
+                add.at(table, rows, incoming)
+            if gradient.touched is not None:
+                gradient.touched[name_].append(rows)
 
 
     # XXX: Enormous hack, will fail if more than one kind is created...
@@ -169,47 +329,116 @@ def keyed_source_vertex(dims, dic, missing_='<unk>', name_='keyed'):
 
 def softmax_vertex(fan_out_, fan_in_, name_='softmax'):
     class SoftMaxVertex(Vertex):
+        __slots__ = ('target', )
         name = name_
         fan_out = fan_out_
         fan_in = fan_in_
+        batchable = True
 
+        # The target is either a label (the index of the correct class) or a
+        #   distribution over the classes as a column vector, for soft
+        #   targets.
         def __init__(self, target=None):
             super().__init__()
+            if isinstance(target, Integral):
+                target = int(target)
+                if not 0 <= target < fan_out_:
+                    raise ValueError('label out of range: {}'.format(target))
             self.target = target
 
-        def forward(self, net, model, loss=None):
-            parents = net.parents[self]
-            size_sum = sum(parent.activations.size for parent in parents)
+        # Vertices for a sequence (or an int array) of labels, -1 for none.
+        @classmethod
+        def many(cls, labels):
+            return [cls(label if label >= 0 else None) for label in labels]
+
+        # The target as a distribution (column vector), if any.
+        def dense_target(self):
+            if not isinstance(self.target, int):
+                return self.target
+            target = zeros((fan_out_, 1))
+            target[self.target] = 1
+            return target
+
+        @classmethod
+        def batch(cls, vertices):
+            return _LabelledBatch(vertices)
+
+        # The labels and soft target positions of a batch, as of the targets
+        #   of the vertices at the time.
+        @classmethod
+        def labels(cls, vertices):
+            if len(vertices) == 1:
+                target = vertices[0].target
+                if target is None or isinstance(target, int):
+                    return (_label_row(target), _NO_ROWS, )
+
+            labels = [-1] * len(vertices)
+            dense = []
+            for i, vertex in enumerate(vertices):
+                target = vertex.target
+                if isinstance(target, int):
+                    labels[i] = target
+                elif target is not None:
+                    dense.append(i)
+            labels = array(labels, dtype=int32)
+
+            soft = []
+            if dense:
+                targets = array([vertices[i].target.ravel() for i in dense])
+                # The dense targets that are one-hot have a label, the rest
+                #   are soft targets.
+                one_hot = (((targets == 1).sum(axis=1) == 1)
+                        & ((targets == 0).sum(axis=1) == fan_out_ - 1))
+                labels[dense] = where(one_hot, targets.argmax(axis=1), -1)
+                soft = [i for i, hot in zip(dense, one_hot.tolist())
+                        if not hot]
+            soft = array(soft, dtype=intp)
+            return (labels, soft, )
+
+        # The one-hot targets are handled by a fused kernel, the soft targets
+        #   (if any) separately.
+        @classmethod
+        def forward_batch(cls, vertices, input_, model, loss=None, out=None):
+            size_sum = input_.shape[1]
             assert fan_in_ == size_sum, "fan in mismatch: %d != %d" % (fan_in_, size_sum)
-            offset = 0
-            input_ = empty((fan_in_, 1))
-            for parent in parents:
-                size = parent.activations.size
-                input_[offset:offset + size] = parent.activations
-                offset += size
+            labels, soft = cls.labels(vertices)
+            if isinstance(vertices, _LabelledBatch):
+                # Note: Kept for the backward pass of this pass only, the
+                #   targets may change before the next.
+                vertices.labels = (labels, soft, )
 
-            activations = dot(model.weight[name_], input_)
-            activations += model.bias[name_]
-            softmax(activations, out=activations)
+            activations, xent = softmax_xent(model.weight[name_],
+                    model.bias[name_], input_, labels, out=out)
 
-            if loss is not None and self.target is not None:
-                loss[name_] += cross_entropy(activations, self.target)
+            if loss is not None:
+                loss[name_] += xent
+                for i in soft.tolist():
+                    loss[name_] += cross_entropy(
+                            activations[i].reshape(-1, 1), vertices[i].target)
 
-            self.input = input_
-            self.activations = activations
+            return activations
 
-        def backward(self, net, model, gradient):
-            if self.target is None:
-                self.message[:] = 0
-                return
+        @classmethod
+        def backward_batch(cls, vertices, input_, activations, incoming,
+                model, gradient, out=None, scratch=None):
+            labels, soft = (vertices.labels
+                    if isinstance(vertices, _LabelledBatch)
+                    else cls.labels(vertices))
 
-            error = self.activations - self.target
-            w_gradient = multiply(error, self.input.T)
+            # Vertices without a target contribute neither gradient nor
+            #   message.
+            message = softmax_xent_backward(model.weight[name_], input_,
+                    activations, labels, gradient.weight[name_],
+                    gradient.bias[name_], out=out, scratch=scratch)
 
-            gradient.weight[name_] += w_gradient
-            gradient.bias[name_] += error
+            if soft.size:
+                error = (activations[soft] - array([vertices[i].target.ravel()
+                    for i in soft.tolist()])).astype(activations.dtype)
+                outer_acc(gradient.weight[name_], error, input_[soft])
+                bias_acc(gradient.bias[name_], error)
+                message[soft] = dot(error, model.weight[name_])
 
-            self.message = dot(model.weight[name_].T, error)
+            return message
 
 
     # XXX: Enormous hack, will fail if more than one kind is created...
@@ -223,10 +452,12 @@ def rnn_vertex(dim, num_inputs_, name_='rnn'):
     fan_in_ = dim * num_inputs_
 
     class RNNVertex(Vertex):
+        __slots__ = ()
         name = name_
         fan_out = fan_out_
         fan_in = fan_in_
         num_inputs = num_inputs_
+        batchable = True
 
         @classmethod
         def init(cls, weights):
@@ -234,55 +465,184 @@ def rnn_vertex(dim, num_inputs_, name_='rnn'):
             weights[:] = socher_2013_comp_mtrx(cls.fan_out, cls.num_inputs)
             return weights
 
-        def forward(self, net, model, loss=None):
-            parents = net.parents[self]
-            size_sum = sum(parent.activations.size for parent in parents)
+        @classmethod
+        def forward_batch(cls, vertices, input_, model, loss=None, out=None):
+            size_sum = input_.shape[1]
             assert fan_in_ == size_sum, "fan in mismatch: %d != %d" % (fan_in_, size_sum)
-            input_ = empty((fan_in_, 1))
-            offset = 0
-            for parent in parents:
-                size = parent.activations.size
-                input_[offset:offset + size] = parent.activations
-                offset += size
 
-            # Calculate the activations.
-            activations = dot(model.weight[name_], input_)
-            activations += model.bias[name_]
-            tanh(activations, out=activations)
+            return rnn_forward(model.weight[name_], model.bias[name_],
+                    input_, out=out)
 
-            self.input = input_
-            self.activations = activations
+        @classmethod
+        def backward_batch(cls, vertices, input_, activations, incoming,
+                model, gradient, out=None, scratch=None):
+            return rnn_backward(model.weight[name_], input_, activations,
+                    incoming, gradient.weight[name_], gradient.bias[name_],
+                    out=out, scratch=scratch)
 
-        def backward(self, net, model, gradient):
-            children = net.children[self]
-            if not children:
-                self.message[:] = 0
-                return
 
-            # Collect the incoming message from all children.
-            incoming_message = zeros((fan_out_, 1))
-            for child in children:
-                offset = 0
-                for other_parent in net.parents[child]:
-                    if other_parent is self:
-                        break
-                    offset += other_parent.fan_out
-                incoming_message += child.message[offset:
-                        offset + incoming_message.size]
+    # XXX: Enormous hack, will fail if more than one kind is created...
+    globals()[RNNVertex.__name__] = RNNVertex
 
-            # Calculate the gradients.
-            back = tanh_prime(self.activations) * incoming_message
-            dger(1.0, self.input.T, back.T, a=gradient.weight[name_].T,
-                    overwrite_a=True)
-            gradient.bias[name_] += back
+    return RNNVertex
 
-            self.message = dot(transpose(model.weight[name_]), back)
+# Class-factored (two-level) softmax over num_labels labels, split into about
+#   sqrt(num_labels) classes of consecutive labels. The probability of a label
+#   is that of its class times that of the label within its class, so for a
+#   labelled vertex only the scores of the classes and of the labels of a
+#   single class are computed, rather than those of all labels.
+#
+# The activations are the class probabilities followed by the probabilities
+#   of the labels within one class: that of the label if any, otherwise the
+#   most probable class (see predict). Targets must be labels.
+def factored_softmax_vertex(num_labels_, fan_in_, name_='factored'):
+    class_size = int(ceil(num_labels_ / int(ceil(sqrt(num_labels_)))))
+    num_classes_ = int(ceil(num_labels_ / class_size))
+    fan_out_ = num_classes_ + class_size
+
+    # The first row (of the weights) and number of labels of a class.
+    def _block(c):
+        return (num_classes_ + c * class_size,
+                min(class_size, num_labels_ - c * class_size), )
+
+    class FactoredSoftMaxVertex(Vertex):
+        __slots__ = ('target', )
+        name = name_
+        fan_out = fan_out_
+        fan_in = fan_in_
+        num_labels = num_labels_
+        num_classes = num_classes_
+        batchable = True
+
+        def __init__(self, target=None):
+            super().__init__()
+            if target is not None:
+                if not isinstance(target, Integral):
+                    raise TypeError('targets must be labels')
+                target = int(target)
+                if not 0 <= target < num_labels_:
+                    raise ValueError('label out of range: {}'.format(target))
+            self.target = target
+
+        # Vertices for a sequence (or an int array) of labels, -1 for none.
+        @classmethod
+        def many(cls, labels):
+            return [cls(label if label >= 0 else None) for label in labels]
+
+        # Scores for each class, followed by those for each label.
+        @classmethod
+        def weights_shape(cls):
+            return (num_classes_ + num_labels_, fan_in_, )
+
+        @classmethod
+        def biases_shape(cls):
+            return (num_classes_ + num_labels_, 1, )
+
+        # The label predicted from the activations of a vertex without a
+        #   target, the most probable label of the most probable class.
+        @classmethod
+        def predict(cls, activations):
+            activations = activations.ravel()
+            c = int(activations[:num_classes_].argmax())
+            _, size = _block(c)
+            return c * class_size + int(activations[
+                num_classes_:num_classes_ + size].argmax())
+
+        @classmethod
+        def batch(cls, vertices):
+            return _LabelledBatch(vertices)
+
+        # The labels of a batch (-1 for none), as of the targets of the
+        #   vertices at the time, see SoftMaxVertex.labels.
+        @classmethod
+        def labels(cls, vertices):
+            if len(vertices) == 1:
+                return _label_row(vertices[0].target)
+            return array([-1 if vertex.target is None else vertex.target
+                for vertex in vertices], dtype=int32)
+
+        @classmethod
+        def forward_batch(cls, vertices, input_, model, loss=None, out=None):
+            size_sum = input_.shape[1]
+            assert fan_in_ == size_sum, "fan in mismatch: %d != %d" % (fan_in_, size_sum)
+            weight = model.weight[name_]
+            bias = model.bias[name_]
+            if out is None:
+                out = empty((input_.shape[0], fan_out_), dtype=input_.dtype)
+
+            scores = dot(input_, weight[:num_classes_].T)
+            scores += bias[:num_classes_].T
+            out[:, :num_classes_] = softmax_rows(scores, out=scores)
+
+            labels = cls.labels(vertices)
+            if isinstance(vertices, _LabelledBatch):
+                # Note: Kept for the backward pass of this pass only.
+                vertices.labels = labels
+
+            xent = 0.0
+            for row, label in enumerate(labels.tolist()):
+                classes = out[row, :num_classes_]
+                c = (label // class_size if label >= 0
+                        else int(classes.argmax()))
+                lo, size = _block(c)
+                scores = dot(weight[lo:lo + size], input_[row])
+                scores += bias[lo:lo + size, 0]
+                within = out[row, num_classes_:]
+                within[:size] = softmax(scores, out=scores)
+                within[size:] = 0
+                if label >= 0:
+                    xent -= float(log(classes[c]
+                        * within[label - c * class_size]))
+
+            if loss is not None:
+                loss[name_] += xent
+
+            return out
+
+        # Only the class scores and those of the class of the label of each
+        #   vertex receive a gradient.
+        @classmethod
+        def backward_batch(cls, vertices, input_, activations, incoming,
+                model, gradient, out=None, scratch=None):
+            weight = model.weight[name_]
+            w_gradient = gradient.weight[name_]
+            b_gradient = gradient.bias[name_]
+            if out is None:
+                out = empty(input_.shape, dtype=input_.dtype)
+            out.fill(0)
+
+            labels = (vertices.labels if isinstance(vertices, _LabelledBatch)
+                    else cls.labels(vertices))
+            rows = (labels >= 0).nonzero()[0]
+            if not rows.size:
+                return out
+            labels = labels[rows]
+            input_ = input_[rows]
+
+            error = activations[rows, :num_classes_]
+            error[arange(rows.size), labels // class_size] -= 1
+            outer_acc(w_gradient[:num_classes_], error, input_)
+            bias_acc(b_gradient[:num_classes_], error)
+            out[rows] = dot(error, weight[:num_classes_])
+
+            for i, (row, label) in enumerate(zip(rows.tolist(),
+                    labels.tolist())):
+                c = label // class_size
+                lo, size = _block(c)
+                error = activations[row:row + 1,
+                        num_classes_:num_classes_ + size].copy()
+                error[0, label - c * class_size] -= 1
+                outer_acc(w_gradient[lo:lo + size], error, input_[i:i + 1])
+                bias_acc(b_gradient[lo:lo + size], error)
+                out[row] += dot(error[0], weight[lo:lo + size])
+
+            return out
 
 
     # XXX: Enormous hack, will fail if more than one kind is created...
-    globals()[RNNVertex.__name__] = RNNVertex
+    globals()[FactoredSoftMaxVertex.__name__] = FactoredSoftMaxVertex
 
-    return RNNVertex
+    return FactoredSoftMaxVertex
 
 # TODO: Could be handed activation function, etc.?
 def average_vertex(dim, name_='average'):
@@ -290,6 +650,7 @@ def average_vertex(dim, name_='average'):
     fan_in_ = dim
 
     class AverageVertex(Vertex):
+        __slots__ = ()
         name = name_
         fan_out = fan_out_
         fan_in = fan_in_
@@ -306,7 +667,7 @@ def average_vertex(dim, name_='average'):
             # for i, parent in enumerate(parents):
             #     input_[:, i] = parent.activations.squeeze()
             size_sum = sum(parent.activations.size for parent in parents)
-            input_ = empty((size_sum, 1))
+            input_ = empty((size_sum, 1), dtype=model.params.dtype)
             offset = 0
             for parent in parents:
                 size = parent.activations.size
@@ -329,15 +690,16 @@ def average_vertex(dim, name_='average'):
                 return
 
             # Collect the incoming message from all children.
-            incoming_message = zeros((fan_out_, 1))
+            incoming_message = zeros((fan_out_, 1), dtype=model.params.dtype)
             for child in children:
                 incoming_message += child.message
 
             # Calculate the gradients.
             back = tanh_prime(self.activations) * incoming_message
             # gradient.weight[name_] = back.T * self.input + gradient.weight[name_]
-            dger(1.0, self.input.T, back.T, a=gradient.weight[name_].T,
-                 overwrite_a=True)
+            # Note: The BLAS routine must match the dtype of the gradient, or
+            #   it would accumulate into a copy.
+            outer_acc(gradient.weight[name_], back.T, self.input.T)
             gradient.bias[name_] += back
 
             self.message = dot(transpose(model.weight[name_]), back)
@@ -349,7 +711,11 @@ def average_vertex(dim, name_='average'):
     return AverageVertex
 
 
-def net_model(_vertice_classes):
+# The dtype (float64 or float32) is used for the parameters, gradients and
+#   activations alike.
+def net_model(_vertice_classes, dtype=float64):
+    assert dtype in (float64, float32), 'unsupported dtype: {}'.format(dtype)
+
     # TODO: Impl. __getstate__ and __setstate__ to side-step "init-keys" ref.
     class Model(object):
         vertice_classes = _vertice_classes
@@ -357,16 +723,32 @@ def net_model(_vertice_classes):
         def __init__(self):
             # Use a single slice of contiguous memory for the parameters
             #   (weights and biases).
-            self.params = empty((sum(c.size() for c in _vertice_classes), 1, ))
+            self.params = empty((sum(c.size() for c in _vertice_classes), 1, ),
+                    dtype=dtype)
 
             # Assign a view for the parameters of each of the classes.
             self.weight = {}
             self.bias = {}
+            # Rows used in the sparse weights (see Vertex.sparse) for each key,
+            #   only tracked for gradients requested as sparse.
+            self.touched = None
+            # Gradient re-used by loss_and_gradient, allocated on first use.
+            self._gradient = None
+            # To be incremented whenever the parameters are changed in place
+            #   (for example after each optimiser step), anything computed
+            #   from an earlier version is stale. See memo.ActivationCache.
+            self.version = 0
 
             self._init_keys()
 
-        def _init_keys(self):
+        # Unless init is set, only assign the views without initialising the
+        #   parameters.
+        def _init_keys(self, init=True):
             params = self.params
+            # The (start, stop) of the dense regions of the parameters, and
+            #   the (start, stop, row size) of the sparse ones for each key.
+            self._dense_regions = []
+            self._sparse_regions = OrderedDict()
             offset = 0
             for v_class in (c for c in _vertice_classes if c.size()):
                 key = v_class.name
@@ -374,35 +756,141 @@ def net_model(_vertice_classes):
                 # Assign a portion of the parameters to the weights.
                 w_size = v_class.weights_size()
                 w_slice = params[offset:offset + w_size]
-                self.weight[key] = v_class.init(w_slice)
+                if init:
+                    self.weight[key] = v_class.init(w_slice)
+                else:
+                    self.weight[key] = w_slice.reshape(
+                            v_class.weights_shape())
+                if v_class.sparse:
+                    self._sparse_regions[key] = (offset, offset + w_size,
+                            v_class.fan_out, )
+                else:
+                    self._add_dense_region(offset, offset + w_size)
                 offset += w_size
 
                 # Assign a portion of the parameters to the biases.
                 b_size = v_class.biases_size()
                 biases = params[offset:offset + b_size].reshape(
                         v_class.biases_shape())
-                biases[:] = 0
+                if init:
+                    biases[:] = 0
                 self.bias[key] = biases
+                self._add_dense_region(offset, offset + b_size)
                 offset += b_size
 
+        def _add_dense_region(self, start, stop):
+            regions = self._dense_regions
+            if start == stop:
+                return
+            if regions and regions[-1][1] == start:
+                regions[-1] = (regions[-1][0], stop, )
+            else:
+                regions.append((start, stop, ))
+
+        # The unique rows used in the sparse weights of key.
+        def _touched_rows(self, key):
+            rows = unique(array(list(chain.from_iterable(self.touched[key])),
+                dtype=int))
+            self.touched[key] = [rows]
+            return rows
+
+        # Move the parameters into memory shared with any processes forked
+        #   after this call, updates by any process are seen by all of them.
+        def share_memory(self):
+            shared = shared_zeros(self.params.shape, dtype=self.params.dtype)
+            shared[:] = self.params
+            self.params = shared
+            self._init_keys(init=False)
+            return self
+
+        # For a sparse gradient, only the used rows of the sparse weights are
+        #   cleared (and normalised).
         def clear(self):
-            self.params[:] = 0
+            if self.touched is None:
+                self.params[:] = 0
+                return
+
+            flat = self.params.reshape(-1)
+            for start, stop in self._dense_regions:
+                flat[start:stop] = 0
+            for key, (start, stop, size) in self._sparse_regions.items():
+                flat[start:stop].reshape(-1, size)[self._touched_rows(key)] = 0
+                self.touched[key] = []
+
+        def normalise(self, n):
+            if self.touched is None:
+                self.params /= n
+                return
+
+            flat = self.params.reshape(-1)
+            for start, stop in self._dense_regions:
+                flat[start:stop] /= n
+            for key, (start, stop, size) in self._sparse_regions.items():
+                flat[start:stop].reshape(-1, size)[self._touched_rows(key)] /= n
 
         # XXX: Name is a bit confusing...
-        def gradient(self):
-            gradient = deepcopy(self)
-            # Note: After the copy the weight/bias views will be invalid,
-            #   re-initialise them.
-            gradient._init_keys()
-            gradient.clear()
+        # With sparse set, the gradient tracks the rows used in the sparse
+        #   weights so that it can be handed to the optimisers as a
+        #   SparseGradient (see Model.sparse).
+        def gradient(self, sparse=False):
+            # Note: Only the layout is shared with the model, there is no need
+            #   to copy (or initialise) the parameters.
+            gradient = type(self).__new__(type(self))
+            gradient.params = zeros(self.params.shape, dtype=self.params.dtype)
+            gradient.weight = {}
+            gradient.bias = {}
+            gradient.touched = None
+            gradient._gradient = None
+            gradient.version = 0
+            gradient._init_keys(init=False)
+            if sparse:
+                gradient.touched = OrderedDict((key, [])
+                        for key in gradient._sparse_regions)
+            return gradient
+
+        def _reused_gradient(self):
+            gradient = getattr(self, '_gradient', None)
+            if gradient is None or gradient.params.shape != self.params.shape:
+                gradient = self.gradient()
+                self._gradient = gradient
+            else:
+                gradient.clear()
             return gradient
 
-        def loss(self, nets, loss=None, normalise=True):
+        # The gradient as a SparseGradient, with only the used rows of the
+        #   sparse weights and views of the remaining parameters.
+        def sparse(self):
+            if self.touched is None:
+                raise ValueError('not a sparse gradient')
+
+            flat = self.params.reshape(-1)
+            dense = tuple((start, flat[start:stop])
+                    for start, stop in self._dense_regions)
+            sparse = []
+            for key, (start, stop, size) in self._sparse_regions.items():
+                rows = self._touched_rows(key)
+                sparse.append((start, stop, rows, flat[start:stop].reshape(
+                    -1, size).take(rows, axis=0), ))
+            return SparseGradient(self.params.shape, dense, sparse)
+
+        def loss(self, nets, loss=None, normalise=True, batched=False,
+                dedup=False, cache=True):
             if loss is None:
                 loss = Loss()
 
-            for net in nets:
-                net.forward(self, loss)
+            if dedup:
+                evaluated = (Net.merge(nets), )
+                evaluated[0].forward(self, loss=loss, batched=batched)
+            elif batched:
+                evaluated = (Plan.union(nets), ) + tuple(nets)
+                evaluated[0].forward(None, self, loss=loss, batched=True)
+            else:
+                evaluated = nets
+                for net in nets:
+                    net.forward(self, loss=loss)
+            if not cache:
+                for net in evaluated:
+                    net.release()
 
             if normalise:
                 loss.normalise(len(nets))
@@ -410,63 +898,163 @@ def net_model(_vertice_classes):
             return loss
 
         # XXX: Re-consider the set-up.
+        # With reuse set (and no gradient given), the same gradient is cleared
+        #   and returned by every call, it is only valid until the next call.
+        # With dedup set, the nets are evaluated as a single net where the
+        #   sub-DAGs shared by the nets are only evaluated once, see
+        #   Net.merge.
+        # Without cache set, the plans of the nets are released once
+        #   evaluated (see Net.release), for nets that are not evaluated
+        #   again.
         def loss_and_gradient(self, nets, loss=None, gradient=None,
-                no_loss=False, normalise=True):
+                no_loss=False, normalise=True, batched=False, pool=None,
+                reuse=False, dedup=False, cache=True):
+            if pool is not None:
+                # Spread the nets over the processes of a GradientPool.
+                return pool.loss_and_gradient(nets, loss=loss,
+                        gradient=gradient, no_loss=no_loss,
+                        normalise=normalise, batched=batched, reuse=reuse,
+                        dedup=dedup, cache=cache)
+
             # TODO: Use the loss method?
             if loss is None and not no_loss:
                 loss = Loss()
             if gradient is None:
-                gradient = self.gradient()
-
-            for net in nets:
-                net.forward(self, loss=loss)
-                net.backward(self, gradient=gradient)
+                gradient = self._reused_gradient() if reuse else self.gradient()
+
+            if dedup:
+                net = Net.merge(nets)
+                net.forward(self, loss=loss, batched=batched)
+                net.backward(self, gradient=gradient, batched=batched)
+                evaluated = (net, )
+            elif batched:
+                # Evaluate all nets at once, with a single product for each
+                #   class of vertices at each depth across all nets.
+                plan = Plan.union(nets)
+                plan.forward(None, self, loss=loss, batched=True)
+                plan.backward(None, self, gradient, batched=True)
+                evaluated = (plan, ) + tuple(nets)
+            else:
+                evaluated = nets
+                for net in nets:
+                    net.forward(self, loss=loss)
+                    net.backward(self, gradient=gradient)
+            if not cache:
+                for net in evaluated:
+                    net.release()
 
             if normalise:
                 if loss is not None:
                     loss.normalise(len(nets))
-                gradient.params /= len(nets)
+                gradient.normalise(len(nets))
 
             return (loss, gradient, )
 
-        # XXX: Yet another hideous hack... This to share the vocabulary slice
-        #   mapping.
+        # The layout of the parameters, for each class with parameters its
+        #   name and the shapes of its weights and biases.
+        @classmethod
+        def layout(cls):
+            return [[c.name, list(c.weights_shape()), list(c.biases_shape())]
+                    for c in _vertice_classes if c.size()]
+
+        # The fingerprint of the vocabulary of each class with one, by name.
+        @classmethod
+        def vocabularies(cls):
+            return {c.name: c.vocabulary.fingerprint()
+                    for c in _vertice_classes if hasattr(c, 'vocabulary')}
+
+        # Save the parameters as a raw (aligned) array preceded by a header
+        #   describing the layout, see Model.load. Unlike pickling, the
+        #   vocabularies are not saved since they belong to the classes, only
+        #   their fingerprints so that they can be checked on loading.
+        def save(self, path):
+            header = json_dumps({
+                'dtype': self.params.dtype.str,
+                'shape': list(self.params.shape),
+                'layout': self.layout(),
+                'vocabularies': self.vocabularies(),
+                }).encode('utf-8')
+            offset = len(_MAGIC) + 8 + len(header)
+            offset += -offset % _ALIGNMENT
+
+            with open(path, 'wb') as out:
+                out.write(_MAGIC)
+                out.write(len(header).to_bytes(8, 'little'))
+                out.write(header)
+                out.write(b'\0' * (offset - out.tell()))
+                # Note: Written as is, without a copy of the parameters.
+                out.write(memoryview(self.params).cast('B'))
+
+        # Load the parameters saved by Model.save by mapping them into memory
+        #   (mode as for numpy.memmap), read-only by default so that the pages
+        #   are shared by all processes loading the same file.
+        @classmethod
+        def load(cls, path, mode='r'):
+            with open(path, 'rb') as inp:
+                if inp.read(len(_MAGIC)) != _MAGIC:
+                    raise ValueError('not a saved model: {}'.format(path))
+                size = int.from_bytes(inp.read(8), 'little')
+                header = json_loads(inp.read(size).decode('utf-8'))
+            offset = len(_MAGIC) + 8 + size
+            offset += -offset % _ALIGNMENT
+
+            if header['layout'] != cls.layout():
+                raise ValueError('layout mismatch for saved model: {}'.format(
+                    path))
+            # Note: The rows of the embeddings are only meaningful for the
+            #   vocabularies they were trained with.
+            if header.get('vocabularies') != cls.vocabularies():
+                raise ValueError(('vocabulary mismatch for saved model: '
+                    '{}').format(path))
+
+            model = cls.__new__(cls)
+            model.params = memmap(path, dtype=header['dtype'], mode=mode,
+                    offset=offset, shape=tuple(header['shape']))
+            model.weight = {}
+            model.bias = {}
+            model.touched = None
+            model._gradient = None
+            model.version = 0
+            model._init_keys(init=False)
+            return model
+
+        # XXX: Yet another hideous hack... This to share the vocabulary.
         def __getstate__(self):
             dic = self.__dict__.copy()
+            dic['_gradient'] = None
             vc_dic = {}
 
             for vc in self.vertice_classes:
                 try:
-                    vc_dic[vc] = vc.slice_by_key
+                    vc_dic[vc] = vc.vocabulary
                 except AttributeError:
                     pass
 
             dic['vc_dic'] = vc_dic
             return dic
 
-        # XXX: Yet another hideous hack... This to share the vocabulary slice
-        #   mapping.
+        # XXX: Yet another hideous hack... This to share the vocabulary.
         def __setstate__(self, state):
             vc_dic = state['vc_dic']
             del state['vc_dic']
 
             for vc in self.vertice_classes:
                 try:
-                    vc.slice_by_key
+                    vc.vocabulary
                 except AttributeError:
                     pass
                 else:
-                    vc.slice_by_key = vc_dic[vc]
+                    vc.vocabulary = vc_dic[vc]
 
             self.__dict__ = state
 
         # TODO: Default to single or multiple nets?
-        def forward(self, net, loss=None):
-            net.forward(self, loss=loss)
+        def forward(self, net, loss=None, batched=False, context=None):
+            net.forward(self, loss=loss, batched=batched, context=context)
 
         # TODO: Default to single or multiple nets?
-        def backward(self, net, gradient=None):
-            return net.backward(self, gradient=gradient)
+        def backward(self, net, gradient=None, batched=False):
+            return net.backward(self, gradient=gradient, batched=batched)
 
 
     # XXX: Enormous hack, will fail if more than one kind is created...
@@ -475,21 +1063,208 @@ def net_model(_vertice_classes):
     return Model
 
 
-class Net(DAG):
-    def forward(self, model, loss=None):
-        for node in self.topological_sort():
-            node.forward(self, model, loss=loss)
-
-    def backward(self, model, gradient=None):
+# Group the vertices of a level by their class, in order of appearance.
+def _by_class(vertices):
+    groups = OrderedDict()
+    for vertex in vertices:
+        try:
+            groups[type(vertex)].append(vertex)
+        except KeyError:
+            groups[type(vertex)] = [vertex]
+    return groups.items()
+
+
+# Evaluation of nets, shared by mutable and frozen nets. Expects the _schedule
+#   and _plan caches to be set.
+class _Evaluation(object):
+    # The batched execution schedule, for each level of the net the vertices
+    #   grouped by their class.
+    def schedule(self, reverse=False):
+        if self._schedule is not None:
+            schedule = self._schedule
+        else:
+            schedule = tuple(tuple((v_class, tuple(vertices))
+                for v_class, vertices in _by_class(level))
+                for level in self.levels())
+            self._schedule = schedule
+
+        return schedule if not reverse else reversed(schedule)
+
+    # The compiled execution plan, re-used until the next edge is added (if
+    #   any) or the net is released.
+    def plan(self):
+        if self._plan is None:
+            self._plan = Plan(self)
+        return self._plan
+
+    # Drop the cached schedule and plan, along with the buffers the vertices
+    #   were evaluated in (their activations and messages go with them). For
+    #   nets that are evaluated only once or rarely, such as those streamed
+    #   from a corpus, see also Model.loss_and_gradient.
+    def release(self):
+        if self._plan is not None:
+            self._plan.release()
+        self._schedule = None
+        self._plan = None
+
+    # A new context to evaluate the net in, see Net.forward, the dtype must
+    #   match that of the model.
+    def context(self, dtype=float64):
+        return self.plan().context(dtype=dtype)
+
+    # With batched set, all vertices of the same class and level are evaluated
+    #   with a single matrix-matrix product. Given a context, the activations
+    #   are only written to the context (indexed by vertex) and not the
+    #   vertices, which allows for concurrent inference but no backward pass.
+    def forward(self, model, loss=None, batched=False, context=None):
+        self.plan().forward(self, model, loss=loss, batched=batched,
+                context=context)
+        return context
+
+    def backward(self, model, gradient=None, batched=False):
         if gradient is None:
             gradient = model.gradient()
 
-        for node in self.topological_sort(reverse=True):
-            node.backward(self, model, gradient)
+        self.plan().backward(self, model, gradient, batched=batched)
 
         return gradient
 
 
+class Net(_Evaluation, DAG):
+    def __init__(self):
+        super().__init__()
+        # Cache(s).
+        self._schedule = None
+        self._plan = None
+        # The vertices added since the plan was compiled, see add_edge.
+        self._pending = {}
+
+    def _invalidate(self):
+        super()._invalidate()
+        self._schedule = None
+        self._plan = None
+        self._pending = {}
+
+    # Edges to vertices new to the plan (if any) extend the plan rather than
+    #   invalidate it, as when a net is built bottom-up and evaluated after
+    #   each addition (see Plan.extend). Any other edge invalidates it.
+    def add_edge(self, parent, child):
+        plan = self._plan
+        pending = self._pending
+        super().add_edge(parent, child)
+        if plan is not None and child not in plan.position:
+            self._plan = plan
+            self._pending = pending
+            for vertex in (parent, child):
+                if vertex not in plan.position:
+                    pending[vertex] = None
+
+    def add_vertex(self, vertex):
+        plan = self._plan
+        pending = self._pending
+        super().add_vertex(vertex)
+        if plan is not None:
+            self._plan = plan
+            self._pending = pending
+            if vertex not in plan.position:
+                pending[vertex] = None
+
+    def plan(self):
+        if self._plan is None:
+            self._pending = {}
+        elif self._pending:
+            # Note: Compile anew rather than extend by more than the plan.
+            if len(self._pending) > len(self._plan.vertices):
+                self._plan = None
+            else:
+                self._plan.extend(self, self._pending)
+            self._pending = {}
+        return super().plan()
+
+    # Combine the nets into a single net where identical sub-DAGs (of the
+    #   same classes, keys and structure) are replaced by a single copy,
+    #   which is evaluated once and receives the messages of all of its
+    #   children. Vertices with a target are never merged, since each
+    #   contributes to the loss, and neither are vertices that would become
+    #   the same parent twice for a child. The merged vertices are those
+    #   first seen, so the others are left untouched by any evaluation.
+    #
+    # A vertex may occur more than once, as when the same net is drawn twice
+    #   for a mini-batch. Each further occurrence that can not be merged
+    #   (such as one with a target) is evaluated as a shallow copy of the
+    #   vertex, so that its loss and messages count as many times as it
+    #   occurs.
+    @classmethod
+    def merge(cls, nets):
+        merged = cls()
+        # The vertex standing in for each vertex, and the vertices standing in
+        #   for each (class, key, parents).
+        canonical = {}
+        shared = {}
+        parents_of = {}
+        for net in nets:
+            # The copies of the repeated vertices of this net.
+            copies = {}
+            for vertex in net.topological_sort():
+                parents = tuple(canonical[copies.get(p, p)]
+                        for p in net.parents[vertex])
+                if len(set(parents)) != len(parents):
+                    # Note: Keep the parents that are duplicated as copies of
+                    #   their own.
+                    seen = set()
+                    uncommon = []
+                    for parent, c_parent in zip((copies.get(p, p)
+                            for p in net.parents[vertex]), parents):
+                        if c_parent in seen:
+                            c_parent = parent
+                            for grandparent in parents_of[parent]:
+                                merged.add_edge(grandparent, parent)
+                        seen.add(c_parent)
+                        uncommon.append(c_parent)
+                    parents = tuple(uncommon)
+                target = getattr(vertex, 'target', None)
+                c_vertex = None
+                if target is None:
+                    key = (type(vertex), getattr(vertex, 'row', None),
+                            parents, )
+                    if not parents and key[1] is None:
+                        # Note: Static sources are only merged with
+                        #   themselves.
+                        key = vertex
+                    c_vertex = shared.get(key)
+                if c_vertex is None and vertex in canonical:
+                    # Note: A vertex that occurs again (with a target or
+                    #   other parents) is evaluated as a copy of its own.
+                    copies[vertex] = vertex = copy(vertex)
+                parents_of[vertex] = parents
+                if c_vertex is not None:
+                    canonical[vertex] = c_vertex
+                    continue
+
+                canonical[vertex] = vertex
+                if target is None:
+                    shared[key] = vertex
+                if parents:
+                    for parent in parents:
+                        merged.add_edge(parent, vertex)
+                else:
+                    merged.add_vertex(vertex)
+
+        return merged
+
+    def freeze(self):
+        return FrozenNet.from_dag(self)
+
+
+# A net that can be evaluated but not extended, see FrozenDAG.
+class FrozenNet(_Evaluation, FrozenDAG):
+    def __init__(self, vertices, parent_ptr, parent_idx):
+        super().__init__(vertices, parent_ptr, parent_idx)
+        # Cache(s).
+        self._schedule = None
+        self._plan = None
+
+
 class Loss(dict):
     def __missing__(self, key):
         return 0.0
@@ -10,18 +10,63 @@ Version:    2013-06-12
 
 # TODO: Clean-up!
 
+from functools import partial
 from itertools import repeat
-from multiprocessing import Array
-from multiprocessing import Value
-from multiprocessing import Process
+from multiprocessing import cpu_count
+from multiprocessing import get_context
+from weakref import WeakValueDictionary
 
 from numpy import absolute
+from numpy import dtype as np_dtype
 from numpy import empty
 from numpy import frombuffer
+from numpy import ndarray
 from numpy import nonzero
 from numpy import sqrt
 from numpy import zeros
 
+# A gradient that is non-zero only for some parts of the (flat) parameters,
+#   with dense parts as (start, values) and row-sparse parts as (start, stop,
+#   rows, values), where the parameters between start and stop form a table
+#   with one row for every row of values and the rows are unique.
+class SparseGradient(object):
+    def __init__(self, shape, dense=(), sparse=()):
+        self.shape = shape
+        self.dense = tuple(dense)
+        self.sparse = tuple(sparse)
+
+    def toarray(self):
+        out = zeros(self.shape)
+        flat = out.reshape(-1)
+        for start, values in self.dense:
+            flat[start:start + values.size] = values.reshape(-1)
+        for start, stop, rows, values in self.sparse:
+            flat[start:stop].reshape(-1, values.shape[1])[rows] = values
+        return out
+
+# Apply step(x0, gradient, *accumulators, **kwargs) to only the parts of x0
+#   and the accumulators (of the same shape as x0) covered by a sparse
+#   gradient. Rows of the sparse parts are gathered and then scattered back.
+#
+# Note: Parameters outside of the gradient are left as they are, which is
+#   exact for AdaGrad but lazy for RMSProp and momentum, where the
+#   accumulators of rows not in the gradient are not decayed.
+def _sparse_step(step, x0, gradient, *accumulators, **kwargs):
+    arrays = [a.reshape(-1) for a in (x0, ) + accumulators]
+    for start, values in gradient.dense:
+        views = [a[start:start + values.size] for a in arrays]
+        step(views[0], values.reshape(-1), *views[1:], **kwargs)
+    for start, stop, rows, values in gradient.sparse:
+        tables = [a[start:stop].reshape(-1, values.shape[1]) for a in arrays]
+        views = [table[rows] for table in tables]
+        step(views[0], values, *views[1:], **kwargs)
+        for table, view in zip(tables, views):
+            table[rows] = view
+
+# Note: Accumulators (for the optimisers that require them) are created with
+#   the given dtype if any, otherwise the dtype of x0. For example, float64
+#   accumulators for float32 parameters.
+
 # Convenience wrapper to support fprime as a joint/separate argument.
 def _f(func, fprime):
     if fprime is None:
@@ -31,13 +76,21 @@ def _f(func, fprime):
             return (func(x), fprime(x), )
         return f
 
+def _rmsprop_step(x0, grad, mean_square, learning_rate, decay_rate,
+        epsilon):
+    mean_square[:] = ((1 - decay_rate) * mean_square
+            + decay_rate * grad ** 2)
+    update = learning_rate * grad
+    update[:] /= sqrt(mean_square) + epsilon
+    x0[:] -= update
+
 # RMSProp from "Lecture 6.5 - rmsprop" by Tieleman and Hinton (2012), yes...
 #   that is the actual cite.
 #
 def fmin_rmsprop(func, x0, fprime=None, learning_rate=0.001, decay_rate=0.1,
-        mean_square=None, epsilon=10 ** -7):
+        mean_square=None, epsilon=10 ** -7, dtype=None):
     if mean_square is None:
-        mean_square = zeros(x0.shape)
+        mean_square = zeros(x0.shape, dtype=dtype or x0.dtype)
 
     f = _f(func, fprime)
 
@@ -48,14 +101,21 @@ def fmin_rmsprop(func, x0, fprime=None, learning_rate=0.001, decay_rate=0.1,
         if mean_square.shape != grad.shape:
             mean_square.resize(grad.shape, refcheck=False)
 
-        mean_square[:] = ((1 - decay_rate) * mean_square
-                + decay_rate * grad ** 2)
-        update = learning_rate * grad
-        update[:] /= sqrt(mean_square) + epsilon
-        x0[:] -= update
+        if isinstance(grad, SparseGradient):
+            _sparse_step(_rmsprop_step, x0, grad, mean_square,
+                    learning_rate=learning_rate, decay_rate=decay_rate,
+                    epsilon=epsilon)
+        else:
+            _rmsprop_step(x0, grad, mean_square, learning_rate, decay_rate,
+                    epsilon)
 
         yield (x0, loss, mean_square)
 
+def _adagrad_step(x0, gradient, sum_grad_square, learning_rate, epsilon):
+    sum_grad_square[:] += gradient ** 2
+    x0[:] -= (learning_rate * gradient  / (
+        sqrt(sum_grad_square) + epsilon))
+
 # AdaGrad, diagonal version, from "Adaptive Subgradient Methods for Online
 #   Learning and Stochastic Optimization" by Duchi et al. (2011).
 #
@@ -66,12 +126,12 @@ def fmin_rmsprop(func, x0, fprime=None, learning_rate=0.001, decay_rate=0.1,
 # TODO: Use an "iterate" flag to control behaviour?
 # TODO: Make sure we are in line with the paper (I think we are).
 def fmin_adagrad(func, x0, fprime=None, learning_rate=0.1,
-        sum_grad_square=None, epsilon=1e-3):
+        sum_grad_square=None, epsilon=1e-3, dtype=None):
 
     # TODO: We allow you to pass this on to resume a previous call.
     if sum_grad_square is None:
         # The sum of squared gradient components
-        sum_grad_square = zeros(x0.shape)
+        sum_grad_square = zeros(x0.shape, dtype=dtype or x0.dtype)
 
     f = _f(func, fprime)
 
@@ -82,30 +142,43 @@ def fmin_adagrad(func, x0, fprime=None, learning_rate=0.1,
         if sum_grad_square.shape != gradient.shape:
             sum_grad_square.resize(gradient.shape, refcheck=False)
 
-        sum_grad_square[:] += gradient ** 2
-        x0[:] -= (learning_rate * gradient  / (
-            sqrt(sum_grad_square) + epsilon))
+        if isinstance(gradient, SparseGradient):
+            _sparse_step(_adagrad_step, x0, gradient, sum_grad_square,
+                    learning_rate=learning_rate, epsilon=epsilon)
+        else:
+            _adagrad_step(x0, gradient, sum_grad_square, learning_rate,
+                    epsilon)
 
         yield x0, loss, sum_grad_square
 
+def _sgd_step(x0, gradient, momentum, learning_rate, momentum_coeff):
+    momentum[:] = momentum * momentum_coeff - gradient * learning_rate
+    x0[:] += momentum
+
 # Stochastic gradient descent with momentum (Polyak, 1964).
-def fmin_sgd(func, x0, fprime=None, learning_rate=0.01, momentum_coeff=0.5):
-    momentum = zeros(x0.shape)
+def fmin_sgd(func, x0, fprime=None, learning_rate=0.01, momentum_coeff=0.5,
+        dtype=None):
+    momentum = zeros(x0.shape, dtype=dtype or x0.dtype)
 
     f = _f(func, fprime)
 
     while True:
         loss, gradient = f(x0)
-        momentum[:] = momentum * momentum_coeff - gradient * learning_rate
-        x0[:] += momentum
+        if isinstance(gradient, SparseGradient):
+            _sparse_step(_sgd_step, x0, gradient, momentum,
+                    learning_rate=learning_rate,
+                    momentum_coeff=momentum_coeff)
+        else:
+            _sgd_step(x0, gradient, momentum, learning_rate, momentum_coeff)
         yield (x0, loss, )
 
 # Nestorov's Accelerated Gradient (Nestorov, 1983) in its momentum formulation
 #   by Sutskever et al. (2013).
 # Note: We do not implement the momentum coefficient schedule described
 #   by Sutskever et al. (2013).
-def fmin_nag(func, x0, fprime=None, learning_rate=0.01, momentum_coeff=0.5):
-    momentum = zeros(x0.shape)
+def fmin_nag(func, x0, fprime=None, learning_rate=0.01, momentum_coeff=0.5,
+        dtype=None):
+    momentum = zeros(x0.shape, dtype=dtype or x0.dtype)
 
     f = _f(func, fprime)
 
@@ -116,6 +189,87 @@ def fmin_nag(func, x0, fprime=None, learning_rate=0.01, momentum_coeff=0.5):
         x0[:] += momentum
         yield (x0, loss, )
 
+# The shared buffers allocated by shared_zeros, by their id.
+_SHARED = WeakValueDictionary()
+
+# An array of zeros in memory shared with any processes forked after the call.
+def shared_zeros(shape, dtype=float):
+    size = 1
+    for dim in shape:
+        size *= dim
+    # Note: Shared ctypes arrays are zero-initialised, the type codes of
+    #   ctypes and NumPy agree for float and double.
+    buf = get_context('fork').Array(np_dtype(dtype).char, size, lock=False)
+    _SHARED[id(buf)] = buf
+    return frombuffer(buf, dtype=dtype).reshape(shape)
+
+# Whether the array is (a view of) an array made by shared_zeros.
+def is_shared(a):
+    while isinstance(a, ndarray):
+        a = a.base
+    return a is not None and _SHARED.get(id(a)) is a
+
+def _hogwild_worker(func, x0, shard, batch_size, step, loss_sum):
+    for start in range(0, len(shard), batch_size):
+        loss, gradient = func(x0, shard[start:start + batch_size])
+        step(x0, gradient)
+        with loss_sum.get_lock():
+            loss_sum.value += loss
+
+# Hogwild! from "Hogwild!: A Lock-Free Approach to Parallelizing Stochastic
+#   Gradient Descent" by Niu et al. (2011), with AdaGrad or RMSProp updates.
+#
+# Each epoch, every process evaluates mini-batches from its own shard of the
+#   data and updates the parameters and accumulator without any locking. Both
+#   x0 and the accumulator must be in shared memory (see shared_zeros and
+#   Model.share_memory) and func(x0, batch) returns a (scalar) loss and the
+#   gradient for a mini-batch. The loss yielded is the mean over the
+#   mini-batches of an epoch.
+#
+# Note: Relies on fork() to hand func and the data to the processes, the
+#   updates by the processes are lost unless the arrays are shared.
+def fmin_hogwild(func, x0, data, processes=None, batch_size=1,
+        method='adagrad', learning_rate=0.1, accumulator=None, epsilon=1e-3,
+        decay_rate=0.1, dtype=None):
+    if processes is None:
+        processes = cpu_count()
+    if accumulator is None:
+        accumulator = shared_zeros(x0.shape, dtype=dtype or x0.dtype)
+    for name, a in (('x0', x0, ), ('accumulator', accumulator, ), ):
+        if not is_shared(a):
+            raise ValueError('{} not in shared memory'.format(name))
+
+    if method == 'adagrad':
+        step = partial(_adagrad_step, sum_grad_square=accumulator,
+                learning_rate=learning_rate, epsilon=epsilon)
+    elif method == 'rmsprop':
+        step = partial(_rmsprop_step, mean_square=accumulator,
+                learning_rate=learning_rate, decay_rate=decay_rate,
+                epsilon=epsilon)
+    else:
+        raise ValueError('unknown method: {}'.format(method))
+
+    shards = tuple(tuple(data[i::processes]) for i in range(processes))
+    return _hogwild_epochs(func, x0, shards, batch_size, step, accumulator)
+
+def _hogwild_epochs(func, x0, shards, batch_size, step, accumulator):
+    context = get_context('fork')
+    num_batches = sum(-(-len(shard) // batch_size) for shard in shards)
+
+    while True:
+        loss_sum = context.Value('d', 0.0)
+        workers = [context.Process(target=_hogwild_worker, args=(func, x0,
+            shard, batch_size, step, loss_sum)) for shard in shards if shard]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            if worker.exitcode:
+                raise RuntimeError('worker failed with exit code {}'.format(
+                    worker.exitcode))
+
+        yield (x0, loss_sum.value / num_batches, accumulator)
+
 # TODO: Move to sanity!
 if __name__ == '__main__':
     from numpy import array
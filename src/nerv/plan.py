@@ -0,0 +1,509 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Compiled execution plans for nets, flattening the structure of a net into
+integer indices and an arena of preallocated buffers that can be re-used for
+every pass.
+
+Version:    2014-04-30
+'''
+
+from collections import OrderedDict
+
+from numpy import add
+from numpy import arange
+from numpy import array
+from numpy import bincount
+from numpy import concatenate
+from numpy import cumsum
+from numpy import dtype as np_dtype
+from numpy import empty
+from numpy import float64
+from numpy import intp
+from numpy import repeat
+from numpy import zeros
+
+
+# Flat indices of the concatenated activations of the vertices at the given
+#   positions, in order.
+def _flat_idx(positions, act_lo):
+    positions = array(positions, dtype=intp)
+    lens = act_lo[positions + 1] - act_lo[positions]
+    return (repeat(act_lo[positions] - (cumsum(lens) - lens), lens)
+            + arange(lens.sum()))
+
+# Start of the range of flat indices if they are contiguous, otherwise None.
+def _contiguous(idx):
+    if idx.size == 0:
+        return 0
+    if idx[-1] - idx[0] + 1 == idx.size and (idx.size == 1
+            or (idx[1:] - idx[:-1] == 1).all()):
+        return int(idx[0])
+    return None
+
+# Lay out vertices in topological order level by level and class by class,
+#   which is a topological order where each group of vertices of the same
+#   class and depth is contiguous. Within a group, order the vertices by the
+#   positions of their parents so that the concatenated parent activations are
+#   more likely to be adjacent in the arena.
+#
+# The parents of the vertices are given by identifier, either the position of
+#   a vertex that is already laid out (less than base) or base plus the index
+#   of one of the vertices. Returns the vertices in order, with their parents
+#   (as positions) and groups (class, start, stop, depth).
+def _layout(vertices, parents, depth, base=0):
+    levels = OrderedDict()
+    for i in sorted(range(len(vertices)), key=depth.__getitem__):
+        try:
+            levels[depth[i]].append(i)
+        except KeyError:
+            levels[depth[i]] = [i]
+
+    order = []
+    position = [0] * len(vertices)
+    groups = []
+    for level, members in levels.items():
+        by_class = OrderedDict()
+        for i in members:
+            try:
+                by_class[type(vertices[i])].append(i)
+            except KeyError:
+                by_class[type(vertices[i])] = [i]
+        for v_class, group in by_class.items():
+            if len(group) > 1 and level:
+                group.sort(key=lambda i: [j if j < base
+                    else position[j - base] for j in parents[i]])
+            start = base + len(order)
+            for i in group:
+                position[i] = base + len(order)
+                order.append(i)
+            groups.append((v_class, start, base + len(order), level, ))
+
+    return ([vertices[i] for i in order], [[j if j < base
+        else position[j - base] for j in parents[i]] for i in order],
+        groups, )
+
+
+# Builds the steps of a plan one group of vertices at a time, allocating the
+#   gathered inputs and messages of each group.
+class _Steps(list):
+    def __init__(self, in_size=0, msg_size=0):
+        super().__init__()
+        self.in_size = in_size
+        self.msg_size = msg_size
+
+    # A group of vertices of a class that is not batchable, with the flat
+    #   indices of the parent activations of each vertex. The net is that of
+    #   the vertices, unless it is the net evaluated.
+    def single(self, v_class, start, stop, depth, act_lo, idx, net=None):
+        self.append((v_class, start, stop, depth, act_lo, None, None, None,
+            tuple(idx), net, ))
+
+    # A group of vertices of a batchable class, given the flat indices of the
+    #   concatenated parent activations of all of the vertices and whether
+    #   any of them repeat (if known). The input of a group is either a view
+    #   of the activations (if the parent activations are adjacent) or
+    #   gathered using the indices.
+    def batch(self, v_class, start, stop, depth, act_lo, idx, dups=None):
+        n = stop - start
+        in_size = idx.size // n
+        lo = _contiguous(idx)
+        if lo is None:
+            if dups is None:
+                dups = bool(bincount(idx).max() > 1)
+            lo = (self.in_size, idx.reshape(n, in_size), dups, )
+            self.in_size += idx.size
+        self.append((v_class, start, stop, depth, act_lo, in_size, lo,
+            self.msg_size, None, None, ))
+        self.msg_size += idx.size
+
+    # The groups laid out by _layout, with the parents of each vertex (by
+    #   position) and the offsets of the activations of all vertices.
+    def groups(self, groups, parents, act_lo):
+        for v_class, start, stop, depth in groups:
+            g_parents = parents[start:stop]
+            if not v_class.batchable:
+                self.single(v_class, start, stop, depth, int(act_lo[start]),
+                        (_flat_idx(v_parents, act_lo)
+                            for v_parents in g_parents))
+                continue
+
+            g_positions = array([j for v_parents in g_parents
+                for j in v_parents], dtype=intp)
+            g_idx = _flat_idx(g_positions, act_lo)
+            in_size = g_idx.size // (stop - start)
+            assert (bincount(repeat(arange(stop - start),
+                [len(v_parents) for v_parents in g_parents]),
+                weights=act_lo[g_positions + 1] - act_lo[g_positions],
+                minlength=stop - start) == in_size).all(), (
+                        'input size mismatch')
+            self.batch(v_class, start, stop, depth, int(act_lo[start]),
+                    g_idx)
+
+
+class Plan(object):
+    def __init__(self, net):
+        vertices, ptr, idx = net.csr()
+        ptr = ptr.tolist()
+        idx = idx.tolist()
+        parents = [idx[ptr[i]:ptr[i + 1]] for i in range(len(vertices))]
+        depth = []
+        for v_parents in parents:
+            depth.append(max([depth[j] for j in v_parents]) + 1
+                    if v_parents else 0)
+
+        vertices, parents, groups = _layout(vertices, parents, depth)
+        self.vertices = tuple(vertices)
+        # The depth of each vertex, for plans that are extended.
+        self.depth = sorted(depth)
+
+        # The activations of all vertices are laid out contiguously, in order.
+        self.act_lo = zeros(len(vertices) + 1, dtype=intp)
+        cumsum([vertex.fan_out for vertex in vertices], out=self.act_lo[1:])
+        self.act_size = int(self.act_lo[-1])
+
+        steps = _Steps()
+        steps.groups(groups, parents, self.act_lo)
+        self._init_steps(steps)
+
+    def _init_steps(self, steps):
+        self.steps = tuple(steps)
+        self.in_size = steps.in_size
+        self.msg_size = steps.msg_size
+        self._position = None
+        # Arenas by dtype, allocated on first use, with room to grow for plans
+        #   that have been extended.
+        self._arenas = {}
+        self._batches = {}
+        self._room = 1
+
+    # Extend the plan in-place for vertices added to the net, all of them new
+    #   to the plan and only the children of vertices of the plan or of each
+    #   other (see Net.add_edge). The new vertices are laid out after those
+    #   of the plan, and the arenas of the plan kept if they have room for
+    #   them.
+    def extend(self, net, vertices):
+        base = len(self.vertices)
+        position = self.position
+        vertices = [vertex for vertex in net.topological_sort()
+                if vertex in vertices]
+        index = {vertex: base + i for i, vertex in enumerate(vertices)}
+        parents = [[position[p] if p in position else index[p]
+            for p in net.parents[vertex]] for vertex in vertices]
+        depth = []
+        for v_parents in parents:
+            depth.append(max([self.depth[j] if j < base
+                else depth[j - base] for j in v_parents]) + 1
+                if v_parents else 0)
+
+        vertices, parents, groups = _layout(vertices, parents, depth, base)
+        self.vertices += tuple(vertices)
+        self.depth.extend(sorted(depth))
+        for i, vertex in enumerate(vertices):
+            position[vertex] = base + i
+
+        act_lo = empty(len(vertices), dtype=intp)
+        cumsum([vertex.fan_out for vertex in vertices], out=act_lo)
+        self.act_lo = concatenate((self.act_lo, act_lo + self.act_size))
+        self.act_size = int(self.act_lo[-1])
+
+        steps = _Steps(self.in_size, self.msg_size)
+        steps.groups(groups, [None] * base + parents, self.act_lo)
+        self.steps += tuple(steps)
+        self.in_size = steps.in_size
+        self.msg_size = steps.msg_size
+        self._room = 2
+        for dtype, arena in tuple(self._arenas.items()):
+            if not arena.extend(steps):
+                del self._arenas[dtype]
+
+    # Combine the plans of the nets into a single plan, where the groups of
+    #   the same class and depth in all of the nets are evaluated as one. The
+    #   nets keep their plans, so that later unions of some of the same nets
+    #   only combine them anew.
+    #
+    # Note: A net may occur more than once, its vertices are then evaluated
+    #   once for each occurrence (the last one being kept by the vertices).
+    @classmethod
+    def union(cls, nets):
+        plans = [net.plan() for net in nets]
+        rank = {}
+        keyed = []
+        for k, plan in enumerate(plans):
+            for j, step in enumerate(plan.steps):
+                v_class = step[0]
+                key = (step[3], rank.setdefault(v_class, len(rank)), )
+                if not v_class.batchable:
+                    key += (k, j, )
+                keyed.append((key, k, step, ))
+        keyed.sort(key=lambda entry: entry[:2])
+
+        # The position of the activations of each plan within the union.
+        flat_maps = [empty(plan.act_size, dtype=intp) for plan in plans]
+        vertices = []
+        act_lo = []
+        offset = 0
+        steps = _Steps()
+        i = 0
+        while i < len(keyed):
+            key, _, step = keyed[i]
+            v_class = step[0]
+            members = [keyed[i]]
+            i += 1
+            while i < len(keyed) and keyed[i][0] == key:
+                members.append(keyed[i])
+                i += 1
+
+            start = len(vertices)
+            g_act_lo = offset
+            for _, k, (_, s_start, s_stop, _, s_lo, _, _, _, _, _) in members:
+                plan = plans[k]
+                s_hi = int(plan.act_lo[s_stop])
+                vertices.extend(plan.vertices[s_start:s_stop])
+                act_lo.append(plan.act_lo[s_start:s_stop] - s_lo + offset)
+                flat_maps[k][s_lo:s_hi] = arange(offset, offset + s_hi - s_lo)
+                offset += s_hi - s_lo
+
+            if not v_class.batchable:
+                (_, k, step), = members
+                steps.single(v_class, start, len(vertices), key[0], g_act_lo,
+                        (flat_maps[k][idx] for idx in step[8]), net=nets[k])
+                continue
+
+            # Note: The vertices of different plans (or occurrences of a
+            #   plan) never share parents, but those of the groups of an
+            #   extended plan may.
+            g_idx = []
+            dups = False
+            for _, k, (_, s_start, s_stop, _, _, in_size, lo, _, _,
+                    _) in members:
+                if isinstance(lo, tuple):
+                    g_idx.append(flat_maps[k][lo[1].ravel()])
+                    dups = dups or lo[2]
+                else:
+                    g_idx.append(flat_maps[k][lo:lo + (s_stop - s_start)
+                        * in_size])
+            if len(set(k for _, k, _ in members)) < len(members):
+                dups = None
+            steps.batch(v_class, start, len(vertices), key[0], g_act_lo,
+                    concatenate(g_idx), dups=dups)
+
+        union = cls.__new__(cls)
+        union.vertices = tuple(vertices)
+        union.act_lo = concatenate(act_lo + [array([offset], dtype=intp)])
+        union.act_size = offset
+        union._init_steps(steps)
+        return union
+
+    # The position of each vertex, only built when first needed.
+    @property
+    def position(self):
+        if self._position is None:
+            self._position = {vertex: i
+                    for i, vertex in enumerate(self.vertices)}
+        return self._position
+
+    # The vertices of a step, as prepared by their class (see Vertex.batch).
+    def batch(self, v_class, start, stop):
+        try:
+            return self._batches[(start, stop)]
+        except KeyError:
+            batch = v_class.batch(self.vertices[start:stop])
+            self._batches[(start, stop)] = batch
+            return batch
+
+    def arena(self, dtype=float64):
+        dtype = np_dtype(dtype)
+        try:
+            return self._arenas[dtype]
+        except KeyError:
+            arena = Arena(self, dtype=dtype)
+            self._arenas[dtype] = arena
+            return arena
+
+    # A separate arena for a single forward pass that leaves the vertices
+    #   untouched, so that several threads can evaluate the same net (or nets
+    #   sharing vertices) at the same time.
+    def context(self, dtype=float64):
+        for step in self.steps:
+            # Note: Only sources keep their activations on the vertex.
+            if step[5] is None and step[0].fan_in:
+                raise ValueError(('{} can not be evaluated without vertex '
+                    'state').format(step[0].__name__))
+        return Arena(self, dtype=dtype)
+
+    # Drop the arenas (and batches) of the plan, along with the state they
+    #   hold for the vertices evaluated by them.
+    def release(self):
+        bound = set(id(step[6]) for arena in self._arenas.values()
+                for step in arena.steps if step[6] is not None)
+        for vertex in self.vertices:
+            at = vertex._at
+            if at is not None and id(at[0]) in bound:
+                vertex._at = None
+                vertex._input = vertex._activations = vertex._message = None
+        self._arenas.clear()
+        self._batches.clear()
+
+    # Without batched set the vertices of a group are evaluated one at a
+    #   time, other than sources which do not depend on each other. Each
+    #   vertex is left with the (rows of the) arena as its input, activations
+    #   and message (see Vertex), unless evaluated in a context.
+    def forward(self, net, model, loss=None, batched=False, context=None):
+        arena = (self.arena(model.params.dtype) if context is None
+                else context)
+        activations = arena.activations
+
+        for (v_class, vertices, start, stop, idx, _, views, _, _,
+                s_net) in arena.steps:
+            if views is None:
+                act_lo = self.act_lo[start:stop + 1].tolist()
+                for i, vertex in enumerate(vertices):
+                    if context is None:
+                        vertex.forward(net if s_net is None else s_net,
+                                model, loss=loss)
+                    activations[act_lo[i]:act_lo[i + 1]] = (
+                            vertex.activations.ravel())
+                continue
+
+            input_, activations_, _ = views
+            # Concatenate the parent activations, unless adjacent.
+            if idx is not None:
+                activations.take(idx, out=input_)
+
+            if batched or stop - start == 1 or not input_.shape[1]:
+                v_class.forward_batch(vertices, input_, model, loss=loss,
+                        out=activations_)
+            else:
+                for row in range(stop - start):
+                    rows = slice(row, row + 1)
+                    v_class.forward_batch(vertices[rows], input_[rows], model,
+                            loss=loss, out=activations_[rows])
+
+            if context is not None:
+                continue
+            for row, vertex in enumerate(vertices):
+                vertex._at = (views, row, )
+                vertex._input = vertex._activations = vertex._message = None
+
+    # Note: Relies on the buffers from the preceding forward pass.
+    def backward(self, net, model, gradient, batched=False):
+        arena = self.arena(model.params.dtype)
+        d_activations = arena.d_activations
+        scratch = arena.scratch
+
+        # The incoming messages are accumulated into the activation
+        #   gradients by each child.
+        d_activations.fill(0)
+
+        for (v_class, vertices, start, stop, idx, dups, views, incoming,
+                d_input, s_net) in reversed(arena.steps):
+            if views is None:
+                for vertex, p_idx in zip(reversed(vertices),
+                        reversed(idx)):
+                    vertex.backward(net if s_net is None else s_net, model,
+                            gradient)
+                    # Only vertices with parents send messages.
+                    if p_idx.size:
+                        d_activations[p_idx] += vertex.message.ravel()
+                continue
+
+            input_, activations, message = views
+            if batched or stop - start == 1 or not input_.shape[1]:
+                v_class.backward_batch(vertices, input_, activations,
+                        incoming, model, gradient, out=message,
+                        scratch=scratch)
+            else:
+                for row in reversed(range(stop - start)):
+                    rows = slice(row, row + 1)
+                    v_class.backward_batch(vertices[rows], input_[rows],
+                            activations[rows], incoming[rows], model,
+                            gradient, out=message[rows], scratch=scratch)
+
+            if not message.size:
+                pass
+            elif idx is None:
+                d_input += message
+            elif dups:
+                # Note: A parent may be shared by several vertices.
+                add.at(d_activations, idx, message)
+            else:
+                d_activations[idx] += message
+
+
+# A single contiguous buffer holding the activations, activation gradients,
+#   gathered inputs and messages for a plan, with views for each step.
+class Arena(object):
+    def __init__(self, plan, dtype=float64):
+        # The size of each region, with room to spare for extended plans.
+        sizes = tuple(plan._room * size
+                for size in (plan.act_size, plan.in_size, plan.msg_size))
+        act_room, in_room, _ = sizes
+        self.buffer = empty(2 * act_room + sum(sizes[1:]), dtype=dtype)
+        self._act = self.buffer[:act_room]
+        self._d_act = self.buffer[act_room:2 * act_room]
+        self._inputs = self.buffer[2 * act_room:2 * act_room + in_room]
+        self._messages = self.buffer[2 * act_room + in_room:]
+        self._sizes = sizes
+        self.plan = plan
+
+        self.activations = self._act[:plan.act_size]
+        self.d_activations = self._d_act[:plan.act_size]
+        self.steps = tuple(self._bind(step) for step in plan.steps)
+        # For the intermediate results of the backward pass of any step.
+        self.scratch = empty(self._scratch_size(plan.steps), dtype=dtype)
+
+    # Bind the new steps of an extended plan, returns False if there is no
+    #   room for them.
+    def extend(self, steps):
+        plan = self.plan
+        if any(size > room for size, room in zip((plan.act_size,
+                plan.in_size, plan.msg_size), self._sizes)):
+            return False
+        self.activations = self._act[:plan.act_size]
+        self.d_activations = self._d_act[:plan.act_size]
+        self.steps += tuple(self._bind(step) for step in steps)
+        size = self._scratch_size(steps)
+        if size > self.scratch.size:
+            self.scratch = empty(size, dtype=self.buffer.dtype)
+        return True
+
+    # The size of the activations of the largest batchable step.
+    @staticmethod
+    def _scratch_size(steps):
+        return max([(stop - start) * v_class.fan_out for (v_class, start,
+            stop, _, _, in_size, _, _, _, _) in steps if in_size is not None]
+            + [0])
+
+    def _bind(self, step):
+        (v_class, start, stop, _, act_lo, in_size, in_spec, msg_lo, idx,
+                net) = step
+        n = stop - start
+        vertices = self.plan.batch(v_class, start, stop)
+        if in_size is None:
+            return (v_class, vertices, start, stop, idx, False, None, None,
+                    None, net, )
+
+        activations = self._act[act_lo:act_lo
+                + n * v_class.fan_out].reshape(n, -1)
+        incoming = self._d_act[act_lo:act_lo
+                + n * v_class.fan_out].reshape(n, -1)
+        message = self._messages[msg_lo:msg_lo + n * in_size].reshape(n, -1)
+        if isinstance(in_spec, tuple):
+            in_lo, idx, dups = in_spec
+            input_ = self._inputs[in_lo:in_lo + n * in_size].reshape(n, -1)
+            d_input = None
+        else:
+            dups = False
+            input_ = self._act[in_spec:in_spec + n * in_size].reshape(n, -1)
+            d_input = self._d_act[in_spec:in_spec
+                    + n * in_size].reshape(n, -1)
+
+        return (v_class, vertices, start, stop, idx, dups,
+                (input_, activations, message, ), incoming, d_input, net, )
+
+    # The activations of a vertex as a column vector.
+    def __getitem__(self, vertex):
+        i = self.plan.position[vertex]
+        return self.activations[self.plan.act_lo[i]:self.plan.act_lo[
+            i + 1]].reshape(-1, 1)
@@ -0,0 +1,112 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Loss and gradient evaluation for mini-batches of nets spread over a persistent
+pool of processes, reducing the per-process gradients into a single gradient.
+
+Version:    2014-05-02
+'''
+
+from multiprocessing import cpu_count
+from multiprocessing import get_context
+
+from .net import Loss
+from .optimise import shared_zeros
+
+# State of each worker process, inherited when forked.
+_worker = {}
+
+def _init_worker(model, nets, gradients):
+    _worker['model'] = model
+    _worker['nets'] = nets
+    _worker['gradients'] = gradients
+
+def _loss_and_gradient(args):
+    slot, nets, no_loss, batched, dedup, cache = args
+    model = _worker['model']
+    # Note: The nets are referred to by their index in the pool.
+    nets = tuple(_worker['nets'][net] for net in nets)
+
+    loss, gradient = model.loss_and_gradient(nets, no_loss=no_loss,
+            normalise=False, batched=batched, reuse=True, dedup=dedup,
+            cache=cache)
+    _worker['gradients'][slot] = gradient.params.ravel()
+    return loss
+
+# Pairwise (tree) summation of the rows, in-place, into the first row.
+def _tree_sum(rows):
+    step = 1
+    while step < len(rows):
+        for i in range(0, len(rows) - step, 2 * step):
+            rows[i] += rows[i + step]
+        step *= 2
+    return rows[0]
+
+
+class GradientPool(object):
+    # The parameters of the model are moved into shared memory, so that any
+    #   update made to them is seen by all workers. The nets given here are
+    #   inherited by the workers and only these nets can be evaluated by the
+    #   pool, since nets (their vertex classes being created by functions)
+    #   can not be pickled and sent to the workers.
+    #
+    # Note: Relies on fork() to hand the model and nets to the workers.
+    def __init__(self, model, nets=(), processes=None):
+        if processes is None:
+            processes = cpu_count()
+
+        self.model = model.share_memory()
+        self.nets = tuple(nets)
+        self.processes = processes
+        self._index = {id(net): i for i, net in enumerate(self.nets)}
+        # One shared gradient for each chunk of a mini-batch.
+        self._gradients = shared_zeros((processes, model.params.size),
+                dtype=model.params.dtype)
+        self._pool = get_context('fork').Pool(processes,
+                initializer=_init_worker,
+                initargs=(self.model, self.nets, self._gradients, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def loss_and_gradient(self, nets, loss=None, gradient=None,
+            no_loss=False, normalise=True, batched=False, reuse=False,
+            dedup=False, cache=True):
+        if loss is None and not no_loss:
+            loss = Loss()
+        if gradient is None:
+            gradient = (self.model._reused_gradient() if reuse
+                    else self.model.gradient())
+        elif gradient.touched is not None:
+            raise ValueError('sparse gradients are not supported')
+
+        try:
+            nets = tuple(self._index[id(net)] for net in nets)
+        except KeyError:
+            raise ValueError('nets must be given to the pool when it is '
+                    'created') from None
+        num_chunks = min(self.processes, len(nets))
+        chunks = tuple((i, nets[i::num_chunks], no_loss, batched, dedup,
+            cache, ) for i in range(num_chunks))
+
+        for chunk_loss in self._pool.map(_loss_and_gradient, chunks):
+            if loss is not None:
+                for key, value in chunk_loss.items():
+                    loss[key] += value
+
+        gradient.params += _tree_sum(self._gradients[:num_chunks]).reshape(
+                gradient.params.shape)
+
+        if normalise:
+            if loss is not None:
+                loss.normalise(len(nets))
+            gradient.normalise(len(nets))
+
+        return (loss, gradient, )
@@ -0,0 +1,123 @@
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Compact vocabularies, mapping (string) keys to rows of an embedding table.
+
+Version:    2014-05-05
+'''
+
+from hashlib import sha1
+from zlib import crc32
+
+from numpy import array
+from numpy import cumsum
+from numpy import int32
+from numpy import int64
+from numpy import uint32
+from numpy import zeros
+
+
+def _encode(key):
+    if not isinstance(key, str):
+        raise TypeError('vocabulary keys must be str, not {}'.format(
+            type(key).__name__))
+    return key.encode('utf-8')
+
+
+# The UTF-8 encoded keys, concatenated in order, with the offset of each key
+#   (and the end of the last), and a table of the CRC-32 of each key in sorted
+#   order along with the row of the key, the row being the position of the
+#   key in the order given. Keys must be strings, unknown keys map to the row
+#   of the missing key.
+#
+# Note: Only a few arrays (and a single string) are kept, which unlike a
+#   dictionary of Python objects are cheap to pickle and remain shared by
+#   forked processes as they are never written to (not even reference counts).
+#   A hash only narrows down the candidates, the keys are always compared.
+class Vocabulary(object):
+    def __init__(self, keys, missing):
+        encoded = [_encode(key) for key in keys]
+        if len(set(encoded)) != len(encoded):
+            raise ValueError('duplicate keys in vocabulary')
+        self.blob = b''.join(encoded)
+        self.offsets = zeros(len(encoded) + 1, dtype=int64)
+        cumsum([len(key) for key in encoded], out=self.offsets[1:])
+
+        hashes = array([crc32(key) for key in encoded], dtype=uint32)
+        order = hashes.argsort(kind='mergesort')
+        self.hashes = hashes[order]
+        self.rows = order.astype(int32)
+
+        if missing not in self:
+            raise KeyError(missing)
+        self.missing = missing
+        self.missing_row = self._find(_encode(missing))
+        # Cache(s).
+        self._fingerprint = None
+
+    def __len__(self):
+        return self.rows.size
+
+    def __contains__(self, key):
+        return (isinstance(key, str)
+                and self._find(key.encode('utf-8')) is not None)
+
+    # The row of an encoded key, if any, given its hash and the first position
+    #   of the hash in the table if known.
+    def _find(self, encoded, h=None, i=None):
+        if h is None:
+            h = crc32(encoded)
+        if i is None:
+            # Note: A Python integer would convert the whole table.
+            i = int(self.hashes.searchsorted(uint32(h)))
+        hashes = self.hashes
+        while i < hashes.size and hashes[i] == h:
+            row = int(self.rows[i])
+            if self.blob[self.offsets[row]:self.offsets[row + 1]] == encoded:
+                return row
+            i += 1
+        return None
+
+    # The row of a single key.
+    def __getitem__(self, key):
+        row = self._find(_encode(key))
+        return self.missing_row if row is None else row
+
+    # The rows for a sequence of keys as an array, with a single search.
+    def lookup(self, keys):
+        encoded = [_encode(key) for key in keys]
+        hashes = array([crc32(key) for key in encoded], dtype=uint32)
+        idx = self.hashes.searchsorted(hashes)
+        # The first candidate of each key, compared below.
+        idx[idx == self.hashes.size] = 0
+        found = self.hashes[idx] == hashes
+        rows = self.rows[idx]
+        lo = self.offsets[rows].tolist()
+        hi = self.offsets[rows + 1].tolist()
+
+        blob = self.blob
+        missing_row = self.missing_row
+        out = rows.tolist()
+        for j, key in enumerate(encoded):
+            if not found[j]:
+                out[j] = missing_row
+            elif blob[lo[j]:hi[j]] != key:
+                # Note: Another key with the same hash, rarely if ever.
+                row = self._find(key, int(hashes[j]), int(idx[j]))
+                out[j] = missing_row if row is None else row
+        return array(out, dtype=int32)
+
+    # The key of a row, the inverse of __getitem__.
+    def key(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row
+            + 1]].decode('utf-8')
+
+    # A digest of the keys and their rows (and the missing key), to tell
+    #   whether a table of embeddings was made for this vocabulary.
+    def fingerprint(self):
+        if self._fingerprint is None:
+            digest = sha1(self.offsets.astype('<i8').tobytes())
+            digest.update(self.blob)
+            digest.update(_encode(self.missing))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
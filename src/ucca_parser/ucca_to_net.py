@@ -6,7 +6,6 @@ import argparse
 import sys
 import operator
 from collections import OrderedDict
-from numpy import array
 
 from ucca import layer0
 from ucca import layer1
@@ -33,9 +32,8 @@ def create_model(passage):
     reprs = OrderedDict([(t.text, random_uniform(dims)) for t in terminals])
     reprs['<unk>'] = random_uniform(dims)
 
-    # One-hot labels as column vectors.
-    neg = array((1, 0)).reshape(-1, 1)
-    pos = array((0, 1)).reshape(-1, 1)
+    # Labels as class indices.
+    neg, pos = range(2)
     labels = (neg, pos)
 
     # Generate classes for each desired vertex.
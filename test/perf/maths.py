@@ -11,11 +11,21 @@ Version:    2014-03-11
 from timeit import repeat
 
 from numpy import empty
+from numpy import int32
+from numpy import zeros
 from numpy.random import random
 
+from nerv.maths import cy_rnn_backward
+from nerv.maths import cy_rnn_forward
 from nerv.maths import cy_softmax
+from nerv.maths import cy_softmax_xent
+from nerv.maths import cy_softmax_xent_backward
 from nerv.maths import cy_tanh_prime
+from nerv.maths import py_rnn_backward
+from nerv.maths import py_rnn_forward
 from nerv.maths import py_softmax
+from nerv.maths import py_softmax_xent
+from nerv.maths import py_softmax_xent_backward
 from nerv.maths import py_tanh_prime
 
 if __name__ == '__main__':
@@ -34,3 +44,51 @@ if __name__ == '__main__':
             ):
         print(f.__name__, end=' ')
         print(min(repeat(lambda : f(x, out=o), repeat=num_its, number=1)))
+
+    # Layer operations, for a single vertex.
+    weight = random((dims, 2 * dims))
+    bias = random((dims, 1))
+    input_ = random((1, 2 * dims))
+    activations = empty((1, dims))
+    message = empty((1, 2 * dims))
+    w_gradient = empty(weight.shape)
+    b_gradient = empty(bias.shape)
+    for f_forward, f_backward in (
+            (py_rnn_forward, py_rnn_backward, ),
+            (cy_rnn_forward, cy_rnn_backward, ),
+            ):
+        def f():
+            f_forward(weight, bias, input_, out=activations)
+            f_backward(weight, input_, activations, activations, w_gradient,
+                    b_gradient, out=message)
+
+        print(f_forward.__name__, f_backward.__name__, end=' ')
+        try:
+            print(min(repeat(f, repeat=num_its, number=1)))
+        except NotImplementedError:
+            print('not available')
+
+    # Softmax with the cross entropy loss, for a single labelled vertex.
+    lbls = 5
+    weight = random((lbls, dims))
+    bias = random((lbls, 1))
+    input_ = random((1, dims))
+    labels = zeros(1, dtype=int32)
+    activations = empty((1, lbls))
+    message = empty((1, dims))
+    w_gradient = empty(weight.shape)
+    b_gradient = empty(bias.shape)
+    for f_forward, f_backward in (
+            (py_softmax_xent, py_softmax_xent_backward, ),
+            (cy_softmax_xent, cy_softmax_xent_backward, ),
+            ):
+        def f():
+            f_forward(weight, bias, input_, labels, out=activations)
+            f_backward(weight, input_, activations, labels, w_gradient,
+                    b_gradient, out=message)
+
+        print(f_forward.__name__, f_backward.__name__, end=' ')
+        try:
+            print(min(repeat(f, repeat=num_its, number=1)))
+        except NotImplementedError:
+            print('not available')
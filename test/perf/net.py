@@ -30,6 +30,8 @@ from nerv.net import net_model
 from nerv.net import net_model
 from nerv.net import rnn_vertex
 from nerv.net import softmax_vertex
+from nerv.plan import Plan
+from nerv.pool import GradientPool
 from nerv.rand import decorate
 from nerv.rand import onehot
 from nerv.rand import bintree
@@ -98,8 +100,10 @@ def _perf_hot_spot():
 
         # Attach the profiler.
         profiler = LineProfiler()
-        profiler.add_function(Comp.forward)
-        profiler.add_function(Comp.backward)
+        profiler.add_function(Comp.forward_batch.__func__)
+        profiler.add_function(Comp.backward_batch.__func__)
+        profiler.add_function(Plan.forward)
+        profiler.add_function(Plan.backward)
         profiler.enable()
 
         # Run the network forwards and backwards to accumulate statistics.
@@ -125,25 +129,39 @@ def _perf_through():
                         struct_f=struct_f)
                 model = Model()
 
-            tocs = []
-            for _ in range(NUM_THROUGHS):
-                tic = time()
-                for net in nets:
-                    net.forward(model)
-                tocs.append(time() - tic)
-            print(('{} sequential forward throughput: {:.1f} net(s) per second'
-                ).format(comp_c_f.__name__, NUM_THROUGH_NETS / min(*tocs)))
-
-            tocs = []
-            for _ in range(NUM_THROUGHS):
-                gradient = model.gradient()
-                tic = time()
-                for net in nets:
-                    net.backward(model, gradient=gradient)
-                tocs.append(time() - tic)
-            print(('{} sequential backward throughput: {:.1f} net(s) per '
-                'second').format(comp_c_f.__name__,
-                    NUM_THROUGH_NETS / min(*tocs)))
+            for batched in (False, True, ):
+                mode = 'batched' if batched else 'sequential'
+
+                tocs = []
+                for _ in range(NUM_THROUGHS):
+                    tic = time()
+                    for net in nets:
+                        net.forward(model, batched=batched)
+                    tocs.append(time() - tic)
+                print(('{} {} forward throughput: {:.1f} net(s) per second'
+                    ).format(comp_c_f.__name__, mode,
+                        NUM_THROUGH_NETS / min(*tocs)))
+
+                tocs = []
+                for _ in range(NUM_THROUGHS):
+                    gradient = model.gradient()
+                    tic = time()
+                    for net in nets:
+                        net.backward(model, gradient=gradient,
+                                batched=batched)
+                    tocs.append(time() - tic)
+                print(('{} {} backward throughput: {:.1f} net(s) per '
+                    'second').format(comp_c_f.__name__, mode,
+                        NUM_THROUGH_NETS / min(*tocs)))
+
+                tocs = []
+                for _ in range(NUM_THROUGHS):
+                    tic = time()
+                    model.loss_and_gradient(nets, batched=batched)
+                    tocs.append(time() - tic)
+                print(('{} {} mini-batch throughput: {:.1f} net(s) per '
+                    'second').format(comp_c_f.__name__, mode,
+                        NUM_THROUGH_NETS / min(*tocs)))
 
 def _perf_through_par():
     num_threads = min(cpu_count(), 4)
@@ -156,24 +174,31 @@ def _perf_through_par():
             model = Model()
 
 
+        # Note: Creating a context is costly, re-use them for each pass.
+        contexts = [net.context() for net in nets]
+
+        def forward(net_and_context):
+            net, context = net_and_context
+            net.forward(model, context=context)
+
         tocs = []
         for _ in range(NUM_THROUGHS):
             tic = time()
-            for _ in pool.imap_unordered(model.forward, nets):
+            for _ in pool.imap_unordered(forward, zip(nets, contexts)):
                 pass
             tocs.append(time() - tic)
         print(('{} parallel ({} thread(s)) forward throughput: {:.1f} net(s) '
             'per second').format(comp_c_f.__name__, num_threads,
                 NUM_THROUGH_NETS / min(*tocs)))
 
-        # TODO: Can't share gradient? Needs to be fixed?
-        tocs = []
-        for _ in range(NUM_THROUGHS):
-            tic = time()
-            for _ in pool.imap_unordered(model.backward, nets):
-                pass
-            tocs.append(time() - tic)
-        print(('{} parallel ({} thread(s)) backward throughput: {:.1f} '
+        # The gradient can't be shared by threads, use processes instead.
+        with GradientPool(model, nets, processes=num_threads) as grad_pool:
+            tocs = []
+            for _ in range(NUM_THROUGHS):
+                tic = time()
+                model.loss_and_gradient(nets, pool=grad_pool)
+                tocs.append(time() - tic)
+        print(('{} parallel ({} process(es)) mini-batch throughput: {:.1f} '
             'net(s) per second').format(comp_c_f.__name__, num_threads,
                 NUM_THROUGH_NETS / min(*tocs)))
 
@@ -8,8 +8,10 @@ Author:     Pontus Stenetorp    <pontus stenetorp se>
 Version:    2014-04-29
 '''
 
+from nerv.dag import DAG
 from nerv.dag import OrderedSet
 
+from random import randint
 from random import shuffle
 
 if __name__ == '__main__':
@@ -39,4 +41,38 @@ if __name__ == '__main__':
 
         assert not oset
 
+    def topological_sort():
+        # A random DAG over a random order of the vertices, with the edges
+        #   added in random order.
+        vertices = list(range(32))
+        shuffle(vertices)
+        edges = []
+        for i in range(len(vertices)):
+            for j in range(i + 1, len(vertices)):
+                if randint(0, 3) == 0:
+                    edges.append((vertices[i], vertices[j], ))
+        shuffle(edges)
+
+        dag = DAG()
+        for k, (parent, child) in enumerate(edges):
+            dag.add_edge(parent, child)
+
+            # The order is maintained after each edge.
+            position = {v: i for i, v in enumerate(dag.topological_sort())}
+            assert len(position) == len(dag.vertices)
+            for p, c in edges[:k + 1]:
+                assert position[p] < position[c]
+
+        # Cycles are refused, leaving the DAG untouched.
+        order = dag.topological_sort()
+        for parent, child in edges[:8]:
+            try:
+                dag.add_edge(child, parent)
+                assert False, 'cycle not detected'
+            except ValueError:
+                pass
+            assert child not in dag.parents[parent]
+        assert dag.topological_sort() == order
+
     ordered_set()
+    topological_sort()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Sanity testing for the data module.
+
+Version:    2014-05-07
+'''
+
+from itertools import chain
+from itertools import count
+from threading import Event
+
+from lib.fixedseed import FixedSeed
+
+from nerv.data import batched
+from nerv.data import bucketed
+from nerv.data import mini_batches
+from nerv.data import prefetched
+from nerv.data import shuffled
+
+if __name__ == '__main__':
+    def shuffle_check():
+        items = list(range(100))
+        result = list(shuffled(iter(items), 10))
+        assert sorted(result) == items
+        assert result != items
+
+        # An item can not move more than the buffer size ahead.
+        for i, item in enumerate(result):
+            assert item <= i + 10
+
+    def batch_check():
+        batches = list(batched(range(10), 4))
+        assert batches == [(0, 1, 2, 3, ), (4, 5, 6, 7, ), (8, 9, )]
+
+        items = list(range(100))
+        batches = list(bucketed(reversed(items), 5, key=lambda x: x,
+            pool_batches=4))
+        assert sorted(chain.from_iterable(batches)) == items
+        for batch in batches:
+            assert max(batch) - min(batch) == len(batch) - 1
+
+    def prefetch_check():
+        assert list(prefetched(range(10), size=2)) == list(range(10))
+
+        def failing():
+            yield 1
+            raise ValueError('failed')
+
+        try:
+            list(prefetched(failing()))
+            assert False, 'exception not propagated'
+        except ValueError:
+            pass
+
+        # The producer stops once the consumer does, rather than block.
+        stopped = Event()
+
+        def endless():
+            try:
+                yield from count()
+            finally:
+                stopped.set()
+
+        items = prefetched(endless(), size=2)
+        assert next(items) == 0
+        items.close()
+        assert stopped.wait(timeout=10)
+
+    def stream_check():
+        built = count()
+
+        class Net(object):
+            def __init__(self, item):
+                next(built)
+                self.vertices = tuple(range(item % 7))
+
+        # Only what is needed is constructed, despite an infinite stream.
+        batches = mini_batches(count(), Net, 8, buffer_size=16, bucket=True,
+                pool_batches=2, prefetch=1)
+        batch = next(batches)
+        assert len(batch) == 8
+        sizes = [len(net.vertices) for net in batch]
+        assert sizes == sorted(sizes)
+        assert next(built) <= 8 * 2 * 3
+
+    with FixedSeed(0x4711):
+        shuffle_check()
+    batch_check()
+    prefetch_check()
+    with FixedSeed(0x4711):
+        stream_check()
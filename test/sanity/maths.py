@@ -13,12 +13,27 @@ Version:    2014-03-11
 from sys import stderr
 
 from numpy import allclose
+from numpy import array
+from numpy import float32
+from numpy import int32
+from numpy import zeros
 from numpy.random import random
 
+from nerv.loss import cross_entropy
+
+from nerv.maths import cy_rnn_backward
+from nerv.maths import cy_rnn_forward
 from nerv.maths import cy_softmax
+from nerv.maths import cy_softmax_xent
+from nerv.maths import cy_softmax_xent_backward
 from nerv.maths import cy_tanh_prime
+from nerv.maths import py_rnn_backward
+from nerv.maths import py_rnn_forward
 from nerv.maths import py_softmax
+from nerv.maths import py_softmax_xent
+from nerv.maths import py_softmax_xent_backward
 from nerv.maths import py_tanh_prime
+from nerv.maths import softmax_rows
 
 if __name__ == '__main__':
     dims = 2 # XXX: 32
@@ -41,3 +56,166 @@ if __name__ == '__main__':
                 '{}').format(f_ref.__name__, f.__name__), file=stderr)
             print('Reference:', o_ref.T, file=stderr)
             print('Output:   ', o.T, file=stderr)
+
+    # Layer operations, for a single row and a batch of rows.
+    for rows in (1, 3, ):
+        weight = random((dims, 2 * dims))
+        bias = random((dims, 1))
+        input_ = random((rows, 2 * dims))
+        incoming = random((rows, dims))
+        activations = py_rnn_forward(weight, bias, input_)
+        try:
+            o_activations = cy_rnn_forward(weight, bias, input_)
+        except NotImplementedError:
+            break
+
+        w_gradient = random(weight.shape)
+        b_gradient = random(bias.shape)
+        o_w_gradient = w_gradient.copy()
+        o_b_gradient = b_gradient.copy()
+        message = py_rnn_backward(weight, input_, activations, incoming,
+                w_gradient, b_gradient)
+        o_message = cy_rnn_backward(weight, input_, activations, incoming,
+                o_w_gradient, o_b_gradient)
+
+        # The same messages with the error computed in a scratch buffer.
+        scratch = random(rows * dims + 1)
+        s_message = py_rnn_backward(weight, input_, activations, incoming,
+                zeros(weight.shape), zeros(bias.shape), scratch=scratch)
+        o_s_message = cy_rnn_backward(weight, input_, activations, incoming,
+                zeros(weight.shape), zeros(bias.shape), scratch=scratch)
+
+        for name, o_ref, o in (
+                ('activations', activations, o_activations, ),
+                ('message', message, o_message, ),
+                ('weight gradient', w_gradient, o_w_gradient, ),
+                ('bias gradient', b_gradient, o_b_gradient, ),
+                ('message with scratch', message, s_message, ),
+                ('message with scratch', message, o_s_message, ),
+                ):
+            if not allclose(o_ref, o):
+                print(('WARNING: Sanity check failed for the {} of '
+                    'cy_rnn_forward/cy_rnn_backward').format(name),
+                    file=stderr)
+
+    # Softmax with the cross entropy loss, with a row without a label.
+    for labels in ((1, ), (0, -1, 1, ), ):
+        labels = array(labels, dtype=int32)
+        rows = labels.size
+        weight = random((3, dims))
+        bias = random((3, 1))
+        input_ = random((rows, dims))
+
+        activations, loss = py_softmax_xent(weight, bias, input_, labels)
+        ref = softmax_rows(input_.dot(weight.T) + bias.T)
+        ref_loss = 0.0
+        for row, label in zip(ref, labels):
+            if label >= 0:
+                target = array([0.0] * 3).reshape(-1, 1)
+                target[label] = 1
+                ref_loss += cross_entropy(row.reshape(-1, 1), target)
+        if not allclose(ref, activations) or not allclose(ref_loss, loss):
+            print('WARNING: Sanity check failed for py_softmax_xent',
+                    file=stderr)
+
+        try:
+            o_activations, o_loss = cy_softmax_xent(weight, bias, input_,
+                    labels)
+        except NotImplementedError:
+            break
+
+        w_gradient = random(weight.shape)
+        b_gradient = random(bias.shape)
+        o_w_gradient = w_gradient.copy()
+        o_b_gradient = b_gradient.copy()
+        message = py_softmax_xent_backward(weight, input_, activations,
+                labels, w_gradient, b_gradient)
+        o_message = cy_softmax_xent_backward(weight, input_, activations,
+                labels, o_w_gradient, o_b_gradient)
+
+        scratch = random(rows * 3 + 1)
+        s_message = py_softmax_xent_backward(weight, input_, activations,
+                labels, zeros(weight.shape), zeros(bias.shape),
+                scratch=scratch)
+        o_s_message = cy_softmax_xent_backward(weight, input_, activations,
+                labels, zeros(weight.shape), zeros(bias.shape),
+                scratch=scratch)
+
+        for name, o_ref, o in (
+                ('activations', activations, o_activations, ),
+                ('loss', loss, o_loss, ),
+                ('message', message, o_message, ),
+                ('weight gradient', w_gradient, o_w_gradient, ),
+                ('bias gradient', b_gradient, o_b_gradient, ),
+                ('message with scratch', message, s_message, ),
+                ('message with scratch', message, o_s_message, ),
+                ):
+            if not allclose(o_ref, o):
+                print(('WARNING: Sanity check failed for the {} of '
+                    'cy_softmax_xent/cy_softmax_xent_backward').format(name),
+                    file=stderr)
+
+    # Labels out of range, or not one for each row, are rejected rather than
+    #   used as offsets.
+    weight = random((3, dims))
+    bias = random((3, 1))
+    activations = softmax_rows(random((2, 3)))
+    for xent, xent_backward in (
+            (py_softmax_xent, py_softmax_xent_backward, ),
+            (cy_softmax_xent, cy_softmax_xent_backward, ),
+            ):
+        for labels in ((0, 3, ), (7, -1, ), (0, ), ):
+            labels = array(labels, dtype=int32)
+            input_ = random((2, dims))
+            for f, args in (
+                    (xent, (weight, bias, input_, labels, ), ),
+                    (xent_backward, (weight, input_, activations, labels,
+                        zeros(weight.shape), zeros(bias.shape), ), ),
+                    ):
+                try:
+                    f(*args)
+                except NotImplementedError:
+                    break
+                except ValueError:
+                    continue
+                print(('WARNING: Sanity check failed for {}, accepted the '
+                    'labels {}').format(f.__name__, labels.tolist()),
+                    file=stderr)
+
+    # Arrays of the wrong shape or dtype are rejected by the kernels, which
+    #   would otherwise read and write out of bounds.
+    weight = random((dims, 2 * dims))
+    bias = random((dims, 1))
+    input_ = random((3, 2 * dims))
+    activations = random((3, dims))
+    for f, args, kwargs in (
+            (cy_rnn_forward, (weight, bias, input_, ), {
+                'out': zeros((1, dims))}, ),
+            (cy_rnn_forward, (weight, bias, input_.astype(float32), ), {}, ),
+            (cy_rnn_forward, (weight, bias[:1], input_, ), {}, ),
+            (cy_rnn_backward, (weight, input_, activations, zeros((1, dims)),
+                zeros(weight.shape), zeros(bias.shape), ), {}, ),
+            (cy_rnn_backward, (weight, input_, activations, activations,
+                zeros(weight.shape), zeros(bias.shape), ), {
+                    'out': zeros((1, 2 * dims))}, ),
+            (cy_rnn_backward, (weight, input_, activations[:1], activations,
+                zeros(weight.shape), zeros(bias.shape), ), {}, ),
+            (cy_softmax_xent_backward, (weight, input_, activations[:1],
+                array((0, 1, 0, ), dtype=int32), zeros(weight.shape),
+                zeros(bias.shape), ), {}, ),
+            (cy_softmax_xent_backward, (weight, input_, activations,
+                array((0, 1, 0, ), dtype=int32),
+                zeros(weight.shape, dtype=float32), zeros(bias.shape), ),
+                {}, ),
+            (cy_softmax, (random(3), ), {'out': zeros(2)}, ),
+            (cy_tanh_prime, (random(3), ), {'out': zeros(3, dtype=float32)},
+                ),
+            ):
+        try:
+            f(*args, **kwargs)
+        except NotImplementedError:
+            break
+        except (TypeError, ValueError, ):
+            continue
+        print(('WARNING: Sanity check failed for {}, accepted mismatching '
+            'arrays').format(f.__name__), file=stderr)
@@ -10,19 +10,29 @@ Version:    2014-03-11
 
 # TODO: This module could be cleaned up.
 
+from collections import OrderedDict
+from itertools import chain
 from pickle import dumps
 from random import randint
 from sys import stderr
 
+from numpy import allclose
+from numpy import zeros
+
 from lib.fixedseed import FixedSeed
 
 from nerv.init import random_uniform
+from nerv.net import Loss
 from nerv.net import Net
+from nerv.net import average_vertex
+from nerv.net import factored_softmax_vertex
 from nerv.net import keyed_source_vertex
 from nerv.net import net_model
 from nerv.net import rnn_vertex
 from nerv.net import softmax_vertex
 from nerv.net import static_source_vertex
+from nerv.rand import bintree
+from nerv.rand import decorate
 
 # Classification vertex with a random target.
 def _rand_class(class_class, lbls):
@@ -30,6 +40,43 @@ def _rand_class(class_class, lbls):
     target[randint(0, lbls - 1)] = 1
     return class_class(target=target)
 
+# Random binary trees over the given keys with randomly labelled vertices.
+def _rand_nets(num_nets, dims=4, lbls=3):
+    keys = ('a', 'b', 'c', '<UNK>', )
+    dic = OrderedDict((k, random_uniform(dims)) for k in keys)
+
+    Source = keyed_source_vertex(dims, dic, missing_='<UNK>')
+    Comp = rnn_vertex(dims, 2)
+    Class = softmax_vertex(lbls, dims)
+    Model = net_model((Source, Comp, Class, ))
+
+    nets = []
+    for _ in range(num_nets):
+        net = bintree(Comp, (Source(keys[randint(0, len(keys) - 1)])
+            for _ in range(randint(2, 7))))
+        decorate(net, lambda : _rand_class(Class, lbls), internal_prob=0.5)
+        nets.append(net)
+
+    return (Model(), tuple(nets), )
+
+# A structurally identical net that shares no vertices with the given one.
+def _copy_net(net):
+    copies = {}
+    for vertex in net.topological_sort():
+        v_class = type(vertex)
+        if hasattr(vertex, 'row'):
+            copies[vertex] = v_class(vertex.key, vertex.row)
+        elif getattr(vertex, 'target', None) is not None:
+            copies[vertex] = v_class(target=vertex.target)
+        else:
+            copies[vertex] = v_class()
+
+    copy = Net()
+    for vertex in net.topological_sort():
+        for parent in net.parents[vertex]:
+            copy.add_edge(copies[parent], copies[vertex])
+    return copy
+
 if __name__ == '__main__':
     def gradient_check():
         from collections import OrderedDict
@@ -115,10 +162,79 @@ if __name__ == '__main__':
 
             return (model, net, )
 
+        # A soft target next to a one-hot one.
+        def soft():
+            dims = 2
+            lbls = 3
+
+            dic = OrderedDict((
+                    ('a', random_uniform(dims), ),
+                    ('b', random_uniform(dims), ),
+                    ('<UNK>', random_uniform(dims), ),
+                    ))
+
+            Source = keyed_source_vertex(dims, dic, missing_='<UNK>')
+            Comp = rnn_vertex(dims, 2)
+            Class = softmax_vertex(lbls, dims)
+            Model = net_model((Source, Comp, Class, ))
+
+            a = Source('a')
+            b = Source('b')
+            c = Comp()
+            d = Class(target=array((0.25, 0.75, 0, )).reshape(-1, 1))
+            e = Class(target=array((0, 0, 1, )).reshape(-1, 1))
+
+            net = Net()
+            net.add_edge(a, c)
+            net.add_edge(b, c)
+            net.add_edge(c, d)
+            net.add_edge(c, e)
+
+            model = Model()
+
+            return (model, net, )
+
+        # Labels of different classes of a factored softmax, the last class
+        #   being smaller than the others.
+        def factored():
+            dims = 2
+            lbls = 7
+
+            dic = OrderedDict((
+                    ('a', random_uniform(dims), ),
+                    ('b', random_uniform(dims), ),
+                    ('<UNK>', random_uniform(dims), ),
+                    ))
+
+            Source = keyed_source_vertex(dims, dic, missing_='<UNK>')
+            Comp = rnn_vertex(dims, 2)
+            Class = factored_softmax_vertex(lbls, dims)
+            Model = net_model((Source, Comp, Class, ))
+
+            a = Source('a')
+            b = Source('b')
+            c = Comp()
+            d = Class(target=1)
+            e = Class(target=6)
+            f = Class()
+
+            net = Net()
+            net.add_edge(a, c)
+            net.add_edge(b, c)
+            net.add_edge(c, d)
+            net.add_edge(c, e)
+            net.add_edge(c, f)
+
+            model = Model()
+
+            return (model, net, )
+
         for data_f in (
                 softmax,
                 keyed,
                 rnn,
+                soft,
+                factored,
                 ):
             fdiff_check(*data_f())
 
@@ -140,8 +256,719 @@ if __name__ == '__main__':
 
         dumps(Model)
 
+    def batched_check():
+        model, nets = _rand_nets(8)
+
+        for net in nets:
+            ref_loss = model.loss((net, ))
+            ref_gradient = net.backward(model)
+
+            loss = Loss()
+            net.forward(model, loss=loss, batched=True)
+            gradient = net.backward(model, batched=True)
+
+            assert allclose(ref_loss.total(), loss.total())
+            assert allclose(ref_gradient.params, gradient.params)
+
+        # Mini-batch evaluation across all of the nets at once, also with a
+        #   net occurring more than once.
+        for batch in (nets, nets + nets[:2], ):
+            ref_loss, ref_gradient = model.loss_and_gradient(batch)
+            loss, gradient = model.loss_and_gradient(batch, batched=True)
+
+            assert allclose(ref_loss.total(), loss.total())
+            assert allclose(ref_gradient.params, gradient.params)
+
+        # The plans of the nets are combined, rather than compiled anew.
+        plans = [net.plan() for net in nets]
+        model.loss_and_gradient(nets[::-1], batched=True)
+        assert all(net.plan() is plan for net, plan in zip(nets, plans))
+
+    def plan_check():
+        model, nets = _rand_nets(1)
+        net = nets[0]
+
+        # The plan is re-used across passes.
+        plan = net.plan()
+        ref_loss = model.loss((net, ))
+        assert net.plan() is plan
+        assert allclose(ref_loss.total(), model.loss((net, )).total())
+
+        # All sources are gathered by a single step, also when not batched.
+        sources = [step for step in plan.steps if step[0].fan_in == 1]
+        assert len(sources) == 1
+        assert list(plan.batch(*sources[0][:3]).rows) == [v.row
+                for v in plan.vertices if type(v) is sources[0][0]]
+
+        # Unless released, which drops the buffers held by the vertices.
+        ref_gradient = net.backward(model)
+        net.release()
+        assert net.plan() is not plan
+        assert all(vertex.activations is None for vertex in plan.vertices
+                if type(vertex).batchable)
+        plan = net.plan()
+        loss, gradient = model.loss_and_gradient((net, ), cache=False)
+        assert net.plan() is not plan
+        assert allclose(ref_loss.total(), loss.total())
+        assert allclose(ref_gradient.params, gradient.params)
+
+        # Extended by edges to new vertices, as when a net is built bottom-up
+        #   and evaluated after each addition.
+        Source, Comp, Class = model.vertice_classes
+        built = Net()
+        left = Comp()
+        built.add_edge(Source('a'), left)
+        built.add_edge(Source('b'), left)
+        built.add_edge(left, _rand_class(Class, 3))
+        built.forward(model)
+        plan = built.plan()
+        for key in 'cab':
+            right = Source(key)
+            parent = Comp()
+            built.add_edge(left, parent)
+            built.add_edge(right, parent)
+            built.add_edge(parent, _rand_class(Class, 3))
+            ref_loss, ref_gradient = model.loss_and_gradient(
+                    (_copy_net(built), ))
+            for batched in (False, True):
+                loss, gradient = model.loss_and_gradient((built, ),
+                        batched=batched)
+                assert allclose(ref_loss.total(), loss.total())
+                assert allclose(ref_gradient.params, gradient.params)
+            left = parent
+        assert built.plan() is plan
+
+        # But invalidated by edges to the vertices of the plan.
+        built.add_edge(Source('c'), left)
+        assert built.plan() is not plan
+
+    def hogwild_check():
+        from itertools import islice
+
+        from nerv.optimise import fmin_hogwild
+
+        model, nets = _rand_nets(16)
+        model.share_memory()
+        params = model.params.copy()
+
+        def f(_, batch):
+            loss, gradient = model.loss_and_gradient(batch)
+            return (loss.total(), gradient.params, )
+
+        losses = [loss for _, loss, _ in islice(fmin_hogwild(f, model.params,
+            nets, processes=2, batch_size=4), 8)]
+
+        # The updates by the workers are visible to this process.
+        assert not allclose(params, model.params)
+        assert losses[-1] < losses[0]
+
+        # Which they would not be without shared memory.
+        try:
+            fmin_hogwild(f, params, nets, processes=2)
+            assert False, 'accepted parameters not in shared memory'
+        except ValueError:
+            pass
+
+    def pool_check():
+        from nerv.pool import GradientPool
+
+        model, nets = _rand_nets(16)
+        loss, gradient = model.loss_and_gradient(nets)
+
+        with GradientPool(model, nets, processes=3) as pool:
+            for batched in (False, True):
+                p_loss, p_gradient = model.loss_and_gradient(nets,
+                        batched=batched, pool=pool)
+                assert allclose(loss.total(), p_loss.total())
+                assert allclose(gradient.params, p_gradient.params)
+
+            # Updates to the parameters are seen by the workers.
+            model.params *= 0.5
+            loss, gradient = model.loss_and_gradient(nets[4:12])
+            p_loss, p_gradient = model.loss_and_gradient(nets[4:12],
+                    pool=pool)
+            assert allclose(loss.total(), p_loss.total())
+            assert allclose(gradient.params, p_gradient.params)
+
+            # Nets not given to the pool can not be sent to the workers.
+            try:
+                model.loss_and_gradient(nets[:2] + (_copy_net(nets[2]), ),
+                        pool=pool)
+                assert False, 'evaluated a net not given to the pool'
+            except ValueError:
+                pass
+
+    def context_check():
+        from multiprocessing.pool import ThreadPool
+
+        model, nets = _rand_nets(16)
+        for net in nets:
+            net.forward(model)
+        expected = [[vertex.activations.copy() for vertex in net]
+                for net in nets]
+        activations = [[vertex.activations for vertex in net]
+                for net in nets]
+
+        def f(net):
+            return net.forward(model, batched=True, context=net.context())
+
+        # Evaluate each net several times concurrently.
+        pool = ThreadPool(4)
+        for net, context in zip(nets * 4, pool.map(f, nets * 4)):
+            exp = expected[nets.index(net)]
+            for vertex, exp_act in zip(net, exp):
+                assert allclose(context[vertex], exp_act)
+
+        # The vertices are left untouched.
+        for net, acts in zip(nets, activations):
+            for vertex, act in zip(net, acts):
+                assert vertex.activations is act
+
+    def sparse_check():
+        from nerv.optimise import fmin_adagrad
+
+        model, nets = _rand_nets(16)
+        _, gradient = model.loss_and_gradient(nets)
+        _, s_gradient = model.loss_and_gradient(nets,
+                gradient=model.gradient(sparse=True))
+        assert allclose(gradient.params, s_gradient.params)
+        assert allclose(gradient.params, s_gradient.sparse().toarray())
+
+        # Lazy AdaGrad updates are identical to the dense ones.
+        d_model = model.gradient()
+        d_model.params[:] = model.params
+
+        def f(_):
+            s_gradient.clear()
+            loss, _ = model.loss_and_gradient(nets[:4], gradient=s_gradient)
+            return (loss.total(), s_gradient.sparse(), )
+
+        def d_f(_):
+            loss, gradient = d_model.loss_and_gradient(nets[:4])
+            return (loss.total(), gradient.params, )
+
+        for fmin_f, m in ((f, model), (d_f, d_model)):
+            for _, _ in zip(fmin_adagrad(fmin_f, m.params), range(4)):
+                pass
+        assert allclose(model.params, d_model.params)
+
+        # Clearing leaves the gradient zeroed.
+        model.loss_and_gradient(nets, gradient=s_gradient)
+        s_gradient.clear()
+        assert not s_gradient.params.any()
+
+    def reuse_check():
+        model, nets = _rand_nets(8)
+        params = model.params.copy()
+        _, gradient = model.loss_and_gradient(nets)
+
+        # The gradient is cleared and re-used, leaving the model untouched.
+        for _ in range(2):
+            _, r_gradient = model.loss_and_gradient(nets, reuse=True)
+            assert allclose(gradient.params, r_gradient.params)
+        assert r_gradient is model.loss_and_gradient(nets, reuse=True)[1]
+        assert (model.params == params).all()
+
+    def float32_check():
+        from numpy import float32
+
+        model, nets = _rand_nets(8)
+        Model32 = net_model(type(model).vertice_classes, dtype=float32)
+        model32 = Model32()
+        model32.params[:] = model.params
+
+        for batched in (False, True):
+            loss, gradient = model.loss_and_gradient(nets, batched=batched)
+            loss32, gradient32 = model32.loss_and_gradient(nets,
+                    batched=batched)
+            assert gradient32.params.dtype == float32
+            assert allclose(loss.total(), loss32.total(), rtol=1e-4)
+            assert allclose(gradient.params, gradient32.params, atol=1e-5)
+
+        for net in nets:
+            context = net.forward(model32, context=net.context(float32))
+            net.forward(model)
+            for vertex in net:
+                assert allclose(vertex.activations, context[vertex],
+                        atol=1e-5)
+
+        # As well as for classes that are not batchable.
+        Source, Comp, Class = type(model).vertice_classes
+        Model = net_model((Source, Comp, Class, average_vertex(4), ))
+        Average = Model.vertice_classes[-1]
+        Model32 = net_model(Model.vertice_classes, dtype=float32)
+        model = Model()
+        model32 = Model32()
+        model32.params[:] = model.params
+        nets = []
+        for keys in ('ab', 'ca', 'bb', ):
+            net = Net()
+            comp = Comp()
+            average = Average()
+            for key in keys:
+                net.add_edge(Source(key), comp)
+            net.add_edge(comp, average)
+            net.add_edge(average, _rand_class(Class, 3))
+            nets.append(net)
+        loss, gradient = model.loss_and_gradient(nets)
+        loss32, gradient32 = model32.loss_and_gradient(nets)
+        assert abs(gradient32.weight[Average.name]).sum()
+        assert allclose(loss.total(), loss32.total(), rtol=1e-4)
+        assert allclose(gradient.params, gradient32.params, atol=1e-5)
+
+    def save_check():
+        from os import remove
+        from tempfile import mkstemp
+
+        model, nets = _rand_nets(4)
+        _, path = mkstemp()
+        try:
+            model.save(path)
+            loaded = type(model).load(path)
+            assert (loaded.params == model.params).all()
+            assert not loaded.params.flags.writeable
+            for net in nets:
+                assert allclose(model.loss((net, )).total(),
+                        loaded.loss((net, )).total())
+
+            # Models with a different layout are refused.
+            Other = net_model((rnn_vertex(5, 2), ))
+            try:
+                Other.load(path)
+                assert False, 'loaded a mismatching model'
+            except ValueError:
+                pass
+
+            # As are models with the same layout but other vocabularies, be
+            #   it other keys or the same keys in another order.
+            _, Comp, Class = model.vertice_classes
+            for keys in (('a', 'b', 'd', '<UNK>', ),
+                    ('b', 'a', 'c', '<UNK>', ), ):
+                Other = net_model((keyed_source_vertex(4, OrderedDict(
+                    (k, random_uniform(4)) for k in keys),
+                    missing_='<UNK>'), Comp, Class, ))
+                assert Other.layout() == type(model).layout()
+                try:
+                    Other.load(path)
+                    assert False, 'loaded a mismatching vocabulary'
+                except ValueError:
+                    pass
+        finally:
+            remove(path)
+
+    def vocabulary_check():
+        from nerv.vocab import Vocabulary
+
+        keys = ('the', 'a', 'caf\u00e9', '<unk>', 'an', )
+        vocab = Vocabulary(keys, '<unk>')
+        assert len(vocab) == len(keys)
+        for row, key in enumerate(keys):
+            assert key in vocab
+            assert vocab[key] == row
+        assert 'zebra' not in vocab
+        assert vocab['zebra'] == vocab['<unk>']
+        assert list(vocab.lookup(('an', 'zebra', 'the', '~', ))) == [
+                4, 3, 0, 3]
+        assert [vocab.key(row) for row in range(len(keys))] == list(keys)
+
+        # Keys are compared in full, however long and whatever they contain.
+        keys = ('a', 'a\x00', '\x00', '', 'x' * 4096, '<unk>', )
+        vocab = Vocabulary(keys, '<unk>')
+        for row, key in enumerate(keys):
+            assert vocab[key] == row
+            assert vocab.key(row) == key
+        assert vocab['x' * 4095] == vocab['<unk>']
+        assert list(vocab.lookup(keys)) == list(range(len(keys)))
+        # Note: Both keys have the same CRC-32.
+        vocab = Vocabulary(('<unk>', 'plumless', 'buckeroo', ), '<unk>')
+        assert list(vocab.lookup(('buckeroo', 'plumless', ))) == [2, 1]
+        assert vocab['buckeroo'] == 2 and vocab['plumless'] == 1
+        try:
+            Vocabulary(('a', 'b', 'a', ), 'a')
+            assert False, 'accepted duplicate keys'
+        except ValueError:
+            pass
+        try:
+            vocab[17]
+            assert False, 'accepted a key that is not a string'
+        except TypeError:
+            pass
+        assert 17 not in vocab
+
+        Source = keyed_source_vertex(2, OrderedDict((k, random_uniform(2))
+            for k in keys))
+        assert [v.row for v in Source.many(('a', 'zebra', ))] == [
+                Source('a').row, Source('<unk>').row]
+
+    def freeze_check():
+        model, nets = _rand_nets(8)
+        frozen = tuple(net.freeze() for net in nets)
+
+        for net, f_net in zip(nets, frozen):
+            assert f_net.freeze() is f_net
+            assert set(net.sources()) == set(f_net.sources())
+            assert set(net.sinks()) == set(f_net.sinks())
+            for vertex in net:
+                assert tuple(net.parents[vertex]) == f_net.parents[vertex]
+                assert set(net.children[vertex]) == set(
+                        f_net.children[vertex])
+
+        for batched in (False, True):
+            loss, gradient = model.loss_and_gradient(nets, batched=batched)
+            f_loss, f_gradient = model.loss_and_gradient(frozen,
+                    batched=batched)
+            assert allclose(loss.total(), f_loss.total())
+            assert allclose(gradient.params, f_gradient.params)
+
+        try:
+            frozen[0].add_edge(*tuple(frozen[0])[:2])
+            assert False, 'added an edge to a frozen net'
+        except TypeError:
+            pass
+
+    def corpus_check():
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        from nerv.corpus import Corpus
+        from nerv.corpus import save_corpus
+
+        model, nets = _rand_nets(8)
+        classes = model.vertice_classes
+        path = mkdtemp()
+        try:
+            save_corpus(path, iter(nets), classes)
+            corpus = Corpus(path, classes)
+            assert len(corpus) == len(nets)
+
+            # Random access, the nets being read back in any order.
+            for i in (5, 0, 7, 3, ):
+                net = nets[i]
+                c_net = corpus[i]
+                vertices = net.topological_sort()
+                assert [type(v) for v in vertices] == [
+                        type(v) for v in c_net.vertices]
+                assert allclose(model.loss((net, )).total(),
+                        model.loss((c_net, )).total())
+                loss, gradient = model.loss_and_gradient((net, ))
+                c_loss, c_gradient = model.loss_and_gradient((c_net, ))
+                assert allclose(gradient.params, c_gradient.params)
+
+            # Mismatching vertex classes are refused, as are classes of the
+            #   same names with other vocabularies.
+            Source, Comp, Class = classes
+            Other = keyed_source_vertex(4, OrderedDict((k, random_uniform(4))
+                for k in ('b', 'a', 'c', '<UNK>', )), missing_='<UNK>')
+            for other in (classes[::-1], (Other, Comp, Class, ), ):
+                try:
+                    Corpus(path, other)
+                    assert False, 'loaded a corpus with mismatching classes'
+                except ValueError:
+                    pass
+        finally:
+            rmtree(path)
+
+    def memo_check():
+        from nerv.memo import ActivationCache
+
+        model, nets = _rand_nets(8)
+        cache = ActivationCache(model)
+
+        for net in chain(nets, (_copy_net(net) for net in nets)):
+            loss = Loss()
+            activations = cache.forward(net, loss=loss)
+            context = net.forward(model, loss=Loss(), context=net.context())
+            for vertex in net:
+                assert allclose(activations[vertex], context[vertex].ravel())
+            assert allclose(loss.total(), model.loss((net, )).total())
+        assert cache.hits
+        assert len(cache)
+
+        # A new version of the model discards the activations.
+        model.params *= 0.5
+        model.version += 1
+        for net in nets:
+            activations = cache.forward(net)
+            context = net.forward(model, context=net.context())
+            for vertex in net:
+                assert allclose(activations[vertex], context[vertex].ravel())
+
+        # The cache never grows beyond its size.
+        cache = ActivationCache(model, size=3)
+        for net in nets:
+            cache.forward(net)
+            assert len(cache) <= 3
+
+        # Sub-DAGs are told apart by their structure alone, be it the keys,
+        #   the order of the parents or the depth.
+        Source, Comp, Class = model.vertice_classes
+        cache = ActivationCache(model)
+        for keys in ('ab', 'ba', 'aa', 'ab', ):
+            net = Net()
+            top = Comp()
+            for key in keys:
+                net.add_edge(Source(key), top)
+            for _ in range(len(cache) % 3):
+                parent = Comp()
+                net.add_edge(top, parent)
+                net.add_edge(Source('a'), parent)
+                top = parent
+            activations = cache.forward(net)
+            context = net.forward(model, context=net.context())
+            for vertex in net:
+                assert allclose(activations[vertex], context[vertex].ravel())
+        assert cache.hits
+
+        # As well as for gradients, which are models of their own.
+        ActivationCache(model.gradient()).forward(nets[0])
+
+    def dedup_check():
+        model, nets = _rand_nets(16)
+        nets = nets + tuple(_copy_net(net) for net in nets)
+
+        merged = Net.merge(nets)
+        assert len(merged.vertices) < sum(len(net.vertices) for net in nets)
+        # Every vertex with a target is kept.
+        assert (sum(1 for v in merged if getattr(v, 'target', None)
+            is not None) == sum(1 for net in nets for v in net
+                if getattr(v, 'target', None) is not None))
+
+        loss, gradient = model.loss_and_gradient(nets)
+        for batched in (False, True):
+            d_loss, d_gradient = model.loss_and_gradient(nets,
+                    batched=batched, dedup=True)
+            assert allclose(loss.total(), d_loss.total())
+            assert allclose(gradient.params, d_gradient.params)
+            assert allclose(loss.total(), model.loss(nets, batched=batched,
+                dedup=True).total())
+
+        # Identical siblings are not merged into a single parent.
+        Source, Comp, Class = model.vertice_classes
+        net = Net()
+        comp = Comp()
+        for source in (Source('a'), Source('a'), ):
+            net.add_edge(source, comp)
+        net.add_edge(comp, _rand_class(Class, 3))
+        nets = (net, _copy_net(net), )
+        merged = Net.merge(nets)
+        assert len(merged.parents[comp]) == 2
+        loss, gradient = model.loss_and_gradient(nets)
+        d_loss, d_gradient = model.loss_and_gradient(nets, dedup=True)
+        assert allclose(loss.total(), d_loss.total())
+        assert allclose(gradient.params, d_gradient.params)
+
+        # Nets drawn more than once for a mini-batch, and a labelled vertex
+        #   shared by nets with different parents, count every time.
+        model, nets = _rand_nets(2)
+        Source, Comp, Class = model.vertice_classes
+        shared = _rand_class(Class, 3)
+        for net in nets:
+            net.add_edge(next(v for v in net.topological_sort(reverse=True)
+                if isinstance(v, Comp)), shared)
+        for batch in ((nets[0], nets[1], nets[0], ), nets, ):
+            loss, gradient = model.loss_and_gradient(batch)
+            for batched in (False, True):
+                d_loss, d_gradient = model.loss_and_gradient(batch,
+                        batched=batched, dedup=True)
+                assert allclose(loss.total(), d_loss.total())
+                assert allclose(gradient.params, d_gradient.params)
+
+    def label_check():
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        from numpy import array
+        from numpy import int32
+
+        from nerv.corpus import Corpus
+        from nerv.corpus import save_corpus
+
+        model, nets = _rand_nets(8)
+        # The same nets with labels rather than one-hot targets.
+        labelled = tuple(_copy_net(net) for net in nets)
+        for net in labelled:
+            for vertex in net:
+                if getattr(vertex, 'target', None) is not None:
+                    vertex.target = int(vertex.target.argmax())
+
+        for batched in (False, True):
+            loss, gradient = model.loss_and_gradient(nets, batched=batched)
+            l_loss, l_gradient = model.loss_and_gradient(labelled,
+                    batched=batched)
+            assert allclose(loss.total(), l_loss.total())
+            assert allclose(gradient.params, l_gradient.params)
+
+        # Targets may change between passes, dense ones also in-place.
+        for net, l_net in zip(nets, labelled):
+            for vertex in chain(net, l_net):
+                target = getattr(vertex, 'target', None)
+                if isinstance(target, int):
+                    vertex.target = (target + 1) % vertex.fan_out
+                elif target is not None:
+                    label = (int(target.argmax()) + 1) % vertex.fan_out
+                    target[:] = 0
+                    target[label] = 1
+        fresh = tuple(_copy_net(net) for net in nets)
+        for batched in (False, True):
+            loss, gradient = model.loss_and_gradient(fresh, batched=batched)
+            for changed in (nets, labelled, ):
+                c_loss, c_gradient = model.loss_and_gradient(changed,
+                        batched=batched)
+                assert allclose(loss.total(), c_loss.total())
+                assert allclose(gradient.params, c_gradient.params)
+
+        # Labels are kept as such by a corpus.
+        path = mkdtemp()
+        try:
+            save_corpus(path, labelled, model.vertice_classes)
+            corpus = Corpus(path, model.vertice_classes)
+            assert allclose(loss.total() * len(nets),
+                    model.loss(tuple(corpus), normalise=False).total())
+            assert all(isinstance(vertex.target, int)
+                    for net in corpus for vertex in net
+                    if getattr(vertex, 'target', None) is not None)
+        finally:
+            rmtree(path)
+
+        Class = model.vertice_classes[2]
+        assert [v.target for v in Class.many(array((2, -1, 0, ),
+            dtype=int32))] == [2, None, 0]
+        assert (Class(1).dense_target().ravel() == (0, 1, 0, )).all()
+        try:
+            Class(3)
+            assert False, 'accepted a label out of range'
+        except ValueError:
+            pass
+
+    def factored_check():
+        from math import log
+
+        from numpy import arange
+        from numpy import random
+
+        dims = 4
+        lbls = 10
+
+        Source = static_source_vertex(dims)
+        Class = factored_softmax_vertex(lbls, dims)
+        Model = net_model((Source, Class, ))
+        model = Model()
+        assert Class.num_classes == 4
+        assert Class.fan_out == Class.num_classes + 3
+
+        source = Source(random.random_sample((dims, 1)))
+        # The probabilities of all labels, given by the activations of the
+        #   class of each label.
+        probs = []
+        for label in range(lbls):
+            vertex = Class(target=label)
+            net = Net()
+            net.add_edge(source, vertex)
+            loss = Loss()
+            net.forward(model, loss=loss)
+            activations = vertex.activations.ravel()
+            prob = (activations[label // 3]
+                    * activations[Class.num_classes + label % 3])
+            assert allclose(loss.total(), -log(prob))
+            probs.append(prob)
+        assert allclose(sum(probs), 1)
+
+        # The prediction is the most probable label of the most probable
+        #   class.
+        vertex = Class()
+        net = Net()
+        net.add_edge(source, vertex)
+        net.forward(model)
+        activations = vertex.activations.ravel()
+        c = activations[:Class.num_classes].argmax()
+        assert Class.predict(activations) == (c * 3
+                + activations[Class.num_classes:].argmax())
+
+        # Batches of the same vertices agree with evaluating them one by one.
+        nets = []
+        for labels in (arange(lbls), (-1, 3, 3, 9, ), ):
+            net = Net()
+            for vertex in Class.many(labels):
+                net.add_edge(source, vertex)
+            nets.append(net)
+        loss, gradient = model.loss_and_gradient(nets)
+        b_loss, b_gradient = model.loss_and_gradient(nets, batched=True)
+        assert allclose(loss.total(), b_loss.total())
+        assert allclose(gradient.params, b_gradient.params)
+
+        for target, error in ((1.0, TypeError, ), (lbls, ValueError, ), ):
+            try:
+                Class(target=target)
+                assert False, 'accepted target: {}'.format(target)
+            except error:
+                pass
+
+    def sampled_fdiff_check():
+        from nerv.fdiff import fdiff_gradient
+        from nerv.fdiff import max_relative_error
+
+        model, nets = _rand_nets(4)
+        params = model.params.copy()
+
+        full = fdiff_gradient(model, nets)
+        for processes, batched in ((None, False, ), (2, True, ), ):
+            sampled = fdiff_gradient(model, nets, samples=5,
+                    processes=processes, batched=batched)
+            # The parameters are restored after each probe.
+            assert (model.params == params).all()
+            assert list(sampled) == list(full)
+            for key, (coordinates, g, n) in sampled.items():
+                f_coordinates, f_g, f_n = full[key]
+                assert coordinates.size == min(5, f_coordinates.size)
+                index = f_coordinates.searchsorted(coordinates)
+                assert (f_coordinates[index] == coordinates).all()
+                assert allclose(g, f_g[index])
+                assert allclose(n, f_n[index])
+                assert max_relative_error(g, n) < 1e-4, key
+
+        # The sampled coordinates of sparse weights are in used rows.
+        (Source, _), (coordinates, g, _) = next(iter(sampled.items()))
+        assert Source.sparse
+        rows = set((coordinates // Source.fan_out).tolist())
+        used = set(vertex.row for net in nets for vertex in net
+                if isinstance(vertex, Source))
+        assert rows <= used
+
     # Run the actual tests.
     with FixedSeed(0x4711):
         gradient_check()
+    with FixedSeed(0x4711):
+        batched_check()
+    with FixedSeed(0x4711):
+        plan_check()
+    with FixedSeed(0x4711):
+        hogwild_check()
+    with FixedSeed(0x4711):
+        pool_check()
+    with FixedSeed(0x4711):
+        context_check()
+    with FixedSeed(0x4711):
+        sparse_check()
+    with FixedSeed(0x4711):
+        reuse_check()
+    with FixedSeed(0x4711):
+        float32_check()
+    with FixedSeed(0x4711):
+        save_check()
+    vocabulary_check()
+    with FixedSeed(0x4711):
+        freeze_check()
+    with FixedSeed(0x4711):
+        corpus_check()
+    with FixedSeed(0x4711):
+        memo_check()
+    with FixedSeed(0x4711):
+        dedup_check()
+    with FixedSeed(0x4711):
+        label_check()
+    with FixedSeed(0x4711):
+        factored_check()
+    with FixedSeed(0x4711):
+        sampled_fdiff_check()
 
     pickle_check()